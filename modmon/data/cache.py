@@ -0,0 +1,421 @@
+"""
+Functions for materialising dataset windows from the source database into a local
+cache of Parquet files, shared by all models run on the same window.
+"""
+from contextlib import contextmanager
+import fcntl
+import os
+from pathlib import Path
+import re
+import shutil
+import tempfile
+
+import pandas as pd
+from sqlalchemy import create_engine, text
+
+from ..config import config
+from ..db.connect import get_database_config
+
+# File in each window directory whose modification time records when the window was
+# last used (for least recently used eviction)
+LAST_USED_FILE = ".last_used"
+
+
+def cache_enabled(cache_config=None):
+    """Check whether the dataset window cache is enabled in the config file.
+
+    Parameters
+    ----------
+    cache_config : configparser.SectionProxy, optional
+        configparser section optionally containing the key 'enabled', by default None
+        which uses modmon.config.config["datacache"] if it exists.
+
+    Returns
+    -------
+    bool
+        True if the cache is enabled.
+    """
+    if cache_config is None:
+        if "datacache" not in config:
+            return False
+        cache_config = config["datacache"]
+    return cache_config.get("enabled") == "True"
+
+
+def get_cache_dir(cache_config=None, create=True):
+    """Get the path to the dataset window cache directory as defined in the config file.
+
+    Parameters
+    ----------
+    cache_config : configparser.SectionProxy, optional
+        configparser section containing the key 'cachedir', by default None which uses
+        modmon.config.config["datacache"]
+    create : bool, optional
+        Whether to create the cache directory, by default True
+
+    Returns
+    -------
+    pathlib.Path
+        Path to the dataset window cache directory.
+
+    Raises
+    ------
+    KeyError
+        If cache_config does not contain the key 'cachedir'
+    """
+    if cache_config is None:
+        cache_config = config["datacache"]
+    if "cachedir" not in cache_config:
+        raise KeyError(
+            "cache_config must contain the key 'cachedir', containing "
+            "the path where cached dataset windows will be stored."
+        )
+
+    cache_dir = Path(cache_config["cachedir"])
+    if create:
+        os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+
+def get_window_key(start_date=None, end_date=None, database=None):
+    """Build the name of the cache directory for a dataset window. Each unique
+    combination of start date, end date and database (i.e. each row in the Dataset
+    table) has its own directory.
+
+    Parameters
+    ----------
+    start_date : str or datetime.datetime , optional
+        Dataset start date, by default None
+    end_date : str or datetime.datetime , optional
+        Dataset end date, by default None
+    database : str, optional
+        Dataset database name, by default None
+
+    Returns
+    -------
+    str
+        Directory name with the format <database>_<start_date>_<end_date>
+    """
+    key = f"{database}_{start_date}_{end_date}"
+    # remove characters that aren't safe in file names (e.g. from datetimes)
+    return re.sub(r"[^A-Za-z0-9_.-]", "-", key)
+
+
+def get_source_engine(database, cache_config=None):
+    """Create an engine connected to the source database for a dataset window.
+
+    Parameters
+    ----------
+    database : str
+        Name of the source database to connect to
+    cache_config : configparser.SectionProxy, optional
+        configparser section containing the source database "dialect" and "host" and
+        optionally "port", "user" and "password", by default None which uses
+        modmon.config.config["datacache"]
+
+    Returns
+    -------
+    sqlalchemy.engine.Engine
+        Engine connected to the source database
+    """
+    if cache_config is None:
+        cache_config = config["datacache"]
+    db_config = dict(cache_config)
+    db_config["database"] = database
+    url, _ = get_database_config(db_config)
+    return create_engine(url)
+
+
+def get_window_queries(cache_config=None):
+    """Load the queries that define the tables extracted for each dataset window. Each
+    file <name>.sql in the 'querydir' directory defines a table called <name>, and may
+    use the bind parameters :start_date and :end_date to restrict the data returned.
+
+    Parameters
+    ----------
+    cache_config : configparser.SectionProxy, optional
+        configparser section containing the key 'querydir', by default None which uses
+        modmon.config.config["datacache"]
+
+    Returns
+    -------
+    dict
+        {table_name: query} dictionary
+
+    Raises
+    ------
+    FileNotFoundError
+        If no .sql files are found in querydir
+    """
+    if cache_config is None:
+        cache_config = config["datacache"]
+    query_dir = Path(cache_config["querydir"])
+
+    queries = {}
+    for query_path in sorted(query_dir.glob("*.sql")):
+        with open(query_path, "r") as f:
+            queries[query_path.stem] = f.read()
+
+    if len(queries) == 0:
+        raise FileNotFoundError(f"No .sql files found in {query_dir}")
+    return queries
+
+
+def extract_window(target_dir, start_date, end_date, database, cache_config=None):
+    """Run all the window queries against the source database and save the results as
+    Parquet files in target_dir. Each table is saved as a directory of Parquet files
+    (one per chunk of rows), which can be loaded with pandas.read_parquet.
+
+    Parameters
+    ----------
+    target_dir : str or Path
+        Directory to save the extracted tables to
+    start_date : str or datetime.datetime
+        Dataset start date
+    end_date : str or datetime.datetime
+        Dataset end date
+    database : str
+        Dataset database name
+    cache_config : configparser.SectionProxy, optional
+        datacache configparser section, by default None which uses
+        modmon.config.config["datacache"]
+    """
+    if cache_config is None:
+        cache_config = config["datacache"]
+    chunk_size = int(cache_config.get("chunksize", 100000))
+    params = {"start_date": start_date, "end_date": end_date}
+
+    engine = get_source_engine(database, cache_config=cache_config)
+    try:
+        with engine.connect() as conn:
+            for name, query in get_window_queries(cache_config).items():
+                table_dir = Path(target_dir, name)
+                os.makedirs(table_dir)
+                chunks = pd.read_sql(
+                    text(query), conn, params=params, chunksize=chunk_size
+                )
+                for i, chunk in enumerate(chunks):
+                    chunk.to_parquet(Path(table_dir, f"part-{i:05d}.parquet"))
+    finally:
+        engine.dispose()
+
+
+def get_dir_size(path):
+    """Get the total size of all files in a directory.
+
+    Parameters
+    ----------
+    path : str or Path
+        Directory path
+
+    Returns
+    -------
+    int
+        Size in bytes
+    """
+    return sum(
+        os.path.getsize(Path(root, f))
+        for root, _, files in os.walk(path)
+        for f in files
+    )
+
+
+@contextmanager
+def lock_window(cache_dir, key, exclusive=False, blocking=True):
+    """Lock a window in the cache. Shared locks are held while a window is being used
+    by a model, and exclusive locks while it is being created or evicted.
+
+    Parameters
+    ----------
+    cache_dir : str or Path
+        Path to the cache directory
+    key : str
+        Window key (see get_window_key)
+    exclusive : bool, optional
+        If True take an exclusive lock, otherwise a shared lock, by default False
+    blocking : bool, optional
+        If False raise BlockingIOError if the lock can't be taken immediately, by
+        default True
+
+    Yields
+    ------
+    None
+    """
+    flags = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+    if not blocking:
+        flags |= fcntl.LOCK_NB
+
+    lock_path = get_lock_path(cache_dir, key)
+    while True:
+        with open(lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, flags)
+            try:
+                # the lock file may have been deleted (see remove_lock_file) while
+                # waiting for the lock, in which case lock the new file instead
+                try:
+                    locked = (
+                        os.stat(lock_path).st_ino == os.fstat(lock_file.fileno()).st_ino
+                    )
+                except FileNotFoundError:
+                    locked = False
+                if locked:
+                    yield
+                    return
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def get_lock_path(cache_dir, key):
+    """Get the path to the lock file of a window in the cache.
+
+    Parameters
+    ----------
+    cache_dir : str or Path
+        Path to the cache directory
+    key : str
+        Window key (see get_window_key)
+
+    Returns
+    -------
+    pathlib.Path
+        Path to the lock file
+    """
+    return Path(cache_dir, f".{key}.lock")
+
+
+def remove_lock_file(cache_dir, key):
+    """Delete the lock file of a window. Must only be called while holding an exclusive
+    lock on the window (see lock_window).
+
+    Parameters
+    ----------
+    cache_dir : str or Path
+        Path to the cache directory
+    key : str
+        Window key (see get_window_key)
+    """
+    try:
+        os.remove(get_lock_path(cache_dir, key))
+    except FileNotFoundError:
+        pass
+
+
+def evict_windows(cache_dir=None, max_size=None, keep=None):
+    """Delete the least recently used windows from the cache until its total size is
+    below max_size, along with their lock files. Windows currently in use are skipped.
+    Lock files of windows that aren't in the cache (e.g. because extracting them
+    failed) are also deleted.
+
+    Parameters
+    ----------
+    cache_dir : str or Path, optional
+        Path to the cache directory, by default None which uses get_cache_dir()
+    max_size : int, optional
+        Maximum cache size in bytes, by default None which uses the value of 'maxsize'
+        (in MB) in modmon.config.config["datacache"]
+    keep : str, optional
+        Key of a window that should never be evicted, by default None
+
+    Returns
+    -------
+    list
+        Keys of the evicted windows.
+    """
+    if cache_dir is None:
+        cache_dir = get_cache_dir()
+    if max_size is None:
+        max_size = int(config["datacache"].get("maxsize", 10000)) * 2 ** 20
+
+    windows = []
+    for window_dir in Path(cache_dir).iterdir():
+        if window_dir.is_dir() and not window_dir.name.startswith("."):
+            last_used = Path(window_dir, LAST_USED_FILE)
+            used_time = last_used.stat().st_mtime if last_used.exists() else 0
+            windows.append((used_time, window_dir, get_dir_size(window_dir)))
+
+    total_size = sum(size for _, _, size in windows)
+    evicted = []
+    for _, window_dir, size in sorted(windows):
+        if total_size <= max_size:
+            break
+        if window_dir.name == keep:
+            continue
+        try:
+            with lock_window(
+                cache_dir, window_dir.name, exclusive=True, blocking=False
+            ):
+                shutil.rmtree(window_dir)
+                remove_lock_file(cache_dir, window_dir.name)
+        except BlockingIOError:
+            continue
+        total_size -= size
+        evicted.append(window_dir.name)
+
+    for lock_path in Path(cache_dir).glob(".*.lock"):
+        key = lock_path.name[1 : -len(".lock")]
+        if key == keep or Path(cache_dir, key).exists():
+            continue
+        try:
+            with lock_window(cache_dir, key, exclusive=True, blocking=False):
+                if not Path(cache_dir, key).exists():
+                    remove_lock_file(cache_dir, key)
+        except BlockingIOError:
+            continue
+
+    return evicted
+
+
+@contextmanager
+def cached_window(start_date=None, end_date=None, database=None, verbose=True):
+    """Get the path to the local copy of a dataset window, extracting it from the source
+    database if it's not already in the cache. The window is protected from eviction
+    until the context exits.
+
+    Parameters
+    ----------
+    start_date : str or datetime.datetime , optional
+        Dataset start date, by default None
+    end_date : str or datetime.datetime , optional
+        Dataset end date, by default None
+    database : str, optional
+        Dataset database name, by default None
+    verbose : bool, optional
+        If True print additional progress messages, by default True
+
+    Yields
+    ------
+    pathlib.Path
+        Path to the directory containing the window's Parquet files.
+    """
+    cache_dir = get_cache_dir()
+    key = get_window_key(start_date, end_date, database)
+    window_dir = Path(cache_dir, key)
+
+    with lock_window(cache_dir, key, exclusive=True):
+        if window_dir.exists():
+            if verbose:
+                print(f"Using cached dataset window {window_dir}")
+        else:
+            if verbose:
+                print(f"Extracting dataset window to {window_dir}...")
+            tmp_dir = tempfile.mkdtemp(dir=cache_dir, prefix=f".tmp-{key}-")
+            try:
+                extract_window(tmp_dir, start_date, end_date, database)
+                os.replace(tmp_dir, window_dir)
+            except BaseException:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                raise
+        Path(window_dir, LAST_USED_FILE).touch()
+
+    with lock_window(cache_dir, key, exclusive=False):
+        # window_dir may have been evicted between releasing the exclusive lock and
+        # taking the shared lock
+        if not window_dir.exists():
+            raise FileNotFoundError(f"{window_dir} was evicted before it could be used")
+        yield window_dir
+
+    # only reached if the run succeeded, so after a failure the cache is left as it is
+    # for a retry
+    evicted = evict_windows(cache_dir, keep=key)
+    if verbose and evicted:
+        print(f"Evicted dataset windows from cache: {evicted}")
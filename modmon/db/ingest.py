@@ -0,0 +1,352 @@
+"""
+Functions for loading large numbers of rows into the ModMon database in parallel, via
+a staging table that is published to the target table in a single statement.
+"""
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import chain, islice
+import time
+import uuid
+
+from sqlalchemy import Column, MetaData, Table, func, select
+from sqlalchemy.exc import DBAPIError
+
+from ..config import config
+
+
+def get_ingest_config(ingest_config=None):
+    """Get the parallel ingestion settings from the config file.
+
+    Parameters
+    ----------
+    ingest_config : configparser.SectionProxy, optional
+        configparser section optionally containing the keys 'workers', 'chunksize' and
+        'retries', by default None which uses modmon.config.config["ingest"] if it
+        exists.
+
+    Returns
+    -------
+    int, int, int
+        Number of connections to load chunks with in parallel, the number of rows per
+        chunk, and the number of times to retry a failed chunk.
+    """
+    if ingest_config is None:
+        ingest_config = config["ingest"] if "ingest" in config else {}
+    n_workers = int(ingest_config.get("workers", 4))
+    chunk_size = int(ingest_config.get("chunksize", 10000))
+    retries = int(ingest_config.get("retries", 3))
+    return n_workers, chunk_size, retries
+
+
+def create_staging_table(engine, table):
+    """Create an empty staging table with the same columns as table, but without any
+    keys or constraints so rows can be loaded into it quickly and in any order. On
+    PostgreSQL the staging table is UNLOGGED, as its contents don't need to survive a
+    crash.
+
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.Engine
+        Engine connected to the ModMon database
+    table : sqlalchemy.Table
+        Table the rows will be published to, e.g. Prediction.__table__
+
+    Returns
+    -------
+    sqlalchemy.Table
+        The created staging table
+    """
+    prefixes = ["UNLOGGED"] if engine.dialect.name == "postgresql" else []
+    staging = Table(
+        f"{table.name}_staging_{uuid.uuid4().hex[:12]}",
+        MetaData(),
+        *[Column(column.name, column.type) for column in table.columns],
+        prefixes=prefixes,
+    )
+    staging.create(engine)
+    return staging
+
+
+def load_chunk(engine, staging, rows, retries=3):
+    """Insert a chunk of rows into a staging table in its own transaction, retrying
+    with exponential backoff if it fails.
+
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.Engine
+        Engine connected to the ModMon database
+    staging : sqlalchemy.Table
+        Staging table (see create_staging_table)
+    rows : list
+        List of dicts of {column_name: value}
+    retries : int, optional
+        Number of times to retry the chunk, by default 3
+
+    Returns
+    -------
+    int
+        Number of rows inserted
+
+    Raises
+    ------
+    sqlalchemy.exc.DBAPIError
+        If the chunk still fails after all retries
+    """
+    for attempt in range(retries + 1):
+        try:
+            with engine.begin() as conn:
+                conn.execute(staging.insert(), rows)
+            return len(rows)
+        except DBAPIError as e:
+            # the chunk's transaction was rolled back, so it's safe to retry
+            if attempt == retries:
+                raise
+            wait = 2 ** attempt
+            print(f"Loading chunk failed ({e.orig}), retrying in {wait}s...")
+            time.sleep(wait)
+
+
+def iter_chunks(rows, chunk_size=10000):
+    """Split rows into lists of chunk_size rows, reading only one chunk of rows at a
+    time so a generator of rows is never fully loaded into memory.
+
+    Parameters
+    ----------
+    rows : iterable
+        Dicts of {column_name: value}, e.g. a list or a generator
+    chunk_size : int, optional
+        Number of rows per chunk, by default 10000
+
+    Yields
+    ------
+    list
+        Chunk of up to chunk_size dicts of {column_name: value}
+    """
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, max(1, chunk_size)))
+        if not chunk:
+            return
+        yield chunk
+
+
+def load_staging_table(engine, staging, rows, n_workers=4, chunk_size=10000, retries=3):
+    """Split rows into chunks and load them into a staging table over several database
+    connections in parallel. At most two chunks per connection are read from rows at
+    a time, so peak memory doesn't grow with the number of rows.
+
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.Engine
+        Engine connected to the ModMon database
+    staging : sqlalchemy.Table
+        Staging table (see create_staging_table)
+    rows : iterable
+        Dicts of {column_name: value}, e.g. a list or a generator
+    n_workers : int, optional
+        Number of chunks to load in parallel, by default 4
+    chunk_size : int, optional
+        Number of rows per chunk, by default 10000
+    retries : int, optional
+        Number of times to retry each chunk, by default 3
+
+    Returns
+    -------
+    int
+        Number of rows loaded
+    """
+    n_workers = max(1, n_workers)
+    n_loaded = 0
+    pending = set()
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        for chunk in iter_chunks(rows, chunk_size):
+            if len(pending) >= 2 * n_workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                n_loaded += sum(future.result() for future in done)
+            pending.add(executor.submit(load_chunk, engine, staging, chunk, retries))
+        n_loaded += sum(future.result() for future in pending)
+    return n_loaded
+
+
+def count_rows(conn, table):
+    """Count the rows in a table.
+
+    Parameters
+    ----------
+    conn : sqlalchemy.engine.Connection or sqlalchemy.engine.Engine
+        Connection to the ModMon database
+    table : sqlalchemy.Table
+        Table to count
+
+    Returns
+    -------
+    int
+        Number of rows in table
+    """
+    return conn.execute(select([func.count()]).select_from(table)).scalar()
+
+
+def publish_staging_table(conn, staging, table):
+    """Copy all rows from a staging table into the target table in one statement.
+
+    Parameters
+    ----------
+    conn : sqlalchemy.engine.Connection
+        Connection to the ModMon database, in the transaction the rows should be
+        published in
+    staging : sqlalchemy.Table
+        Staging table (see create_staging_table)
+    table : sqlalchemy.Table
+        Table to publish the rows to
+
+    Returns
+    -------
+    int
+        Number of rows published
+    """
+    columns = [column.name for column in table.columns]
+    result = conn.execute(
+        table.insert().from_select(columns, select([staging.c[c] for c in columns]))
+    )
+    return result.rowcount
+
+
+def bulk_insert(
+    engine,
+    table,
+    rows,
+    session=None,
+    n_workers=None,
+    chunk_size=None,
+    retries=None,
+    verbose=True,
+):
+    """Insert rows into a table by loading them into a staging table in parallel, then
+    publishing them to the table in a single statement, so either all or none of the
+    rows are added.
+
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.Engine
+        Engine connected to the ModMon database
+    table : sqlalchemy.Table
+        Table to insert the rows into, e.g. Prediction.__table__
+    rows : iterable
+        Dicts of {column_name: value}, e.g. a list or a generator. Rows are read one
+        chunk at a time (see load_staging_table), so generating them lazily avoids
+        holding them all in memory.
+    session : sqlalchemy.orm.session.Session, optional
+        If given the rows are published in the session's current transaction (so they
+        are only visible once the session is committed, and can refer to objects added
+        earlier in the transaction). Otherwise they're published and committed in a
+        new transaction. By default None.
+    n_workers : int, optional
+        Number of connections to load chunks with in parallel, by default None which
+        uses the value in modmon.config.config["ingest"] (see get_ingest_config)
+    chunk_size : int, optional
+        Number of rows per chunk, by default None which uses the config value
+    retries : int, optional
+        Number of times to retry a failed chunk, by default None which uses the config
+        value
+    verbose : bool, optional
+        If True print the load and publish rates, by default True
+
+    Returns
+    -------
+    int
+        Number of rows inserted
+
+    Raises
+    ------
+    ValueError
+        If the number of rows staged or published doesn't match the number of rows
+        loaded (nothing is published to table in this case)
+    """
+    default_workers, default_chunk_size, default_retries = get_ingest_config()
+    n_workers = default_workers if n_workers is None else n_workers
+    chunk_size = default_chunk_size if chunk_size is None else chunk_size
+    retries = default_retries if retries is None else retries
+
+    rows = iter(rows)
+    first_row = next(rows, None)
+    if first_row is None:
+        return 0
+    rows = chain([first_row], rows)
+    if session is not None:
+        # write pending objects the rows may refer to
+        session.flush()
+
+    if engine.dialect.name == "sqlite":
+        # SQLite only allows one writer at a time, so other connections can't load a
+        # staging table while the session's transaction is open. Insert directly
+        # instead.
+        conn = session.connection() if session is not None else engine
+        n_inserted = 0
+        for chunk in iter_chunks(rows, chunk_size):
+            conn.execute(table.insert(), chunk)
+            n_inserted += len(chunk)
+        return n_inserted
+
+    staging = create_staging_table(engine, table)
+    try:
+        start = time.perf_counter()
+        n_loaded = load_staging_table(
+            engine, staging, rows, n_workers, chunk_size, retries
+        )
+        load_time = time.perf_counter() - start
+
+        n_staged = count_rows(engine, staging)
+        if n_staged != n_loaded:
+            raise ValueError(
+                f"Expected {n_loaded} rows in staging table but found {n_staged}"
+            )
+
+        start = time.perf_counter()
+        if session is None:
+            with engine.begin() as conn:
+                n_published = publish_staging_table(conn, staging, table)
+                check_published(n_published, n_loaded)
+        else:
+            # publishing locks the staging table until the end of the transaction, so
+            # do it in a savepoint which releases the lock if it fails (otherwise the
+            # table couldn't be dropped below)
+            with session.begin_nested():
+                conn = session.connection()
+                n_published = publish_staging_table(conn, staging, table)
+                check_published(n_published, n_loaded)
+                staging.drop(conn)
+                staging = None
+        publish_time = time.perf_counter() - start
+    finally:
+        if staging is not None:
+            staging.drop(engine)
+
+    if verbose:
+        print(
+            f"Loaded {n_loaded} rows into {table.name} with {n_workers} connections: "
+            f"staging {n_loaded / max(load_time, 1e-9):.0f} rows/s, "
+            f"publish {n_published / max(publish_time, 1e-9):.0f} rows/s"
+        )
+    return n_published
+
+
+def check_published(n_published, n_expected):
+    """Check the number of rows published from a staging table matches the number of
+    rows loaded.
+
+    Parameters
+    ----------
+    n_published : int
+        Number of rows published, or -1 if not known (as reported by some database
+        drivers)
+    n_expected : int
+        Number of rows loaded into the staging table
+
+    Raises
+    ------
+    ValueError
+        If n_published is known and doesn't equal n_expected
+    """
+    if n_published >= 0 and n_published != n_expected:
+        raise ValueError(
+            f"Expected to publish {n_expected} rows but published {n_published}"
+        )
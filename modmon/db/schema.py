@@ -3,6 +3,7 @@ Classes defining the ModMon database schema in the SQLAlchemy ORM
 """
 # coding: utf-8
 from sqlalchemy import (
+    BigInteger,
     Boolean,
     Column,
     DateTime,
@@ -136,7 +137,9 @@ class Prediction(Base):
     datasetid = Column(
         ForeignKey("dataset.datasetid"), primary_key=True, nullable=False
     )
-    runid = Column(Integer, primary_key=True, nullable=False)
+    # indexed so the predictions of a run (e.g. for drift, sketches and label metrics)
+    # can be read without scanning the whole table
+    runid = Column(Integer, primary_key=True, nullable=False, index=True)
     recordid = Column(String(50), primary_key=True, nullable=False)
 
     runtime = Column(DateTime, nullable=False)
@@ -166,10 +169,358 @@ class Score(Base):
     )
     runid = Column(Integer, primary_key=True, nullable=False)
     metric = Column(ForeignKey("metric.metric"), primary_key=True, nullable=False)
+    # subgroup of the dataset the value is for (see SliceDefinition), with the format
+    # <slice name>=<value>, or an empty string for the whole dataset. Part of the
+    # primary key, see docs/run_models.md for adding it to an existing database.
+    slice = Column(
+        String(100), primary_key=True, nullable=False, default="", server_default=""
+    )
 
     isreference = Column(Boolean, nullable=False)
     runtime = Column(DateTime, nullable=False)
     value = Column(Float(53), nullable=False)
+    # bootstrap confidence interval of the value, and p-value of the difference from
+    # the value on the reference run (see modmon.metrics.bootstrap), if calculated
+    valuelower = Column(Float(53))
+    valueupper = Column(Float(53))
+    pvalue = Column(Float(53))
+
+    metric1 = relationship("Metric")
+    modelversion1 = relationship("ModelVersion")
+    dataset = relationship("Dataset")
+
+
+class RunSketch(Base):
+    """Each row in the RunSketch table summarises the distribution of one output of a
+    prediction run (or of one part of it, e.g. a shard), so runs can be compared
+    without reading all their predictions (see modmon.metrics.sketch).
+    """
+
+    __tablename__ = "run_sketch"
+    __table_args__ = (
+        ForeignKeyConstraint(
+            ["modelid", "modelversion"],
+            ["model_version.modelid", "model_version.modelversion"],
+        ),
+    )
+
+    modelid = Column(Integer, primary_key=True, nullable=False)
+    modelversion = Column(String(10), primary_key=True, nullable=False)
+    datasetid = Column(
+        ForeignKey("dataset.datasetid"), primary_key=True, nullable=False
+    )
+    runid = Column(Integer, primary_key=True, nullable=False)
+    output = Column(String(50), primary_key=True, nullable=False)
+    part = Column(String(50), primary_key=True, nullable=False)
+
+    count = Column(BigInteger, nullable=False)
+    missing = Column(BigInteger, nullable=False)
+    mean = Column(Float(53), nullable=False)
+    variance = Column(Float(53), nullable=False)
+    min = Column(Float(53), nullable=False)
+    max = Column(Float(53), nullable=False)
+    histogram = Column(JSON, nullable=False)
+    digest = Column(JSON, nullable=False)
+
+    modelversion1 = relationship("ModelVersion")
+    dataset = relationship("Dataset")
+
+
+class PredictionRollup(Base):
+    """Each row in the PredictionRollup table is a small summary of one output of a
+    prediction run (or of one part of it, e.g. a shard), keyed by the start of the
+    dataset window, so trends in predictions over time can be queried without reading
+    the prediction table (see modmon.metrics.rollup and modmon.query).
+    """
+
+    __tablename__ = "prediction_rollup"
+    __table_args__ = (
+        ForeignKeyConstraint(
+            ["modelid", "modelversion"],
+            ["model_version.modelid", "model_version.modelversion"],
+        ),
+    )
+
+    # primary key ordered so rollups of a model version's output in a time range are
+    # an index range scan
+    modelid = Column(Integer, primary_key=True, nullable=False)
+    modelversion = Column(String(10), primary_key=True, nullable=False)
+    output = Column(String(50), primary_key=True, nullable=False)
+    periodstart = Column(DateTime, primary_key=True, nullable=False)
+    datasetid = Column(
+        ForeignKey("dataset.datasetid"), primary_key=True, nullable=False
+    )
+    runid = Column(Integer, primary_key=True, nullable=False)
+    part = Column(String(50), primary_key=True, nullable=False)
+
+    count = Column(BigInteger, nullable=False)
+    missing = Column(BigInteger, nullable=False)
+    sum = Column(Float(53), nullable=False)
+    sumsq = Column(Float(53), nullable=False)
+    min = Column(Float(53), nullable=False)
+    max = Column(Float(53), nullable=False)
+    histogram = Column(JSON, nullable=False)
+
+    modelversion1 = relationship("ModelVersion")
+    dataset = relationship("Dataset")
+
+
+class Label(Base):
+    """Each row in the Label table is the true value of the outputs for one record in a
+    dataset (e.g. an outcome that was only known after the predictions were made),
+    with the same record IDs and output names as the prediction table.
+    """
+
+    __tablename__ = "label"
+
+    datasetid = Column(
+        ForeignKey("dataset.datasetid"), primary_key=True, nullable=False
+    )
+    recordid = Column(String(50), primary_key=True, nullable=False)
+
+    loadtime = Column(DateTime, nullable=False)
+    values = Column(JSON, nullable=False)
+
+    dataset = relationship("Dataset")
+
+
+class LabelEvaluation(Base):
+    """Each row in the LabelEvaluation table records when a prediction run was last
+    scored against the labels of its dataset (see modmon.metrics.evaluate).
+    """
+
+    __tablename__ = "label_evaluation"
+    __table_args__ = (
+        ForeignKeyConstraint(
+            ["modelid", "modelversion"],
+            ["model_version.modelid", "model_version.modelversion"],
+        ),
+    )
+
+    modelid = Column(Integer, primary_key=True, nullable=False)
+    modelversion = Column(String(10), primary_key=True, nullable=False)
+    datasetid = Column(
+        ForeignKey("dataset.datasetid"), primary_key=True, nullable=False
+    )
+    runid = Column(Integer, primary_key=True, nullable=False)
+
+    evaluatedtime = Column(DateTime, nullable=False)
+    nlabels = Column(BigInteger, nullable=False)
+    # time bootstrap confidence intervals were last calculated for the run's scores
+    bootstraptime = Column(DateTime)
+
+    modelversion1 = relationship("ModelVersion")
+    dataset = relationship("Dataset")
+
+
+class SliceDefinition(Base):
+    """Each row in the SliceDefinition table defines a way of splitting the records in
+    a dataset into subgroups (slices) for a research question, e.g. by age band or
+    region, so metrics can be calculated for each slice.
+    """
+
+    __tablename__ = "slice_definition"
+
+    questionid = Column(
+        ForeignKey("research_question.questionid"), primary_key=True, nullable=False
+    )
+    name = Column(String(50), primary_key=True, nullable=False)
+
+    # name of the label (or prediction) value to slice by
+    column = Column(String(50), nullable=False)
+    # edges of the bins to group numeric values into, or null to use each distinct
+    # value as a slice
+    bins = Column(JSON)
+    description = Column(String(500))
+
+    research_question = relationship("ResearchQuestion")
+
+
+class AlertRule(Base):
+    """Each row in the AlertRule table is a rule that new scores are checked against
+    when they're added to the database (see modmon.metrics.alerts), either a threshold
+    on the value of a metric or a relative change from the model version's reference
+    score.
+    """
+
+    __tablename__ = "alert_rule"
+
+    ruleid = Column(Integer, primary_key=True)
+
+    # metric name the rule applies to, may include shell-style wildcards (e.g.
+    # modmon.psi.*)
+    metric = Column(String(50), nullable=False)
+    # model the rule applies to, or null for all models
+    modelid = Column(ForeignKey("model.modelid"))
+    # min, max, decrease or increase (see modmon.metrics.alerts.RULE_KINDS)
+    kind = Column(String(10), nullable=False)
+    threshold = Column(Float(53), nullable=False)
+    description = Column(String(500))
+
+    model = relationship("Model")
+
+
+class Alert(Base):
+    """Each row in the Alert table is a new score that broke an alert rule."""
+
+    __tablename__ = "alert"
+    __table_args__ = (
+        ForeignKeyConstraint(
+            ["modelid", "modelversion"],
+            ["model_version.modelid", "model_version.modelversion"],
+        ),
+    )
+
+    alertid = Column(Integer, primary_key=True)
+
+    ruleid = Column(ForeignKey("alert_rule.ruleid"), nullable=False)
+    modelid = Column(Integer, nullable=False)
+    modelversion = Column(String(10), nullable=False)
+    datasetid = Column(ForeignKey("dataset.datasetid"), nullable=False)
+    # run ID of the score that broke the rule
+    runid = Column(Integer, nullable=False)
+    metric = Column(String(50), nullable=False)
+    value = Column(Float(53), nullable=False)
+    # reference score the value was compared to, for relative change rules
+    baseline = Column(Float(53))
+    alerttime = Column(DateTime, nullable=False)
+    message = Column(String(500), nullable=False)
+
+    alert_rule = relationship("AlertRule")
+    modelversion1 = relationship("ModelVersion")
+    dataset = relationship("Dataset")
+
+
+class AnomalyState(Base):
+    """Each row in the AnomalyState table is the state of the anomaly detectors for the
+    scores of one metric of a model version (see modmon.metrics.anomaly), so new scores
+    can be checked without reading the metric's history.
+    """
+
+    __tablename__ = "anomaly_state"
+    __table_args__ = (
+        ForeignKeyConstraint(
+            ["modelid", "modelversion"],
+            ["model_version.modelid", "model_version.modelversion"],
+        ),
+    )
+
+    modelid = Column(Integer, primary_key=True, nullable=False)
+    modelversion = Column(String(10), primary_key=True, nullable=False)
+    metric = Column(ForeignKey("metric.metric"), primary_key=True, nullable=False)
+
+    # run ID of the most recent score (by run time) included in the state
+    lastrunid = Column(Integer, nullable=False)
+    # number of scores included in the state
+    count = Column(BigInteger, nullable=False)
+    # exponentially weighted mean and variance of the scores
+    ewmamean = Column(Float(53))
+    ewmavariance = Column(Float(53))
+    # one-sided cumulative sums of standardised deviations above and below the mean
+    cusumhigh = Column(Float(53), nullable=False)
+    cusumlow = Column(Float(53), nullable=False)
+    # most recent scores, oldest first, for the rolling median
+    window = Column(JSON, nullable=False)
+
+    metric1 = relationship("Metric")
+    modelversion1 = relationship("ModelVersion")
+
+
+class AnomalyCheck(Base):
+    """Each row in the AnomalyCheck table is a dataset whose score for a metric of a
+    model version has been included in the state of the anomaly detectors (see
+    modmon.metrics.anomaly), so each dataset is only added to a series once, even if
+    it's scored again.
+    """
+
+    __tablename__ = "anomaly_check"
+    __table_args__ = (
+        ForeignKeyConstraint(
+            ["modelid", "modelversion"],
+            ["model_version.modelid", "model_version.modelversion"],
+        ),
+    )
+
+    modelid = Column(Integer, primary_key=True, nullable=False)
+    modelversion = Column(String(10), primary_key=True, nullable=False)
+    metric = Column(ForeignKey("metric.metric"), primary_key=True, nullable=False)
+    datasetid = Column(
+        ForeignKey("dataset.datasetid"), primary_key=True, nullable=False
+    )
+
+    # run ID of the score that was checked
+    runid = Column(Integer, nullable=False)
+
+    metric1 = relationship("Metric")
+    modelversion1 = relationship("ModelVersion")
+    dataset = relationship("Dataset")
+
+
+class Anomaly(Base):
+    """Each row in the Anomaly table is a score flagged as anomalous by one of the
+    anomaly detectors, compared to the previous scores of the same metric and model
+    version.
+    """
+
+    __tablename__ = "anomaly"
+    __table_args__ = (
+        ForeignKeyConstraint(
+            ["modelid", "modelversion"],
+            ["model_version.modelid", "model_version.modelversion"],
+        ),
+    )
+
+    modelid = Column(Integer, primary_key=True, nullable=False)
+    modelversion = Column(String(10), primary_key=True, nullable=False)
+    runid = Column(Integer, primary_key=True, nullable=False)
+    metric = Column(ForeignKey("metric.metric"), primary_key=True, nullable=False)
+    # robust_z, ewma or cusum (see modmon.metrics.anomaly.DETECTORS)
+    detector = Column(String(20), primary_key=True, nullable=False)
+
+    datasetid = Column(ForeignKey("dataset.datasetid"), nullable=False)
+    value = Column(Float(53), nullable=False)
+    # value of the detector's statistic, e.g. the z-score
+    statistic = Column(Float(53), nullable=False)
+    detectedtime = Column(DateTime, nullable=False)
+
+    metric1 = relationship("Metric")
+    modelversion1 = relationship("ModelVersion")
+    dataset = relationship("Dataset")
+
+
+class LatestScore(Base):
+    """Each row in the LatestScore table summarises the scores of one metric of a model
+    version: its most recent value, its reference value and the difference between
+    them. Maintained as scores are added (see modmon.db.summary), so current values can
+    be looked up without scanning the score table.
+    """
+
+    __tablename__ = "latest_score"
+    __table_args__ = (
+        ForeignKeyConstraint(
+            ["modelid", "modelversion"],
+            ["model_version.modelid", "model_version.modelversion"],
+        ),
+    )
+
+    modelid = Column(Integer, primary_key=True, nullable=False)
+    modelversion = Column(String(10), primary_key=True, nullable=False)
+    metric = Column(ForeignKey("metric.metric"), primary_key=True, nullable=False)
+    slice = Column(
+        String(100), primary_key=True, nullable=False, default="", server_default=""
+    )
+
+    # most recent (non-reference) score, null if the model version has only been run
+    # on its reference dataset
+    datasetid = Column(ForeignKey("dataset.datasetid"))
+    runid = Column(Integer)
+    runtime = Column(DateTime)
+    value = Column(Float(53))
+    # reference score saved when the model version was added
+    referencevalue = Column(Float(53))
+    # value - referencevalue
+    delta = Column(Float(53))
+    updatedtime = Column(DateTime, nullable=False)
 
     metric1 = relationship("Metric")
     modelversion1 = relationship("ModelVersion")
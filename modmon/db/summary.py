@@ -0,0 +1,195 @@
+"""
+Functions to maintain the latest_score table, a summary of the most recent and
+reference value of each metric of each model version. The summary is updated in the
+same transaction as scores are added, so dashboards can look up current values by
+primary key rather than scanning the score table. It can be rebuilt from the score
+table with modmon_summary_rebuild, e.g. after deleting scores.
+"""
+import argparse
+from datetime import datetime
+import math
+
+import pandas as pd
+from sqlalchemy import select
+
+from .connect import get_session
+from .ingest import bulk_insert
+from .schema import LatestScore, Score
+
+
+def to_datetime(value):
+    """Convert a time (e.g. an ISO format string, as used for run times) to a
+    datetime.datetime.
+    """
+    if value is None or isinstance(value, datetime):
+        return value
+    return pd.Timestamp(value).to_pydatetime()
+
+
+def get_delta(value, reference_value):
+    """Difference between a value and its reference value, or None if either is
+    missing.
+    """
+    if value is None or reference_value is None:
+        return None
+    return value - reference_value
+
+
+def update_latest_scores(
+    session, model_version, dataset_id, run_id, run_time, values, is_reference=False
+):
+    """Update the latest_score summary with new scores of a model version. The session
+    is not committed.
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session
+        ModMon database session
+    model_version : modmon.schema.db.ModelVersion
+        Model version object
+    dataset_id : int
+        ID of the dataset the scores are for
+    run_id : int
+        Run ID of the scores
+    run_time : str or datetime.datetime
+        Time of the run
+    values : dict
+        {(metric_name, slice_label): value} of the new scores (slice_label is an empty
+        string for scores for the whole dataset)
+    is_reference : bool, optional
+        If True the scores are the model version's reference scores, by default False
+    """
+    run_time = to_datetime(run_time)
+    updated_time = datetime.now()
+    new_values = {}
+    for key, value in values.items():
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            continue
+        if not math.isnan(value):
+            new_values[key] = value
+    if not new_values:
+        return
+
+    summaries = {
+        (summary.metric, summary.slice): summary
+        for summary in session.query(LatestScore).filter(
+            LatestScore.modelid == model_version.modelid,
+            LatestScore.modelversion == model_version.modelversion,
+            LatestScore.metric.in_({metric for metric, _ in new_values}),
+        )
+    }
+    for (metric, slice_label), value in new_values.items():
+        summary = summaries.get((metric, slice_label))
+        if summary is None:
+            summary = LatestScore(
+                modelid=model_version.modelid,
+                modelversion=model_version.modelversion,
+                metric=metric,
+                slice=slice_label,
+            )
+            session.add(summary)
+        if is_reference:
+            summary.referencevalue = value
+        elif summary.runtime is None or (run_time, run_id) >= (
+            summary.runtime,
+            summary.runid,
+        ):
+            summary.datasetid = dataset_id
+            summary.runid = run_id
+            summary.runtime = run_time
+            summary.value = value
+        summary.delta = get_delta(summary.value, summary.referencevalue)
+        summary.updatedtime = updated_time
+
+
+def rebuild_latest_scores(session=None, verbose=True):
+    """Rebuild the latest_score summary from all scores in the score table.
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session, optional
+        ModMon database session or None in which case one will be created, by default
+        None
+    verbose : bool, optional
+        If True print additional progress messages, by default True
+
+    Returns
+    -------
+    int
+        Number of rows in the rebuilt summary
+    """
+    if not session:
+        session = get_session()
+        close_session = True  # if session is created in function, close it in function
+    else:
+        close_session = False  # if session given, leave it open
+
+    scores = Score.__table__
+    columns = [
+        "modelid",
+        "modelversion",
+        "metric",
+        "slice",
+        "datasetid",
+        "runid",
+        "runtime",
+        "value",
+        "isreference",
+    ]
+    scores = pd.DataFrame(
+        session.execute(select([scores.c[column] for column in columns])).fetchall(),
+        columns=columns,
+    )
+    key = ["modelid", "modelversion", "metric", "slice"]
+    scores = scores.dropna(subset=["value"]).sort_values(["runtime", "runid"])
+    latest = (
+        scores[~scores["isreference"].astype(bool)]
+        .drop_duplicates(key, keep="last")
+        .drop(columns="isreference")
+    )
+    reference = (
+        scores[scores["isreference"].astype(bool)]
+        .drop_duplicates(key, keep="last")[key + ["value"]]
+        .rename(columns={"value": "referencevalue"})
+    )
+    summary = latest.merge(reference, on=key, how="outer")
+    summary["delta"] = summary["value"] - summary["referencevalue"]
+    summary["updatedtime"] = datetime.now()
+    # native Python values, with None for missing values
+    summary = summary.astype(object).where(summary.notna(), None)
+    rows = summary.to_dict(orient="records")
+    for row in rows:
+        for column in ["modelid", "datasetid", "runid"]:
+            if row[column] is not None:
+                row[column] = int(row[column])
+        row["runtime"] = to_datetime(row["runtime"])
+
+    session.query(LatestScore).delete(synchronize_session=False)
+    bulk_insert(
+        session.bind, LatestScore.__table__, rows, session=session, verbose=False
+    )
+    session.commit()
+    if verbose:
+        print(f"Rebuilt latest_score with {len(rows)} rows")
+
+    if close_session:
+        session.close()
+    return len(rows)
+
+
+def main():
+    """Rebuild the latest_score summary table.
+
+    Available from the command-line as modmon_summary_rebuild
+    """
+    parser = argparse.ArgumentParser(
+        description=(
+            "Rebuild the summary of the latest and reference value of each metric of "
+            "each model version from the score table"
+        )
+    )
+    parser.parse_args()
+
+    rebuild_latest_scores()
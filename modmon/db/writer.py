@@ -0,0 +1,209 @@
+"""
+Write-behind writer that saves results from many concurrent model runs to the ModMon
+database in batches, from a single session.
+"""
+from concurrent.futures import Future
+import queue
+import threading
+import time
+
+from ..config import config
+from .connect import get_session
+from .utils import get_unique_id
+
+# Put on the queue to tell the writer thread to stop
+_STOP = object()
+
+
+def get_writer_config(ingest_config=None):
+    """Get the result writer settings from the config file.
+
+    Parameters
+    ----------
+    ingest_config : configparser.SectionProxy, optional
+        configparser section optionally containing the keys 'batchsize', 'batchdelay'
+        and 'queuesize', by default None which uses modmon.config.config["ingest"] if
+        it exists.
+
+    Returns
+    -------
+    int, float, int
+        Maximum number of runs to commit in one transaction, maximum seconds to wait
+        for a batch to fill, and the maximum number of runs waiting to be written.
+    """
+    if ingest_config is None:
+        ingest_config = config["ingest"] if "ingest" in config else {}
+    batch_size = int(ingest_config.get("batchsize", 20))
+    batch_delay = float(ingest_config.get("batchdelay", 2))
+    queue_size = int(ingest_config.get("queuesize", 100))
+    return batch_size, batch_delay, queue_size
+
+
+class ResultWriter:
+    """Thread that saves the results of model runs to the database. Runs (e.g. in
+    parallel worker threads) submit functions that add their results to a session, and
+    the writer calls them in batches, committing each batch in one transaction and
+    assigning each run a unique run ID. Submitting blocks while the queue is full, so
+    runs can't get too far ahead of the database.
+    """
+
+    def __init__(
+        self,
+        results_table,
+        batch_size=None,
+        batch_delay=None,
+        queue_size=None,
+        session_factory=None,
+        verbose=True,
+    ):
+        """Initialise an instance of ResultWriter and start its thread.
+
+        Parameters
+        ----------
+        results_table : class
+            Table the results are saved to from modmon.db.schema, used to assign run
+            IDs
+        batch_size : int, optional
+            Maximum number of runs to commit in one transaction, by default None which
+            uses the value in modmon.config.config["ingest"] (see get_writer_config)
+        batch_delay : float, optional
+            Maximum seconds to wait for more runs before committing a batch, by default
+            None which uses the config value
+        queue_size : int, optional
+            Maximum number of runs waiting to be written before submit blocks, by
+            default None which uses the config value
+        session_factory : function, optional
+            Function returning a new ModMon database session, by default None which
+            uses modmon.db.connect.get_session
+        verbose : bool, optional
+            If True print a message after each batch is committed, by default True
+        """
+        default_size, default_delay, default_queue_size = get_writer_config()
+        self.results_table = results_table
+        self.batch_size = default_size if batch_size is None else batch_size
+        self.batch_delay = default_delay if batch_delay is None else batch_delay
+        self.session_factory = (
+            get_session if session_factory is None else session_factory
+        )
+        self.verbose = verbose
+
+        queue_size = default_queue_size if queue_size is None else queue_size
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.n_written = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, write):
+        """Queue the results of a run to be written to the database, blocking if the
+        queue is full.
+
+        Parameters
+        ----------
+        write : function
+            Function that adds a run's results to the database, taking arguments
+            session and run_id. It must not commit the session.
+
+        Returns
+        -------
+        concurrent.futures.Future
+            Future whose result is the run ID once the run has been committed, or that
+            raises the exception raised by write.
+        """
+        if not self.thread.is_alive():
+            raise RuntimeError("ResultWriter has been closed")
+        future = Future()
+        self.queue.put((write, future))
+        return future
+
+    def _next_batch(self):
+        """Wait for the next batch of runs to write.
+
+        Returns
+        -------
+        list, bool
+            List of (write, future) tuples, and whether the writer has been told to
+            stop.
+        """
+        item = self.queue.get()
+        if item is _STOP:
+            return [], True
+
+        batch = [item]
+        deadline = time.monotonic() + self.batch_delay
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is _STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _write(self, session, batch):
+        """Write a batch of runs in one transaction.
+
+        Parameters
+        ----------
+        session : sqlalchemy.orm.session.Session
+            ModMon database session
+        batch : list
+            List of (write, future) tuples
+
+        Returns
+        -------
+        list
+            Run ID assigned to each run in the batch
+        """
+        # run IDs are only assigned here, so one query gives IDs for the whole batch
+        first_id = get_unique_id(session, self.results_table.runid)
+        run_ids = [first_id + i for i in range(len(batch))]
+        for (write, _), run_id in zip(batch, run_ids):
+            write(session, run_id)
+        session.commit()
+        return run_ids
+
+    def _run(self):
+        """Write batches from the queue until told to stop."""
+        session = self.session_factory()
+        try:
+            stop = False
+            while not stop:
+                batch, stop = self._next_batch()
+                if len(batch) == 0:
+                    continue
+                try:
+                    run_ids = self._write(session, batch)
+                    for (_, future), run_id in zip(batch, run_ids):
+                        future.set_result(run_id)
+                except Exception:
+                    # retry runs one at a time so one bad run doesn't lose the others
+                    session.rollback()
+                    run_ids = []
+                    for item in batch:
+                        try:
+                            run_ids += self._write(session, [item])
+                            item[1].set_result(run_ids[-1])
+                        except Exception as e:
+                            session.rollback()
+                            item[1].set_exception(e)
+                self.n_written += len(run_ids)
+                if self.verbose and run_ids:
+                    print(f"Saved {len(run_ids)} runs to the database")
+        finally:
+            session.close()
+
+    def close(self):
+        """Write all queued runs and stop the writer thread."""
+        if self.thread.is_alive():
+            self.queue.put(_STOP)
+            self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
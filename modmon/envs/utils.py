@@ -2,12 +2,17 @@
 General functions for managing and creating virtual environments.
 """
 import os
+import threading
 import warnings
 
 from .renv import create_renv_env
 from .conda import get_conda_activate_command, create_conda_env
 from ..utils.utils import build_model_identifier
 
+# {environment: lock} so environments are only created by one thread at a time
+ENV_LOCKS = {}
+ENV_LOCKS_LOCK = threading.Lock()
+
 
 def get_model_env_types(path):
     """Determine whether a model specifies a conda or renv environment. The presence of
@@ -39,6 +44,24 @@ def get_model_env_types(path):
     return {"conda": conda, "renv": renv}
 
 
+def get_env_lock(key):
+    """Get the lock that must be held while creating an environment, so model versions
+    run in parallel threads don't create (or update) the same environment at once.
+
+    Parameters
+    ----------
+    key : tuple
+        Identifies the environment, e.g. ("conda", env_name)
+
+    Returns
+    -------
+    threading.Lock
+        Lock for the environment
+    """
+    with ENV_LOCKS_LOCK:
+        return ENV_LOCKS.setdefault(key, threading.Lock())
+
+
 def create_env(model_path, model_id, model_version, capture_output=False):
     """Create all the environments defined in a model directory.
 
@@ -70,7 +93,9 @@ def create_env(model_path, model_id, model_version, capture_output=False):
         )
 
     if env_types["renv"]:
-        conda_env = create_renv_env(model_path, capture_output=capture_output)
+        # renv environments are set up in the model directory
+        with get_env_lock(("renv", os.path.realpath(model_path))):
+            conda_env = create_renv_env(model_path, capture_output=capture_output)
         # create_renv_env returns conda environment with appropriate R version
         #  (as well as setting up renv), if set in config
         if conda_env:
@@ -78,11 +103,12 @@ def create_env(model_path, model_id, model_version, capture_output=False):
 
     if env_types["conda"]:
         env_name = build_model_identifier(model_id, model_version)
-        create_conda_env(
-            env_name,
-            env_file=f"{model_path}/environment.yml",
-            capture_output=capture_output,
-        )
+        with get_env_lock(("conda", env_name)):
+            create_conda_env(
+                env_name,
+                env_file=f"{model_path}/environment.yml",
+                capture_output=capture_output,
+            )
         env_cmd = get_conda_activate_command(env_name)
 
     return env_cmd
@@ -0,0 +1,351 @@
+"""
+Functions and classes for calling Python model entry-points in a worker process
+running in the model's environment.
+"""
+import json
+from pathlib import Path
+import subprocess
+import threading
+import time
+
+import pandas as pd
+
+from ..config import config
+from ..utils.utils import build_model_identifier
+
+# Script run by the worker process (must only depend on the standard library)
+WORKER_SCRIPT = Path(Path(__file__).parent, "worker_main.py")
+
+
+class WorkerError(Exception):
+    """Raised when a model entry-point fails or a worker process exits unexpectedly."""
+
+
+def decode_result(result):
+    """Convert a result sent by a worker process back to a Python object.
+
+    Parameters
+    ----------
+    result : dict
+        Encoded result (see modmon.envs.worker_main.encode_result)
+
+    Returns
+    -------
+    pandas.DataFrame, pandas.Series, dict or list
+        The value returned by the entry-point
+    """
+    data = result["data"]
+    if result["type"] == "frame":
+        if "columns" in data:
+            return pd.DataFrame(
+                data["data"], index=data["index"], columns=data["columns"]
+            )
+        return pd.Series(data["data"], index=data["index"], name=data.get("name"))
+    return data
+
+
+class ModelWorker:
+    """Python process running in a model's environment, which calls model entry-points
+    and returns their results in memory. Only used for models with a Python
+    entry-point, as the model environment must include python.
+    """
+
+    def __init__(self, run_dir, env_cmd=None, verbose=True):
+        """Initialise an instance of ModelWorker. The process is started by the first
+        call to the worker (or by start).
+
+        Parameters
+        ----------
+        run_dir : str or Path
+            Path to the model directory, used as the working directory of the worker
+        env_cmd : str, optional
+            Command to activate the model environment, by default None
+        verbose : bool, optional
+            If True print additional progress messages, by default True
+        """
+        self.run_dir = run_dir
+        self.env_cmd = env_cmd
+        self.verbose = verbose
+        self.process = None
+        # number of requests served by the current process, and when it was last used
+        self.n_requests = 0
+        self.last_used = time.monotonic()
+        # held while the worker is handling a request or being stopped, so an idle
+        # worker isn't stopped by another thread (see WorkerPool.close_idle) mid-call
+        self.lock = threading.RLock()
+
+    def start(self):
+        """Start the worker process."""
+        worker_cmd = f'exec python -u "{WORKER_SCRIPT}"'
+        if self.env_cmd is not None:
+            worker_cmd = f"{self.env_cmd} && {worker_cmd}"
+        if self.verbose:
+            print(f"Starting worker in {self.run_dir} with command:\n{worker_cmd}")
+
+        self.process = subprocess.Popen(
+            worker_cmd,
+            cwd=self.run_dir,
+            shell=True,
+            executable="/bin/bash",
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+        )
+        self.n_requests = 0
+
+    def is_alive(self):
+        """Check whether the worker process is running.
+
+        Returns
+        -------
+        bool
+            True if the worker process has been started and has not exited.
+        """
+        return self.process is not None and self.process.poll() is None
+
+    def call(self, entrypoint, **kwargs):
+        """Call a model entry-point in the worker process.
+
+        Parameters
+        ----------
+        entrypoint : str
+            Entry-point in the format "module:function"
+        **kwargs
+            Keyword arguments to pass to the entry-point. Values must be JSON
+            serialisable.
+
+        Returns
+        -------
+        pandas.DataFrame, pandas.Series, dict or list
+            Value returned by the entry-point
+
+        Raises
+        ------
+        WorkerError
+            If the entry-point raised an exception or the worker process exited.
+        """
+        response = self.send({"entrypoint": entrypoint, "kwargs": kwargs})
+        if not response["ok"]:
+            raise WorkerError(f"{entrypoint} failed:\n{response['error']}")
+        return decode_result(response["result"])
+
+    def send(self, request):
+        """Send a request to the worker process (starting it if needed) and wait for the
+        response.
+
+        Parameters
+        ----------
+        request : dict
+            JSON serialisable request (see modmon.envs.worker_main.handle_request)
+
+        Returns
+        -------
+        dict
+            Response from the worker process
+
+        Raises
+        ------
+        WorkerError
+            If the worker process exited before responding.
+        """
+        with self.lock:
+            if not self.is_alive():
+                self.start()
+
+            try:
+                self.process.stdin.write(json.dumps(request) + "\n")
+                self.process.stdin.flush()
+                line = self.process.stdout.readline()
+            except BrokenPipeError:
+                line = ""
+            self.n_requests += 1
+            self.last_used = time.monotonic()
+
+            if not line:
+                self.close()
+                raise WorkerError(f"Worker process exited while handling {request}")
+            return json.loads(line)
+
+    def close(self, timeout=10):
+        """Stop the worker process.
+
+        Parameters
+        ----------
+        timeout : int, optional
+            Seconds to wait for the process to exit before killing it, by default 10
+        """
+        with self.lock:
+            if self.process is None:
+                return
+            try:
+                self.process.stdin.close()
+            except BrokenPipeError:
+                pass
+            try:
+                self.process.wait(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+            self.process.stdout.close()
+            self.process = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class WorkerPool:
+    """Pool of persistent workers, one per model version with a Python entry-point, for
+    calling the entry-point on many dataset windows without re-creating the model's
+    environment, restarting its worker process and re-importing its modules for each
+    one. Workers are stopped after being idle for idle_timeout seconds (checked by a
+    background thread while the pool has workers), and restarted after serving
+    max_requests requests.
+    """
+
+    def __init__(self, idle_timeout=None, max_requests=None, verbose=True):
+        """Initialise an instance of WorkerPool.
+
+        Parameters
+        ----------
+        idle_timeout : float, optional
+            Seconds a worker can be idle before it's stopped, by default None which uses
+            the value in modmon.config.config["workers"] or 300 if that's not present.
+        max_requests : int, optional
+            Number of requests after which a worker process is restarted, by default
+            None which uses the value in modmon.config.config["workers"] or 100 if
+            that's not present.
+        verbose : bool, optional
+            If True print additional progress messages, by default True
+        """
+        worker_config = config["workers"] if "workers" in config else {}
+        if idle_timeout is None:
+            idle_timeout = float(worker_config.get("idle_timeout", 300))
+        if max_requests is None:
+            max_requests = int(worker_config.get("max_requests", 100))
+
+        self.idle_timeout = idle_timeout
+        self.max_requests = max_requests
+        self.verbose = verbose
+        self.workers = {}
+        # protects self.workers, which is also used by the reaper thread
+        self.lock = threading.Lock()
+        self.reaper = None
+        self.stop_reaper = threading.Event()
+
+    def get_worker(self, model_version, run_dir, create_env, capture_output=False):
+        """Get the worker for a model version, creating it (and the model environment)
+        if it's not already running.
+
+        Parameters
+        ----------
+        model_version : modmon.schema.db.ModelVersion
+            Model version object
+        run_dir : str or Path
+            Path to the model directory
+        create_env : function
+            Function to create the model environment and return the command to
+            activate it (see modmon.envs.utils.create_env)
+        capture_output : bool, optional
+            Passed to create_env, by default False
+
+        Returns
+        -------
+        ModelWorker
+            Worker for the model version
+        """
+        self.close_idle()
+
+        key = (
+            build_model_identifier(model_version.modelid, model_version.modelversion),
+            str(run_dir),
+        )
+        with self.lock:
+            worker = self.workers.get(key)
+            if worker is not None and worker.n_requests >= self.max_requests:
+                if self.verbose:
+                    print(f"Restarting worker after {worker.n_requests} requests")
+                worker.close()
+
+            if worker is None:
+                if self.verbose:
+                    print("Creating environment...")
+                env_cmd = create_env(
+                    run_dir,
+                    model_version.modelid,
+                    model_version.modelversion,
+                    capture_output=capture_output,
+                )
+                worker = ModelWorker(run_dir, env_cmd=env_cmd, verbose=self.verbose)
+                self.workers[key] = worker
+            # the worker hasn't been called yet, so make sure it isn't reaped first
+            worker.last_used = time.monotonic()
+            self.start_reaper()
+
+        return worker
+
+    def start_reaper(self):
+        """Start the background thread that stops idle workers, if it's not running."""
+        if self.reaper is not None and self.reaper.is_alive():
+            return
+        self.stop_reaper.clear()
+        self.reaper = threading.Thread(target=self.reap, daemon=True)
+        self.reaper.start()
+
+    def reap(self):
+        """Stop idle workers every few seconds until the pool is closed (run in the
+        reaper thread).
+        """
+        interval = min(max(self.idle_timeout / 4, 0.1), 30)
+        while not self.stop_reaper.wait(interval):
+            self.close_idle()
+
+    def close_idle(self):
+        """Stop workers that have been idle for longer than idle_timeout. Workers that
+        are handling a request are never stopped.
+        """
+        with self.lock:
+            now = time.monotonic()
+            for key, worker in list(self.workers.items()):
+                if not worker.lock.acquire(blocking=False):
+                    # in use by another thread
+                    continue
+                try:
+                    if now - worker.last_used > self.idle_timeout:
+                        worker.close()
+                        del self.workers[key]
+                finally:
+                    worker.lock.release()
+
+    def close_all(self):
+        """Stop all workers in the pool, and the reaper thread."""
+        self.stop_reaper.set()
+        if self.reaper is not None:
+            self.reaper.join()
+            self.reaper = None
+        with self.lock:
+            for worker in self.workers.values():
+                worker.close()
+            self.workers = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close_all()
+
+
+def workers_enabled():
+    """Check whether persistent workers are enabled in the config file.
+
+    Returns
+    -------
+    bool
+        The value of "persistent" in modmon.config.config["workers"], or False if
+        that's not present.
+    """
+    if "workers" in config:
+        return config["workers"].get("persistent", "False") == "True"
+    return False
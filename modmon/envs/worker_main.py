@@ -0,0 +1,100 @@
+"""
+Worker process run inside a model's environment to call Python model entry-points
+without starting a new interpreter or re-activating the environment for each run.
+
+This file is run as a script with the model environment's python, where ModMon itself
+is not installed, so it must only use the standard library. Requests are read from
+stdin and responses written to stdout as one JSON object per line (see
+modmon.envs.worker for the parent side of the protocol). Anything the model prints is
+redirected to stderr so it can't interfere with the responses.
+"""
+import importlib
+import json
+import os
+import sys
+import traceback
+
+
+def encode_result(result):
+    """Convert the value returned by an entry-point to a JSON-serialisable dict.
+
+    Parameters
+    ----------
+    result : pandas.DataFrame, pandas.Series, dict or list
+        Value returned by the entry-point
+
+    Returns
+    -------
+    dict
+        {"type": "frame", "data": <result in pandas "split" format>} for pandas objects,
+        or {"type": "json", "data": result} otherwise.
+    """
+    if hasattr(result, "to_json"):
+        # pandas DataFrame or Series
+        return {
+            "type": "frame",
+            "data": json.loads(result.to_json(orient="split", date_format="iso")),
+        }
+    return {"type": "json", "data": result}
+
+
+def load_entrypoint(entrypoint):
+    """Import the function defined by an entry-point string.
+
+    Parameters
+    ----------
+    entrypoint : str
+        Entry-point in the format "module:function", where module is importable from
+        the model directory.
+
+    Returns
+    -------
+    function
+        The entry-point function
+    """
+    module_name, function_name = entrypoint.split(":")
+    module = importlib.import_module(module_name)
+    return getattr(module, function_name)
+
+
+def handle_request(request):
+    """Call the entry-point in a request and build the response.
+
+    Parameters
+    ----------
+    request : dict
+        Request with keys "entrypoint" and "kwargs"
+
+    Returns
+    -------
+    dict
+        {"ok": True, "result": <encoded result>} if the call succeeded, or
+        {"ok": False, "error": <traceback>} if it raised an exception.
+    """
+    try:
+        function = load_entrypoint(request["entrypoint"])
+        result = function(**request["kwargs"])
+        return {"ok": True, "result": encode_result(result)}
+    except Exception:
+        return {"ok": False, "error": traceback.format_exc()}
+
+
+def main():
+    """Serve requests from stdin until it is closed."""
+    # keep the real stdout for responses, and send everything else to stderr
+    responses = os.fdopen(os.dup(sys.stdout.fileno()), "w")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    # model modules are imported from the working directory (the model directory)
+    sys.path.insert(0, os.getcwd())
+
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        response = handle_request(json.loads(line))
+        sys.stdout.flush()
+        responses.write(json.dumps(response) + "\n")
+        responses.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,497 @@
+"""
+Functions to check new scores against alert rules as they're added to the database, and
+to save and send alerts for scores that break them. Only the new scores are checked,
+against the rules and each model version's reference scores, which are cached, so the
+cost doesn't grow with the score history.
+
+Alerts are saved to the alert table in the same transaction as the scores, and sent to
+the notification sinks in the [alerts] section of the config file (a JSON lines file
+and/or a webhook) after the transaction is committed.
+"""
+import argparse
+from datetime import datetime
+from fnmatch import fnmatchcase
+import json
+import math
+import threading
+import time
+import urllib.request
+
+import numpy as np
+from sqlalchemy import event
+
+from ..config import config
+from ..db.connect import get_session
+from ..db.schema import Alert, AlertRule, Score
+
+# Kinds of alert rule, and a description of when each is broken. Relative changes are
+# compared to the model version's reference score for the same metric.
+RULE_KINDS = {
+    "min": "value below {threshold}",
+    "max": "value above {threshold}",
+    "decrease": "decreased by more than {threshold:.0%} from reference {baseline}",
+    "increase": "increased by more than {threshold:.0%} from reference {baseline}",
+}
+# Key in session.info of alerts waiting for the session to be committed
+PENDING_KEY = "modmon_pending_alerts"
+
+
+def get_alert_config(alert_config=None):
+    """Get the alert settings from the config file.
+
+    Parameters
+    ----------
+    alert_config : configparser.SectionProxy, optional
+        configparser section optionally containing the keys 'enabled', 'file',
+        'webhook' and 'cachettl', by default None which uses
+        modmon.config.config["alerts"] if it exists.
+
+    Returns
+    -------
+    bool, str, str, float
+        Whether new scores are checked against alert rules, the path of the file to
+        append alerts to (or None), the URL to post alerts to (or None), and the number
+        of seconds to cache rules and reference scores for.
+    """
+    if alert_config is None:
+        alert_config = config["alerts"] if "alerts" in config else {}
+    enabled = alert_config.get("enabled", "True") == "True"
+    alert_file = alert_config.get("file") or None
+    webhook = alert_config.get("webhook") or None
+    cache_ttl = float(alert_config.get("cachettl", 300))
+    return enabled, alert_file, webhook, cache_ttl
+
+
+class AlertCache:
+    """Caches the alert rules and the reference scores of each model version, so
+    checking new scores doesn't query the database each time. Entries expire after a
+    number of seconds, so changes to the rules are picked up.
+    """
+
+    def __init__(self, ttl=300):
+        """Initialise an instance of AlertCache.
+
+        Parameters
+        ----------
+        ttl : float, optional
+            Seconds to keep cached rules and reference scores for, by default 300
+        """
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """Remove everything from the cache."""
+        with self._lock:
+            self._rules = None
+            self._rules_time = None
+            self._baselines = {}
+
+    def _expired(self, load_time):
+        return load_time is None or time.monotonic() - load_time > self.ttl
+
+    def get_rules(self, session):
+        """Get all alert rules.
+
+        Parameters
+        ----------
+        session : sqlalchemy.orm.session.Session
+            ModMon database session
+
+        Returns
+        -------
+        list
+            (ruleid, metric, modelid, kind, threshold) of each rule
+        """
+        with self._lock:
+            if self._expired(self._rules_time):
+                self._rules = session.query(
+                    AlertRule.ruleid,
+                    AlertRule.metric,
+                    AlertRule.modelid,
+                    AlertRule.kind,
+                    AlertRule.threshold,
+                ).all()
+                self._rules_time = time.monotonic()
+            return self._rules
+
+    def get_baselines(self, session, model_version):
+        """Get the reference scores of a model version.
+
+        Parameters
+        ----------
+        session : sqlalchemy.orm.session.Session
+            ModMon database session
+        model_version : modmon.schema.db.ModelVersion
+            Model version object
+
+        Returns
+        -------
+        dict
+            {metric_name: reference value}
+        """
+        key = (model_version.modelid, model_version.modelversion)
+        with self._lock:
+            baselines, load_time = self._baselines.get(key, (None, None))
+            if self._expired(load_time):
+                baselines = dict(
+                    session.query(Score.metric, Score.value).filter(
+                        Score.modelid == model_version.modelid,
+                        Score.modelversion == model_version.modelversion,
+                        Score.isreference,
+                        Score.slice == "",
+                    )
+                )
+                self._baselines[key] = (baselines, time.monotonic())
+            return baselines
+
+
+CACHE = AlertCache(get_alert_config()[3])
+
+
+def check_rule(kind, threshold, value, baseline=None):
+    """Check whether a value breaks an alert rule.
+
+    Parameters
+    ----------
+    kind : str
+        Kind of rule, one of RULE_KINDS
+    threshold : float
+        Threshold of the rule. For relative change rules the fraction of the baseline,
+        e.g. 0.1 for a change of more than 10%.
+    value : float
+        Value to check
+    baseline : float, optional
+        Reference value for relative change rules, by default None
+
+    Returns
+    -------
+    bool
+        True if the value breaks the rule. Relative change rules are never broken if
+        there's no (non-zero) baseline.
+
+    Raises
+    ------
+    ValueError
+        If kind isn't one of RULE_KINDS
+    """
+    if kind == "min":
+        return value < threshold
+    if kind == "max":
+        return value > threshold
+    if kind in ("decrease", "increase"):
+        if baseline is None or baseline == 0:
+            return False
+        change = (value - baseline) / abs(baseline)
+        return -change > threshold if kind == "decrease" else change > threshold
+    raise ValueError(f"Alert rule kind must be one of {list(RULE_KINDS)}, not {kind}")
+
+
+def get_severity(kind, threshold, value, baseline=None):
+    """Measure how far a value is beyond the threshold of an alert rule, so breaches of
+    different rules can be compared.
+
+    Parameters
+    ----------
+    kind : str
+        Kind of rule, one of RULE_KINDS
+    threshold : float
+        Threshold of the rule
+    value : float
+        Value that breaks the rule
+    baseline : float, optional
+        Reference value for relative change rules, by default None
+
+    Returns
+    -------
+    float
+        1 plus the distance beyond the threshold as a fraction of the threshold, e.g.
+        1.5 for a max rule with threshold 0.2 and value 0.3
+    """
+    if kind in ("decrease", "increase"):
+        change = abs(value - baseline) / abs(baseline)
+        return change / threshold if threshold else np.inf
+    if threshold == 0:
+        return 1 + abs(value)
+    return 1 + abs(value - threshold) / abs(threshold)
+
+
+def check_alerts(session, model_version, dataset_id, run_id, values):
+    """Check new scores against the alert rules, and add an alert to the session for
+    each score that breaks a rule. The session is not committed, and the alerts are
+    sent to the notification sinks after it is.
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session
+        ModMon database session
+    model_version : modmon.schema.db.ModelVersion
+        Model version object
+    dataset_id : int
+        ID of the dataset the scores are for
+    run_id : int
+        Run ID of the scores
+    values : dict
+        {metric_name: value} of the new scores
+
+    Returns
+    -------
+    list
+        Alert objects added to the session
+    """
+    enabled, _, _, _ = get_alert_config()
+    if not enabled:
+        return []
+    rules = [
+        rule
+        for rule in CACHE.get_rules(session)
+        if rule.modelid is None or rule.modelid == model_version.modelid
+    ]
+    if not rules:
+        return []
+    baselines = None
+
+    alert_time = datetime.now()
+    alerts = []
+    for metric, value in values.items():
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            continue
+        if math.isnan(value):
+            continue
+        for rule in rules:
+            if not fnmatchcase(metric, rule.metric):
+                continue
+            baseline = None
+            if rule.kind in ("decrease", "increase"):
+                if baselines is None:
+                    baselines = CACHE.get_baselines(session, model_version)
+                baseline = baselines.get(metric)
+            if not check_rule(rule.kind, rule.threshold, value, baseline):
+                continue
+            condition = RULE_KINDS[rule.kind].format(
+                threshold=rule.threshold, baseline=baseline
+            )
+            alert = Alert(
+                ruleid=rule.ruleid,
+                modelid=model_version.modelid,
+                modelversion=model_version.modelversion,
+                datasetid=dataset_id,
+                runid=run_id,
+                metric=metric,
+                value=value,
+                baseline=baseline,
+                alerttime=alert_time,
+                message=(
+                    f"Model {model_version.modelid} version "
+                    f"{model_version.modelversion} on dataset {dataset_id}: {metric} = "
+                    f"{value:.4g} ({condition})"
+                )[: Alert.message.type.length],
+            )
+            session.add(alert)
+            alerts.append(alert)
+
+    if alerts:
+        queue_notifications(session, alerts)
+    return alerts
+
+
+def queue_notifications(session, alerts):
+    """Send alerts to the notification sinks once the session is committed (and drop
+    them if it's rolled back).
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session
+        ModMon database session
+    alerts : list
+        Alert objects
+    """
+    if PENDING_KEY not in session.info:
+        session.info[PENDING_KEY] = []
+        event.listen(session, "after_commit", _send_pending)
+        event.listen(session, "after_soft_rollback", _clear_pending)
+    session.info[PENDING_KEY].extend(alert_to_dict(alert) for alert in alerts)
+
+
+def _send_pending(session):
+    pending = session.info.get(PENDING_KEY, [])
+    session.info[PENDING_KEY] = []
+    if pending:
+        send_alerts(pending)
+
+
+def _clear_pending(session, previous_transaction):
+    session.info[PENDING_KEY] = []
+
+
+def alert_to_dict(alert):
+    """Convert an alert to a JSON serialisable dict.
+
+    Parameters
+    ----------
+    alert : modmon.db.schema.Alert
+        Alert object
+
+    Returns
+    -------
+    dict
+        Values of the alert's columns
+    """
+    return {
+        "ruleid": alert.ruleid,
+        "modelid": alert.modelid,
+        "modelversion": alert.modelversion,
+        "datasetid": alert.datasetid,
+        "runid": alert.runid,
+        "metric": alert.metric,
+        "value": alert.value,
+        "baseline": alert.baseline,
+        "alerttime": alert.alerttime.isoformat(),
+        "message": alert.message,
+    }
+
+
+def send_alerts(alerts, alert_file=None, webhook=None):
+    """Send alerts to the notification sinks: append them to a JSON lines file and/or
+    post them to a webhook. Failing to send alerts prints a warning rather than raising
+    an error, as the alerts are already saved in the database.
+
+    Parameters
+    ----------
+    alerts : list
+        Alerts as dicts (see alert_to_dict)
+    alert_file : str, optional
+        Path of the file to append alerts to, by default None which uses the value in
+        modmon.config.config["alerts"]
+    webhook : str, optional
+        URL to post alerts to as JSON, by default None which uses the value in
+        modmon.config.config["alerts"]
+    """
+    _, config_file, config_webhook, _ = get_alert_config()
+    alert_file = alert_file or config_file
+    webhook = webhook or config_webhook
+
+    for alert in alerts:
+        print(f"ALERT: {alert['message']}")
+    if alert_file is not None:
+        try:
+            with open(alert_file, "a") as f:
+                for alert in alerts:
+                    f.write(json.dumps(alert) + "\n")
+        except OSError as e:
+            print(f"WARNING: Could not write alerts to {alert_file}: {e}")
+    if webhook is not None:
+        request = urllib.request.Request(
+            webhook,
+            data=json.dumps({"alerts": alerts}).encode(),
+            headers={"Content-Type": "application/json"},
+        )
+        try:
+            urllib.request.urlopen(request, timeout=10).close()
+        except OSError as e:
+            print(f"WARNING: Could not post alerts to {webhook}: {e}")
+
+
+def read_rules_file(rules_path):
+    """Load alert rules from a JSON file.
+
+    Parameters
+    ----------
+    rules_path : str or Path
+        Path to a JSON file containing a list of rules, each a dict with the keys
+        "metric", "kind" and "threshold", and optionally "modelid" and "description".
+        For example:
+        [{"metric": "modmon.auc.*", "kind": "min", "threshold": 0.7},
+         {"metric": "accuracy", "kind": "decrease", "threshold": 0.05, "modelid": 1}]
+
+    Returns
+    -------
+    list
+        List of rule dicts
+
+    Raises
+    ------
+    ValueError
+        If a rule doesn't have a metric, kind and threshold, or its kind isn't one of
+        RULE_KINDS
+    """
+    with open(rules_path, "r") as f:
+        rules = json.load(f)
+    for rule in rules:
+        if not all(key in rule for key in ("metric", "kind", "threshold")):
+            raise ValueError(
+                f"Alert rule {rule} must have a metric, kind and threshold"
+            )
+        if rule["kind"] not in RULE_KINDS:
+            raise ValueError(
+                f"Alert rule {rule} kind must be one of {list(RULE_KINDS)}"
+            )
+    return rules
+
+
+def add_alert_rules(session, rules):
+    """Add alert rules to the database. The session is not committed.
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session
+        ModMon database session
+    rules : list
+        List of rule dicts (see read_rules_file)
+    """
+    for rule in rules:
+        session.add(
+            AlertRule(
+                metric=rule["metric"],
+                modelid=rule.get("modelid"),
+                kind=rule["kind"],
+                threshold=rule["threshold"],
+                description=rule.get("description"),
+            )
+        )
+    CACHE.clear()
+
+
+def main():
+    """Add alert rules, or list the rules and most recent alerts.
+
+    Available from the command-line as modmon_alerts
+    """
+    parser = argparse.ArgumentParser(
+        description=(
+            "Add rules that new scores are checked against, or list the rules and the "
+            "most recent alerts"
+        )
+    )
+    parser.add_argument(
+        "--rules_file",
+        help=(
+            "JSON file with a list of alert rules, each with a metric, kind (min, max, "
+            "decrease or increase), threshold and optionally modelid and description"
+        ),
+    )
+    parser.add_argument(
+        "--limit",
+        help="Number of recent alerts to list (default: 20)",
+        type=int,
+        default=20,
+    )
+    args = parser.parse_args()
+
+    session = get_session()
+    if args.rules_file is not None:
+        add_alert_rules(session, read_rules_file(args.rules_file))
+        session.commit()
+
+    print("Rules:")
+    for rule in session.query(AlertRule).order_by(AlertRule.ruleid):
+        model = "all models" if rule.modelid is None else f"model {rule.modelid}"
+        print(f"{rule.ruleid}: {rule.metric} {rule.kind} {rule.threshold} ({model})")
+    print("Recent alerts:")
+    for alert in (
+        session.query(Alert).order_by(Alert.alerttime.desc()).limit(args.limit)
+    ):
+        print(f"{alert.alerttime}: {alert.message}")
+    session.close()
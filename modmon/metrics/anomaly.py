@@ -0,0 +1,476 @@
+"""
+Functions to detect anomalies in the history of each metric of each model version (a
+series of scores with one score per dataset, in the order of their run times), with a
+rolling robust z-score, an exponentially weighted moving average (EWMA) z-score and a
+CUSUM detector.
+
+All series are processed together in one vectorised batch. The state of the detectors
+for each series is saved in the anomaly_state table, and the datasets included in
+each series in the anomaly_check table, so only scores for new datasets are read and
+each new score is checked in constant time. Scores for datasets that are scored again
+(e.g. when new labels arrive) don't re-enter their series. Anomalous scores are saved
+in the anomaly table.
+"""
+import argparse
+from datetime import datetime
+import warnings
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import and_, not_, select
+
+from ..config import config
+from ..db.connect import get_session
+from ..db.schema import Anomaly, AnomalyCheck, AnomalyState, Score
+
+# Anomaly detectors and their descriptions
+DETECTORS = {
+    "robust_z": "Robust z-score (median and MAD of the previous scores in the window)",
+    "ewma": "z-score from the exponentially weighted mean and variance of the scores",
+    "cusum": "Cumulative sum of standardised deviations from the EWMA",
+}
+
+
+def get_anomaly_config(anomaly_config=None):
+    """Get the anomaly detection settings from the config file.
+
+    Parameters
+    ----------
+    anomaly_config : configparser.SectionProxy, optional
+        configparser section optionally containing the keys 'enabled', 'window',
+        'minhistory', 'alpha', 'zthreshold', 'ewmathreshold', 'cusumk' and 'cusumh',
+        by default None which uses modmon.config.config["anomaly"] if it exists.
+
+    Returns
+    -------
+    bool, dict
+        Whether anomalies are detected after models are run, and the detector settings
+        as keyword arguments for SeriesDetectors.
+    """
+    if anomaly_config is None:
+        anomaly_config = config["anomaly"] if "anomaly" in config else {}
+    enabled = anomaly_config.get("enabled", "True") == "True"
+    settings = {
+        "window": int(anomaly_config.get("window", 30)),
+        "min_history": int(anomaly_config.get("minhistory", 10)),
+        "alpha": float(anomaly_config.get("alpha", 0.1)),
+        "z_threshold": float(anomaly_config.get("zthreshold", 4)),
+        "ewma_threshold": float(anomaly_config.get("ewmathreshold", 3.5)),
+        "cusum_k": float(anomaly_config.get("cusumk", 0.5)),
+        "cusum_h": float(anomaly_config.get("cusumh", 5)),
+    }
+    return enabled, settings
+
+
+def _scale_floor(location):
+    """Smallest spread used to standardise scores, so constant series don't give
+    infinite z-scores for rounding errors.
+    """
+    return 1e-6 * np.maximum(np.abs(location), 1)
+
+
+class SeriesDetectors:
+    """State of the anomaly detectors for many series of scores, stored as arrays with
+    one element (or row) per series so that a new score can be checked for a set of
+    series at once.
+    """
+
+    def __init__(
+        self,
+        n_series,
+        window=30,
+        min_history=10,
+        alpha=0.1,
+        z_threshold=4,
+        ewma_threshold=3.5,
+        cusum_k=0.5,
+        cusum_h=5,
+    ):
+        """Initialise an instance of SeriesDetectors, with no history for any series.
+
+        Parameters
+        ----------
+        n_series : int
+            Number of series
+        window : int, optional
+            Number of previous scores used for the rolling robust z-score, by default
+            30
+        min_history : int, optional
+            Number of previous scores a series must have before its scores can be
+            anomalous, by default 10
+        alpha : float, optional
+            Smoothing factor of the EWMA (weight of the newest score), by default 0.1
+        z_threshold : float, optional
+            Robust z-score above which (in absolute value) a score is anomalous, by
+            default 4
+        ewma_threshold : float, optional
+            EWMA z-score above which (in absolute value) a score is anomalous, by
+            default 3.5
+        cusum_k : float, optional
+            Allowance of the CUSUM detector, in standard deviations, by default 0.5
+        cusum_h : float, optional
+            Decision threshold of the CUSUM detector, in standard deviations, by default
+            5
+        """
+        self.window_size = window
+        self.min_history = min_history
+        self.alpha = alpha
+        self.z_threshold = z_threshold
+        self.ewma_threshold = ewma_threshold
+        self.cusum_k = cusum_k
+        self.cusum_h = cusum_h
+
+        self.count = np.zeros(n_series, dtype=np.int64)
+        self.mean = np.full(n_series, np.nan)
+        self.variance = np.full(n_series, np.nan)
+        self.cusum_high = np.zeros(n_series)
+        self.cusum_low = np.zeros(n_series)
+        # previous scores, oldest first and NaN padded on the left
+        self.window = np.full((n_series, window), np.nan)
+
+    def set_state(self, series, state):
+        """Set the state of a series, e.g. loaded from the database.
+
+        Parameters
+        ----------
+        series : int
+            Index of the series
+        state : modmon.db.schema.AnomalyState
+            Saved state of the series
+        """
+        self.count[series] = state.count
+        self.mean[series] = np.nan if state.ewmamean is None else state.ewmamean
+        self.variance[series] = (
+            np.nan if state.ewmavariance is None else state.ewmavariance
+        )
+        self.cusum_high[series] = state.cusumhigh
+        self.cusum_low[series] = state.cusumlow
+        values = [np.nan if v is None else v for v in state.window][-self.window_size :]
+        self.window[series] = np.nan
+        if values:
+            self.window[series, -len(values) :] = values
+
+    def get_state(self, series):
+        """Get the state of a series as the values of AnomalyState columns.
+
+        Parameters
+        ----------
+        series : int
+            Index of the series
+
+        Returns
+        -------
+        dict
+            {column_name: value}
+        """
+
+        def to_float(value):
+            return None if np.isnan(value) else float(value)
+
+        window = self.window[series]
+        return {
+            "count": int(self.count[series]),
+            "ewmamean": to_float(self.mean[series]),
+            "ewmavariance": to_float(self.variance[series]),
+            "cusumhigh": float(self.cusum_high[series]),
+            "cusumlow": float(self.cusum_low[series]),
+            "window": [float(v) for v in window[~np.isnan(window)]],
+        }
+
+    def update(self, series, values):
+        """Check the next score of a set of series for anomalies, then add it to their
+        state.
+
+        Parameters
+        ----------
+        series : numpy.ndarray
+            Indices of the series (each at most once)
+        values : numpy.ndarray
+            Next score of each series
+
+        Returns
+        -------
+        dict
+            {detector: (anomalous, statistic)} for each detector in DETECTORS, where
+            anomalous is a boolean array with whether each score is anomalous and
+            statistic is an array of the detector's statistic (NaN if the series
+            doesn't have enough history).
+        """
+        count = self.count[series]
+        ready = count >= self.min_history
+
+        # rolling robust z-score against the previous scores in the window
+        window = self.window[series]
+        robust_z = np.full(len(series), np.nan)
+        if ready.any():
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", RuntimeWarning)
+                median = np.nanmedian(window[ready], axis=1)
+                mad = 1.4826 * np.nanmedian(
+                    np.abs(window[ready] - median[:, np.newaxis]), axis=1
+                )
+            mad = np.maximum(mad, _scale_floor(median))
+            robust_z[ready] = (values[ready] - median) / mad
+
+        # EWMA z-score against the mean and variance before this score
+        mean = self.mean[series]
+        variance = self.variance[series]
+        scale = np.maximum(np.sqrt(variance), _scale_floor(mean))
+        ewma_z = np.where(ready, (values - mean) / scale, np.nan)
+
+        # CUSUM of the EWMA z-scores, restarting after each anomaly
+        cusum_high = np.where(
+            ready, np.maximum(0, self.cusum_high[series] + ewma_z - self.cusum_k), 0
+        )
+        cusum_low = np.where(
+            ready, np.maximum(0, self.cusum_low[series] - ewma_z - self.cusum_k), 0
+        )
+        cusum = np.where(cusum_high >= cusum_low, cusum_high, -cusum_low)
+        cusum[~ready] = np.nan
+        cusum_anomalous = ready & (np.abs(cusum) > self.cusum_h)
+        cusum_high[cusum_anomalous] = 0
+        cusum_low[cusum_anomalous] = 0
+
+        # add the scores to the state
+        first = count == 0
+        delta = np.where(first, 0, values - mean)
+        self.mean[series] = np.where(first, values, mean + self.alpha * delta)
+        self.variance[series] = np.where(
+            first, 0, (1 - self.alpha) * (variance + self.alpha * delta ** 2)
+        )
+        self.cusum_high[series] = cusum_high
+        self.cusum_low[series] = cusum_low
+        self.window[series] = np.column_stack([window[:, 1:], values])
+        self.count[series] = count + 1
+
+        return {
+            "robust_z": (ready & (np.abs(robust_z) > self.z_threshold), robust_z),
+            "ewma": (ready & (np.abs(ewma_z) > self.ewma_threshold), ewma_z),
+            "cusum": (cusum_anomalous, cusum),
+        }
+
+
+def read_new_scores(session, rebuild=False):
+    """Read the scores for datasets that haven't been included in the anomaly state of
+    their series yet (see AnomalyCheck), using the latest run if a dataset has more
+    than one score for a metric. Reference scores and scores for slices of datasets
+    are excluded.
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session
+        ModMon database session
+    rebuild : bool, optional
+        If True read the scores for all datasets, by default False
+
+    Returns
+    -------
+    pandas.DataFrame
+        Scores with the columns modelid, modelversion, metric, datasetid, runid,
+        runtime and value, ordered by run time, dataset ID and run ID
+    """
+    columns = ["modelid", "modelversion", "metric", "datasetid", "runid", "runtime"]
+    scores = Score.__table__
+    checks = AnomalyCheck.__table__
+    query = select([scores.c[column] for column in columns] + [scores.c.value]).where(
+        and_(not_(scores.c.isreference), scores.c.slice == "")
+    )
+    if not rebuild:
+        query = query.select_from(
+            scores.outerjoin(
+                checks,
+                and_(
+                    checks.c.modelid == scores.c.modelid,
+                    checks.c.modelversion == scores.c.modelversion,
+                    checks.c.metric == scores.c.metric,
+                    checks.c.datasetid == scores.c.datasetid,
+                ),
+            )
+        ).where(checks.c.datasetid.is_(None))
+    rows = session.execute(query).fetchall()
+    scores = pd.DataFrame(rows, columns=columns + ["value"])
+    # one score per dataset in each series, from its latest run
+    scores = scores.sort_values("runid").drop_duplicates(
+        ["modelid", "modelversion", "metric", "datasetid"], keep="last"
+    )
+    return scores.sort_values(
+        ["runtime", "datasetid", "runid"], kind="mergesort"
+    ).reset_index(drop=True)
+
+
+def detect_anomalies(scores, detectors):
+    """Run the anomaly detectors over new scores of many series. The scores of all
+    series are processed in steps, with each step checking the next score of every
+    series that has one at once.
+
+    Parameters
+    ----------
+    scores : pandas.DataFrame
+        New scores with a series column (index of the series in detectors) and a value
+        column, ordered by run time
+    detectors : SeriesDetectors
+        State of the detectors for each series, updated in place
+
+    Returns
+    -------
+    pandas.DataFrame
+        Rows of scores that are anomalous, with the additional columns detector and
+        statistic (one row per score and detector)
+    """
+    series = scores["series"].to_numpy()
+    values = scores["value"].to_numpy(dtype=float)
+    # position of each score in its series, and the scores sorted by it
+    step = scores.groupby("series").cumcount().to_numpy()
+    order = np.argsort(step, kind="stable")
+    bounds = np.searchsorted(step[order], np.arange(step.max() + 2))
+
+    anomalies = []
+    for i in range(len(bounds) - 1):
+        rows = order[bounds[i] : bounds[i + 1]]
+        for detector, (anomalous, statistic) in detectors.update(
+            series[rows], values[rows]
+        ).items():
+            if anomalous.any():
+                flagged = scores.iloc[rows[anomalous]].copy()
+                flagged["detector"] = detector
+                flagged["statistic"] = statistic[anomalous]
+                anomalies.append(flagged)
+    if not anomalies:
+        return scores.iloc[:0].assign(detector=[], statistic=[])
+    return pd.concat(anomalies)
+
+
+def update_anomalies(session=None, rebuild=False, verbose=True):
+    """Check the scores added since the last update for anomalies, save any anomalies
+    found and update the state of the detectors.
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session, optional
+        ModMon database session or None in which case one will be created, by default
+        None
+    rebuild : bool, optional
+        If True delete all saved anomalies and detector states and process the full
+        history of scores, by default False
+    verbose : bool, optional
+        If True print additional progress messages, by default True
+
+    Returns
+    -------
+    int
+        Number of anomalies found
+    """
+    if not session:
+        session = get_session()
+        close_session = True  # if session is created in function, close it in function
+    else:
+        close_session = False  # if session given, leave it open
+
+    _, settings = get_anomaly_config()
+    if rebuild:
+        session.query(Anomaly).delete(synchronize_session=False)
+        session.query(AnomalyState).delete(synchronize_session=False)
+        session.query(AnomalyCheck).delete(synchronize_session=False)
+
+    scores = read_new_scores(session, rebuild)
+    # datasets (including those with missing scores) are only added to a series once
+    session.add_all(
+        [
+            AnomalyCheck(
+                modelid=int(row.modelid),
+                modelversion=row.modelversion,
+                metric=row.metric,
+                datasetid=int(row.datasetid),
+                runid=int(row.runid),
+            )
+            for row in scores.itertuples()
+        ]
+    )
+    scores = scores[~scores["value"].isna()]
+    if scores.empty:
+        session.commit()
+        if close_session:
+            session.close()
+        return 0
+
+    keys = list(zip(scores["modelid"], scores["modelversion"], scores["metric"]))
+    series_keys = list(dict.fromkeys(keys))
+    series_index = {key: i for i, key in enumerate(series_keys)}
+    scores = scores.assign(series=[series_index[key] for key in keys])
+
+    detectors = SeriesDetectors(len(series_keys), **settings)
+    states = {
+        (state.modelid, state.modelversion, state.metric): state
+        for state in session.query(AnomalyState)
+    }
+    for key, i in series_index.items():
+        if key in states:
+            detectors.set_state(i, states[key])
+
+    anomalies = detect_anomalies(scores, detectors)
+
+    last_run_ids = scores.groupby("series")["runid"].last()
+    for key, i in series_index.items():
+        values = detectors.get_state(i)
+        values["lastrunid"] = int(last_run_ids[i])
+        if key in states:
+            for column, value in values.items():
+                setattr(states[key], column, value)
+        else:
+            session.add(
+                AnomalyState(
+                    modelid=key[0], modelversion=key[1], metric=key[2], **values
+                )
+            )
+
+    detected_time = datetime.now()
+    session.add_all(
+        [
+            Anomaly(
+                modelid=int(row.modelid),
+                modelversion=row.modelversion,
+                runid=int(row.runid),
+                metric=row.metric,
+                detector=row.detector,
+                datasetid=int(row.datasetid),
+                value=float(row.value),
+                statistic=float(row.statistic),
+                detectedtime=detected_time,
+            )
+            for row in anomalies.itertuples()
+        ]
+    )
+    session.commit()
+    if verbose:
+        print(
+            f"Checked {len(scores)} new scores in {len(series_keys)} series and found "
+            f"{len(anomalies)} anomalies"
+        )
+
+    if close_session:
+        session.close()
+    return len(anomalies)
+
+
+def main():
+    """Detect anomalies in the scores added since the last check.
+
+    Available from the command-line as modmon_anomaly
+    """
+    parser = argparse.ArgumentParser(
+        description=(
+            "Detect anomalies in the history of each metric of each model version"
+        )
+    )
+    parser.add_argument(
+        "--rebuild",
+        help=(
+            "If set, delete all saved anomalies and detector states and check the full "
+            "history of scores (e.g. after changing the settings or backfilling "
+            "results)"
+        ),
+        action="store_true",
+    )
+    args = parser.parse_args()
+
+    update_anomalies(rebuild=args.rebuild)
@@ -0,0 +1,530 @@
+"""
+Functions to calculate bootstrap confidence intervals for the label metrics of
+prediction runs (see modmon.metrics.evaluate), and a bootstrap test of the difference
+between each metric and its value on the model version's reference run, from the
+stored predictions and labels. Results are saved next to the metric values in the score
+table.
+
+Resampling uses the Poisson bootstrap: in each resample every labelled prediction is
+included a Poisson(1) number of times, drawn from a hash of its record ID and the seed.
+This gives the same resamples however the predictions are read (in any order or chunk
+size), lets runs be resampled in chunks without holding them in memory, and pairs
+resamples of records that are in both a run and its reference run.
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import math
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import func
+
+from ..config import config
+from ..db.connect import ENGINE, get_session
+from ..db.schema import LabelEvaluation, ModelVersion, Score
+from .drift import get_reference_run
+from .evaluate import get_evaluate_config, iter_labelled_chunks
+from .kernels import KERNELS, OutputEvaluator
+from .utils import OVERALL_SLICE, get_reserved_metric_name
+
+# Kernels whose metrics aren't resampled (the number of rows varies between Poisson
+# resamples)
+SKIP_KERNELS = ["count"]
+# Maximum number of resampled rows passed to the kernels at a time
+BLOCK_ROWS = 2_000_000
+# Cumulative distribution function of Poisson(1), used to draw resample weights
+POISSON_CDF = np.cumsum([math.exp(-1) / math.factorial(k) for k in range(20)])
+
+
+def get_bootstrap_config(bootstrap_config=None):
+    """Get the bootstrap settings from the config file.
+
+    Parameters
+    ----------
+    bootstrap_config : configparser.SectionProxy, optional
+        configparser section optionally containing the keys 'enabled', 'resamples',
+        'alpha', 'seed' and 'jobs', by default None which uses
+        modmon.config.config["bootstrap"] if it exists.
+
+    Returns
+    -------
+    bool, int, float, int, int
+        Whether confidence intervals are calculated after label metrics are updated,
+        the number of resamples, the significance level (the intervals cover
+        1 - alpha), the random seed and the number of processes to use.
+    """
+    if bootstrap_config is None:
+        bootstrap_config = config["bootstrap"] if "bootstrap" in config else {}
+    enabled = bootstrap_config.get("enabled", "False") == "True"
+    resamples = int(bootstrap_config.get("resamples", 200))
+    alpha = float(bootstrap_config.get("alpha", 0.05))
+    seed = int(bootstrap_config.get("seed", 0))
+    jobs = int(bootstrap_config.get("jobs", 1))
+    return enabled, resamples, alpha, seed, jobs
+
+
+def _mix(x):
+    """splitmix64 finaliser, to turn (e.g. consecutive) uint64 keys into independent
+    pseudo-random uint64 values.
+    """
+    x = x ^ (x >> np.uint64(30))
+    x = x * np.uint64(0xBF58476D1CE4E5B9)
+    x = x ^ (x >> np.uint64(27))
+    x = x * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def resample_weights(record_ids, resamples, seed=0):
+    """Draw the number of times each record is included in each Poisson bootstrap
+    resample. The weights only depend on the record IDs, number of resamples and seed.
+
+    Parameters
+    ----------
+    record_ids : list-like
+        Record IDs of the rows
+    resamples : int
+        Number of resamples
+    seed : int, optional
+        Random seed, by default 0
+
+    Returns
+    -------
+    numpy.ndarray
+        Weights with shape (resamples, number of records)
+    """
+    keys = pd.util.hash_pandas_object(
+        pd.Series(record_ids, dtype=object).astype(str), index=False
+    ).to_numpy()
+    golden = np.uint64(0x9E3779B97F4A7C15)
+    # uint64 arithmetic is modulo 2**64
+    with np.errstate(over="ignore"):
+        keys = _mix(keys ^ _mix(np.uint64(seed) + golden))
+        steps = np.arange(1, resamples + 1, dtype=np.uint64) * golden
+        bits = _mix(keys[np.newaxis, :] + steps[:, np.newaxis])
+    # top 53 bits as a uniform number in [0, 1)
+    uniform = (bits >> np.uint64(11)).astype(np.float64) / 2.0 ** 53
+    return np.searchsorted(POISSON_CDF, uniform, side="right").astype(np.int64)
+
+
+def resample_indices(weights):
+    """Convert resample weights to the row numbers and resample number of each
+    resampled row.
+
+    Parameters
+    ----------
+    weights : numpy.ndarray
+        Weights with shape (resamples, number of rows) (see resample_weights)
+
+    Returns
+    -------
+    numpy.ndarray, numpy.ndarray
+        Row number and resample of each resampled row
+    """
+    resamples, n_rows = weights.shape
+    counts = weights.ravel()
+    rows = np.repeat(np.tile(np.arange(n_rows), resamples), counts)
+    groups = np.repeat(np.repeat(np.arange(resamples), n_rows), counts)
+    return rows, groups
+
+
+def bootstrap_run(
+    session, run_id, resamples=200, seed=0, chunk_size=100000, kernels=None
+):
+    """Calculate the label metrics of each output of a prediction run on Poisson
+    bootstrap resamples of its labelled predictions. All resamples are calculated in
+    one pass over the predictions, as groups of the metric kernels.
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session
+        ModMon database session
+    run_id : int
+        Run ID of the prediction run
+    resamples : int, optional
+        Number of resamples, by default 200
+    seed : int, optional
+        Random seed, by default 0
+    chunk_size : int, optional
+        Number of labelled predictions to read at a time, by default 100000
+    kernels : list, optional
+        Names of the metric kernels to calculate, by default None which uses all
+        kernels in modmon.metrics.kernels.KERNELS. Kernels in SKIP_KERNELS are skipped.
+
+    Returns
+    -------
+    dict
+        {metric_name: array of the metric in each resample} with the reserved metric
+        names (see modmon.metrics.utils.get_reserved_metric_name)
+    """
+    if kernels is None:
+        kernels = list(KERNELS.keys())
+    kernels = [name for name in kernels if name not in SKIP_KERNELS]
+    block_size = max(1, BLOCK_ROWS // resamples)
+
+    evaluators = {}
+    for y_pred, y_true in iter_labelled_chunks(session, run_id, chunk_size):
+        columns = y_pred.columns.intersection(y_true.columns)
+        for start in range(0, len(y_pred), block_size):
+            block_pred = y_pred.iloc[start : start + block_size]
+            block_true = y_true.iloc[start : start + block_size]
+            rows, groups = resample_indices(
+                resample_weights(block_pred.index, resamples, seed)
+            )
+            for column in columns:
+                if column not in evaluators:
+                    evaluators[column] = OutputEvaluator(kernels, resamples)
+                evaluators[column].update(
+                    block_pred[column].to_numpy()[rows],
+                    block_true[column].to_numpy()[rows],
+                    groups,
+                    resamples,
+                )
+
+    replicates = {}
+    for column, evaluator in evaluators.items():
+        if evaluator.n == 0:
+            continue
+        for metric, values in evaluator.result().items():
+            replicates[get_reserved_metric_name(metric, column)] = values
+    return replicates
+
+
+def percentile_interval(replicates, alpha=0.05):
+    """Percentile bootstrap confidence interval.
+
+    Parameters
+    ----------
+    replicates : numpy.ndarray
+        Value of the metric in each resample (NaN where it couldn't be calculated)
+    alpha : float, optional
+        Significance level, by default 0.05 for a 95% interval
+
+    Returns
+    -------
+    float, float
+        Lower and upper bounds of the interval, or None, None if the metric couldn't be
+        calculated for any resample
+    """
+    replicates = replicates[~np.isnan(replicates)]
+    if len(replicates) == 0:
+        return None, None
+    lower, upper = np.percentile(replicates, [100 * alpha / 2, 100 * (1 - alpha / 2)])
+    return float(lower), float(upper)
+
+
+def bootstrap_pvalue(replicates, reference_replicates):
+    """Two-sided bootstrap p-value for the difference between a metric on a run and
+    on the reference run being zero, from the differences between matching resamples
+    of the two runs.
+
+    Parameters
+    ----------
+    replicates : numpy.ndarray
+        Value of the metric in each resample of the run
+    reference_replicates : numpy.ndarray
+        Value of the metric in each resample of the reference run
+
+    Returns
+    -------
+    float
+        p-value, or None if the difference couldn't be calculated for any resample
+    """
+    differences = replicates - reference_replicates
+    differences = differences[~np.isnan(differences)]
+    if len(differences) == 0:
+        return None
+    n = len(differences)
+    below = (1 + np.sum(differences <= 0)) / (n + 1)
+    above = (1 + np.sum(differences >= 0)) / (n + 1)
+    return float(min(1.0, 2 * min(below, above)))
+
+
+def bootstrap_model_version(
+    session,
+    model_version,
+    runs,
+    reference_run_id=None,
+    resamples=200,
+    alpha=0.05,
+    seed=0,
+    chunk_size=100000,
+    kernels=None,
+):
+    """Calculate bootstrap confidence intervals, and p-values against the reference
+    run, for the label metrics of prediction runs of a model version.
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session
+        ModMon database session
+    model_version : modmon.schema.db.ModelVersion
+        Model version object
+    runs : list
+        (dataset_id, run_id) of each prediction run
+    reference_run_id : int, optional
+        Run ID of the reference run, by default None in which case no p-values are
+        calculated
+    resamples : int, optional
+        Number of resamples, by default 200
+    alpha : float, optional
+        Significance level of the intervals, by default 0.05
+    seed : int, optional
+        Random seed, by default 0
+    chunk_size : int, optional
+        Number of labelled predictions to read at a time, by default 100000
+    kernels : list, optional
+        Names of the metric kernels to calculate, by default None for all kernels
+
+    Returns
+    -------
+    dict
+        {(dataset_id, run_id): {metric_name: (lower, upper, pvalue)}}
+    """
+    reference_replicates = {}
+    if reference_run_id is not None:
+        reference_replicates = bootstrap_run(
+            session, reference_run_id, resamples, seed, chunk_size, kernels
+        )
+
+    results = {}
+    for dataset_id, run_id in runs:
+        if run_id == reference_run_id:
+            replicates = reference_replicates
+        else:
+            replicates = bootstrap_run(
+                session, run_id, resamples, seed, chunk_size, kernels
+            )
+        results[(dataset_id, run_id)] = {}
+        for name, values in replicates.items():
+            pvalue = None
+            if name in reference_replicates and run_id != reference_run_id:
+                pvalue = bootstrap_pvalue(values, reference_replicates[name])
+            results[(dataset_id, run_id)][name] = (
+                *percentile_interval(values, alpha),
+                pvalue,
+            )
+    return results
+
+
+def _init_worker():
+    """Discard database connections inherited from the parent process."""
+    ENGINE.dispose()
+
+
+def _bootstrap_worker(modelid, modelversion, runs, reference_run_id, kwargs):
+    """Run bootstrap_model_version in a worker process, with its own session."""
+    session = get_session()
+    try:
+        model_version = session.query(ModelVersion).get((modelid, modelversion))
+        return bootstrap_model_version(
+            session, model_version, runs, reference_run_id, **kwargs
+        )
+    finally:
+        session.close()
+
+
+def add_bootstrap_results(session, model_version, results, bootstrap_time):
+    """Save bootstrap results to the label metric scores of a model version, and record
+    when they were calculated. The session is not committed.
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session
+        ModMon database session
+    model_version : modmon.schema.db.ModelVersion
+        Model version object
+    results : dict
+        {(dataset_id, run_id): {metric_name: (lower, upper, pvalue)}} (see
+        bootstrap_model_version)
+    bootstrap_time : datetime.datetime
+        Time the calculation started
+    """
+    for (dataset_id, run_id), metrics in results.items():
+        for name, (lower, upper, pvalue) in metrics.items():
+            session.query(Score).filter(
+                Score.modelid == model_version.modelid,
+                Score.modelversion == model_version.modelversion,
+                Score.datasetid == dataset_id,
+                Score.metric == name,
+                Score.slice == OVERALL_SLICE,
+            ).update(
+                {"valuelower": lower, "valueupper": upper, "pvalue": pvalue},
+                synchronize_session=False,
+            )
+        session.query(LabelEvaluation).filter(
+            LabelEvaluation.modelid == model_version.modelid,
+            LabelEvaluation.modelversion == model_version.modelversion,
+            LabelEvaluation.datasetid == dataset_id,
+            LabelEvaluation.runid == run_id,
+        ).update({"bootstraptime": bootstrap_time}, synchronize_session=False)
+
+
+def get_runs_to_bootstrap(session, model_version, force=False):
+    """Get the prediction runs of a model version whose label metrics don't have up to
+    date confidence intervals, i.e. the latest evaluated run on each dataset if it
+    hasn't been bootstrapped since it was last evaluated.
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session
+        ModMon database session
+    model_version : modmon.schema.db.ModelVersion
+        Model version object
+    force : bool, optional
+        If True return the latest evaluated run on each dataset even if it's up to
+        date, by default False
+
+    Returns
+    -------
+    list
+        (dataset_id, run_id) of each run
+    """
+    latest = (
+        session.query(
+            LabelEvaluation.datasetid, func.max(LabelEvaluation.runid).label("runid")
+        )
+        .filter(
+            LabelEvaluation.modelid == model_version.modelid,
+            LabelEvaluation.modelversion == model_version.modelversion,
+        )
+        .group_by(LabelEvaluation.datasetid)
+        .subquery()
+    )
+    evaluations = (
+        session.query(LabelEvaluation)
+        .join(
+            latest,
+            (LabelEvaluation.datasetid == latest.c.datasetid)
+            & (LabelEvaluation.runid == latest.c.runid),
+        )
+        .filter(
+            LabelEvaluation.modelid == model_version.modelid,
+            LabelEvaluation.modelversion == model_version.modelversion,
+        )
+        .all()
+    )
+    return [
+        (evaluation.datasetid, evaluation.runid)
+        for evaluation in evaluations
+        if force
+        or evaluation.bootstraptime is None
+        or evaluation.bootstraptime < evaluation.evaluatedtime
+    ]
+
+
+def update_bootstrap_scores(
+    session=None, model_versions=None, force=False, jobs=None, verbose=True
+):
+    """Calculate bootstrap confidence intervals and p-values for the label metrics of
+    the latest evaluated prediction run of each model version on each dataset, if they
+    aren't up to date. Model versions are processed in parallel in a process pool.
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session, optional
+        ModMon database session or None in which case one will be created, by default
+        None
+    model_versions : list, optional
+        ModelVersion objects to calculate intervals for, by default None which uses all
+        model versions
+    force : bool, optional
+        If True recalculate intervals even if they're up to date, by default False
+    jobs : int, optional
+        Number of processes, by default None which uses the value in
+        modmon.config.config["bootstrap"]. If 1 model versions are processed one at a
+        time in this process.
+    verbose : bool, optional
+        If True print additional progress messages, by default True
+    """
+    if not session:
+        session = get_session()
+        close_session = True  # if session is created in function, close it in function
+    else:
+        close_session = False  # if session given, leave it open
+
+    _, resamples, alpha, seed, config_jobs = get_bootstrap_config()
+    if jobs is None:
+        jobs = config_jobs
+    _, chunk_size, kernels = get_evaluate_config()
+    kwargs = {
+        "resamples": resamples,
+        "alpha": alpha,
+        "seed": seed,
+        "chunk_size": chunk_size,
+        "kernels": kernels,
+    }
+
+    if model_versions is None:
+        model_versions = session.query(ModelVersion).all()
+    tasks = []
+    for mv in model_versions:
+        runs = get_runs_to_bootstrap(session, mv, force)
+        if runs:
+            tasks.append((mv, runs, get_reference_run(session, mv)))
+
+    def save(mv, results, bootstrap_time):
+        add_bootstrap_results(session, mv, results, bootstrap_time)
+        session.commit()
+        if verbose:
+            print(
+                f"Saved bootstrap intervals for model {mv.modelid} version "
+                f"{mv.modelversion} ({len(results)} runs)"
+            )
+
+    bootstrap_time = datetime.now()
+    if jobs == 1:
+        for mv, runs, reference_run_id in tasks:
+            results = bootstrap_model_version(
+                session, mv, runs, reference_run_id, **kwargs
+            )
+            save(mv, results, bootstrap_time)
+    elif tasks:
+        # release this process's connections so they aren't shared with the workers
+        session.commit()
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker) as pool:
+            futures = [
+                (
+                    mv,
+                    pool.submit(
+                        _bootstrap_worker,
+                        mv.modelid,
+                        mv.modelversion,
+                        runs,
+                        reference_run_id,
+                        kwargs,
+                    ),
+                )
+                for mv, runs, reference_run_id in tasks
+            ]
+            for mv, future in futures:
+                save(mv, future.result(), bootstrap_time)
+
+    if close_session:
+        session.close()
+
+
+def main():
+    """Calculate bootstrap confidence intervals for label metrics.
+
+    Available from the command-line as modmon_bootstrap
+    """
+    parser = argparse.ArgumentParser(
+        description=(
+            "Calculate bootstrap confidence intervals for the metrics calculated from "
+            "labels, and p-values for their difference from the reference run"
+        )
+    )
+    parser.add_argument(
+        "--jobs",
+        help="Number of processes to use, by default the value in the config file",
+        type=int,
+    )
+    parser.add_argument(
+        "--force",
+        help="If set, recalculate intervals even if they're up to date",
+        action="store_true",
+    )
+    args = parser.parse_args()
+
+    update_bootstrap_scores(force=args.force, jobs=args.jobs)
@@ -0,0 +1,510 @@
+"""
+Functions to measure drift in the distribution of a model version's predictions between
+a prediction run and the model version's reference run, stored as scores with reserved
+metric names.
+"""
+import argparse
+
+import numpy as np
+from sqlalchemy import func
+
+from ..config import config
+from ..db.connect import get_session
+from ..db.schema import ModelVersion, Prediction, Score
+from .read import iter_prediction_chunks
+from .sketch import align_histograms, get_many_run_sketches
+from .utils import RESERVED_PREFIX, get_reserved_metric_name, replace_reserved_scores
+
+DRIFT_STATISTICS = {
+    "psi": "Population stability index",
+    "ks": "Kolmogorov-Smirnov statistic",
+    "js": "Jensen-Shannon distance",
+}
+
+
+def get_drift_config(drift_config=None):
+    """Get the drift settings from the config file.
+
+    Parameters
+    ----------
+    drift_config : configparser.SectionProxy, optional
+        configparser section optionally containing the keys 'enabled', 'bins',
+        'psibins' and 'chunksize', by default None which uses
+        modmon.config.config["drift"] if it exists.
+
+    Returns
+    -------
+    bool, int, int, int
+        Whether drift is calculated after predictions are made, the number of
+        histogram bins used for the KS statistic and JS distance, the number of bins
+        used for the PSI, and the number of predictions to read at a time.
+    """
+    if drift_config is None:
+        drift_config = config["drift"] if "drift" in config else {}
+    enabled = drift_config.get("enabled", "True") == "True"
+    n_bins = int(drift_config.get("bins", 1000))
+    n_psi_bins = int(drift_config.get("psibins", 10))
+    chunk_size = int(drift_config.get("chunksize", 100000))
+    return enabled, n_bins, n_psi_bins, chunk_size
+
+
+def get_drift_metric_name(statistic, column):
+    """Get the reserved metric name for a drift statistic of an output column.
+
+    Parameters
+    ----------
+    statistic : str
+        Drift statistic, one of the keys of DRIFT_STATISTICS
+    column : str
+        Name of the model output
+
+    Returns
+    -------
+    str
+        Metric name with the format modmon.<statistic>.<column>
+    """
+    return get_reserved_metric_name(statistic, column)
+
+
+def get_reference_run(session, model_version):
+    """Get the prediction run that drift is measured against for a model version. This
+    is the first prediction run on the model version's test dataset if there is one,
+    otherwise the model version's first prediction run.
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session
+        ModMon database session
+    model_version : modmon.schema.db.ModelVersion
+        Model version object
+
+    Returns
+    -------
+    int or None
+        Run ID of the reference run, or None if the model version has no predictions
+    """
+    query = session.query(func.min(Prediction.runid)).filter(
+        Prediction.modelid == model_version.modelid,
+        Prediction.modelversion == model_version.modelversion,
+    )
+    run_id = query.filter(Prediction.datasetid == model_version.testdatasetid).scalar()
+    if run_id is None:
+        run_id = query.scalar()
+    return run_id
+
+
+def get_run_ranges(session, run_id, chunk_size=100000):
+    """Get the minimum and maximum of each numeric output in a prediction run.
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session
+        ModMon database session
+    run_id : int
+        Run ID of the prediction run
+    chunk_size : int, optional
+        Number of predictions to read at a time, by default 100000
+
+    Returns
+    -------
+    dict
+        {output_name: (min, max)} for outputs with at least one numeric value
+    """
+    ranges = {}
+    for chunk in iter_prediction_chunks(session, run_id, chunk_size):
+        mins = chunk.min()
+        maxs = chunk.max()
+        for column in chunk.columns:
+            if np.isnan(mins[column]):
+                continue
+            if column in ranges:
+                low, high = ranges[column]
+                ranges[column] = (min(low, mins[column]), max(high, maxs[column]))
+            else:
+                ranges[column] = (mins[column], maxs[column])
+    return ranges
+
+
+def get_bin_edges(ranges, n_bins=1000):
+    """Get equal-width histogram bin edges spanning the range of each output.
+
+    Parameters
+    ----------
+    ranges : dict
+        {output_name: (min, max)} (see get_run_ranges)
+    n_bins : int, optional
+        Number of bins, by default 1000
+
+    Returns
+    -------
+    dict
+        {output_name: array of n_bins + 1 edges}
+    """
+    edges = {}
+    for column, (low, high) in ranges.items():
+        if low == high:
+            # constant output, use a unit-width range centred on the value
+            low, high = low - 0.5, high + 0.5
+        edges[column] = np.linspace(low, high, n_bins + 1)
+    return edges
+
+
+def get_run_histograms(session, run_id, edges, chunk_size=100000):
+    """Count the predictions of a run in histogram bins, for each output. Values
+    outside the range of the bins are counted in the first or last bin.
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session
+        ModMon database session
+    run_id : int
+        Run ID of the prediction run
+    edges : dict
+        {output_name: bin edges} (see get_bin_edges)
+    chunk_size : int, optional
+        Number of predictions to read at a time, by default 100000
+
+    Returns
+    -------
+    dict
+        {output_name: array of counts in each bin}
+    """
+    counts = {
+        column: np.zeros(len(e) - 1, dtype=np.int64) for column, e in edges.items()
+    }
+    for chunk in iter_prediction_chunks(session, run_id, chunk_size):
+        for column, e in edges.items():
+            if column not in chunk.columns:
+                continue
+            x = chunk[column].to_numpy()
+            x = np.clip(x[~np.isnan(x)], e[0], e[-1])
+            counts[column] += np.histogram(x, bins=e)[0]
+    return counts
+
+
+def get_sketch_histograms(ref_sketches, new_sketches):
+    """Get the histograms of each output of two prediction runs on the same bins, from
+    their sketches.
+
+    Parameters
+    ----------
+    ref_sketches : dict
+        {output_name: ColumnSketch} for the reference run (see
+        modmon.metrics.sketch.get_run_sketches)
+    new_sketches : dict
+        {output_name: ColumnSketch} for the new run
+
+    Returns
+    -------
+    dict, dict
+        {output_name: array of counts in each bin} for the reference run and the new
+        run, for each output in the reference run. The new run's counts are all zero
+        if it doesn't have the output.
+    """
+    ref_hists = {}
+    new_hists = {}
+    for column, ref_sketch in ref_sketches.items():
+        if column in new_sketches:
+            ref_hists[column], new_hists[column] = align_histograms(
+                ref_sketch.histogram, new_sketches[column].histogram
+            )
+        else:
+            ref_hists[column] = ref_sketch.histogram.counts
+            new_hists[column] = np.zeros_like(ref_hists[column])
+    return ref_hists, new_hists
+
+
+def ks_statistic(ref_counts, new_counts):
+    """Kolmogorov-Smirnov statistic (maximum distance between the cumulative
+    distributions) calculated from binned data.
+
+    Parameters
+    ----------
+    ref_counts : numpy.ndarray
+        Counts in each bin for the reference distribution
+    new_counts : numpy.ndarray
+        Counts in the same bins for the new distribution
+
+    Returns
+    -------
+    float
+        KS statistic, between 0 (identical) and 1
+    """
+    ref_cdf = np.cumsum(ref_counts) / ref_counts.sum()
+    new_cdf = np.cumsum(new_counts) / new_counts.sum()
+    return float(np.max(np.abs(ref_cdf - new_cdf)))
+
+
+def js_distance(ref_counts, new_counts):
+    """Jensen-Shannon distance (square root of the Jensen-Shannon divergence, in bits)
+    calculated from binned data.
+
+    Parameters
+    ----------
+    ref_counts : numpy.ndarray
+        Counts in each bin for the reference distribution
+    new_counts : numpy.ndarray
+        Counts in the same bins for the new distribution
+
+    Returns
+    -------
+    float
+        JS distance, between 0 (identical) and 1
+    """
+    p = ref_counts / ref_counts.sum()
+    q = new_counts / new_counts.sum()
+    m = (p + q) / 2
+
+    def kl_divergence(a, b):
+        nonzero = a > 0
+        return np.sum(a[nonzero] * np.log2(a[nonzero] / b[nonzero]))
+
+    divergence = (kl_divergence(p, m) + kl_divergence(q, m)) / 2
+    return float(np.sqrt(max(divergence, 0.0)))
+
+
+def population_stability_index(ref_counts, new_counts, n_bins=10, epsilon=1e-4):
+    """Population stability index calculated from binned data. The fine bins are first
+    merged into n_bins bins each containing roughly the same proportion of the
+    reference distribution (e.g. deciles).
+
+    Parameters
+    ----------
+    ref_counts : numpy.ndarray
+        Counts in each fine bin for the reference distribution
+    new_counts : numpy.ndarray
+        Counts in the same bins for the new distribution
+    n_bins : int, optional
+        Number of quantile bins, by default 10
+    epsilon : float, optional
+        Minimum proportion in a bin (avoids infinite values for empty bins), by default
+        1e-4
+
+    Returns
+    -------
+    float
+        PSI, 0 for identical distributions (values above 0.25 are usually considered a
+        significant shift)
+    """
+    ref_total = ref_counts.sum()
+    # assign each fine bin to a quantile bin by the reference CDF at its midpoint
+    midpoint_cdf = (np.cumsum(ref_counts) - ref_counts / 2) / ref_total
+    groups = np.minimum((midpoint_cdf * n_bins).astype(int), n_bins - 1)
+
+    expected = np.bincount(groups, weights=ref_counts, minlength=n_bins) / ref_total
+    actual = np.bincount(groups, weights=new_counts, minlength=n_bins)
+    actual = actual / new_counts.sum()
+    expected = np.maximum(expected, epsilon)
+    actual = np.maximum(actual, epsilon)
+    return float(np.sum((actual - expected) * np.log(actual / expected)))
+
+
+def compute_drift(
+    session, run_id, reference_run_id, n_bins=1000, n_psi_bins=10, chunk_size=100000
+):
+    """Calculate the PSI, KS statistic and JS distance of each numeric output in a
+    prediction run compared to a reference run. If both runs have sketches (see
+    modmon.metrics.sketch) their histograms are used. Otherwise each run is read in
+    chunks, so memory use depends on chunk_size rather than the size of the runs.
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session
+        ModMon database session
+    run_id : int
+        Run ID of the prediction run to measure drift for
+    reference_run_id : int
+        Run ID of the prediction run to compare against
+    n_bins : int, optional
+        Number of histogram bins spanning the range of the reference run, by default
+        1000
+    n_psi_bins : int, optional
+        Number of quantile bins for the PSI, by default 10
+    chunk_size : int, optional
+        Number of predictions to read at a time, by default 100000
+
+    Returns
+    -------
+    dict
+        {metric_name: value} with the reserved metric names for each statistic and
+        output (see get_drift_metric_name)
+    """
+    sketches = get_many_run_sketches(session, [run_id, reference_run_id])
+    if run_id in sketches and reference_run_id in sketches:
+        ref_hists, new_hists = get_sketch_histograms(
+            sketches[reference_run_id], sketches[run_id]
+        )
+    else:
+        edges = get_bin_edges(
+            get_run_ranges(session, reference_run_id, chunk_size), n_bins
+        )
+        ref_hists = get_run_histograms(session, reference_run_id, edges, chunk_size)
+        new_hists = get_run_histograms(session, run_id, edges, chunk_size)
+
+    drift = {}
+    for column, ref_counts in ref_hists.items():
+        new_counts = new_hists[column]
+        if new_counts.sum() == 0:
+            continue
+        statistics = {
+            "psi": population_stability_index(ref_counts, new_counts, n_psi_bins),
+            "ks": ks_statistic(ref_counts, new_counts),
+            "js": js_distance(ref_counts, new_counts),
+        }
+        for statistic, value in statistics.items():
+            drift[get_drift_metric_name(statistic, column)] = value
+    return drift
+
+
+def add_drift_scores(
+    session, model_version, dataset_id, run_id, run_time, reference_run_id=None
+):
+    """Calculate drift for a prediction run and add it to the score table, replacing
+    any drift scores previously calculated for the same model version and dataset.
+    The session is not committed.
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session
+        ModMon database session
+    model_version : modmon.schema.db.ModelVersion
+        Model version object
+    dataset_id : int
+        ID of the dataset the predictions were made for
+    run_id : int
+        Run ID of the prediction run
+    run_time : str or datetime.datetime
+        Time of the prediction run
+    reference_run_id : int, optional
+        Run ID of the prediction run to compare against, by default None which uses
+        get_reference_run
+
+    Returns
+    -------
+    dict
+        {metric_name: value} of the added drift scores (empty if run_id is the
+        reference run).
+    """
+    _, n_bins, n_psi_bins, chunk_size = get_drift_config()
+    if reference_run_id is None:
+        reference_run_id = get_reference_run(session, model_version)
+    if reference_run_id is None or reference_run_id == run_id:
+        return {}
+
+    drift = compute_drift(
+        session, run_id, reference_run_id, n_bins, n_psi_bins, chunk_size
+    )
+    descriptions = {
+        statistic: f"{description} vs reference run"
+        for statistic, description in DRIFT_STATISTICS.items()
+    }
+    return replace_reserved_scores(
+        session, model_version, dataset_id, run_time, drift, descriptions
+    )
+
+
+def update_drift_scores(
+    session=None, model_versions=None, force=False, dataset_ids=None, verbose=True
+):
+    """Calculate drift for the latest prediction run of each model version on each
+    dataset, if it hasn't already been calculated.
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session, optional
+        ModMon database session or None in which case one will be created, by default
+        None
+    model_versions : list, optional
+        ModelVersion objects to calculate drift for, by default None which uses all
+        model versions
+    force : bool, optional
+        If True recalculate drift even if it's up to date, by default False
+    dataset_ids : list, optional
+        Only calculate drift on these datasets, by default None (all datasets)
+    verbose : bool, optional
+        If True print additional progress messages, by default True
+    """
+    if not session:
+        session = get_session()
+        close_session = True  # if session is created in function, close it in function
+    else:
+        close_session = False  # if session given, leave it open
+
+    if model_versions is None:
+        model_versions = session.query(ModelVersion).all()
+
+    for mv in model_versions:
+        reference_run_id = get_reference_run(session, mv)
+        if reference_run_id is None:
+            continue
+
+        latest_runs = (
+            session.query(
+                Prediction.datasetid,
+                func.max(Prediction.runid),
+                func.max(Prediction.runtime),
+            )
+            .filter(
+                Prediction.modelid == mv.modelid,
+                Prediction.modelversion == mv.modelversion,
+            )
+            .group_by(Prediction.datasetid)
+            .all()
+        )
+        if dataset_ids is not None:
+            latest_runs = [run for run in latest_runs if run[0] in dataset_ids]
+        # time of the latest drift scores on each dataset
+        drift_times = dict(
+            session.query(Score.datasetid, func.max(Score.runtime))
+            .filter(
+                Score.modelid == mv.modelid,
+                Score.modelversion == mv.modelversion,
+                Score.metric.like(f"{RESERVED_PREFIX}psi.%"),
+            )
+            .group_by(Score.datasetid)
+            .all()
+        )
+
+        for dataset_id, run_id, run_time in latest_runs:
+            if run_id == reference_run_id:
+                continue
+            if (
+                not force
+                and dataset_id in drift_times
+                and drift_times[dataset_id] >= run_time
+            ):
+                continue
+            if verbose:
+                print(
+                    f"Calculating drift for model {mv.modelid} version "
+                    f"{mv.modelversion} on dataset {dataset_id} (run {run_id} vs "
+                    f"reference run {reference_run_id})"
+                )
+            add_drift_scores(
+                session, mv, dataset_id, run_id, run_time, reference_run_id
+            )
+            session.commit()
+
+    if close_session:
+        session.close()
+
+
+def main():
+    """Calculate prediction drift for all model versions in the database.
+
+    Available from the command-line as modmon_drift
+    """
+    parser = argparse.ArgumentParser(
+        description=(
+            "Calculate drift in the predictions of each model version compared to its "
+            "reference run"
+        )
+    )
+    parser.add_argument(
+        "--force",
+        help="If set, recalculate drift even if it's already been calculated",
+        action="store_true",
+    )
+    args = parser.parse_args()
+
+    update_drift_scores(force=args.force)
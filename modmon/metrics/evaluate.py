@@ -0,0 +1,326 @@
+"""
+Functions to calculate the performance of prediction runs from their stored predictions
+and the ground-truth labels loaded for their datasets, without re-running the models.
+Metrics are only recalculated for runs whose labels have changed since they were last
+evaluated.
+"""
+import argparse
+from datetime import datetime
+
+import numpy as np
+from sqlalchemy import Text, and_, cast, func, select
+
+from ..config import config
+from ..db.connect import get_session
+from ..db.schema import Label, LabelEvaluation, ModelVersion, Prediction
+from .kernels import OutputEvaluator, get_metric_descriptions
+from .read import to_numeric_frame, values_to_frame
+from .slices import SliceGrouper, get_slice_definitions
+from .utils import get_reserved_metric_name, replace_reserved_scores
+
+
+def get_evaluate_config(evaluate_config=None):
+    """Get the label metric settings from the config file.
+
+    Parameters
+    ----------
+    evaluate_config : configparser.SectionProxy, optional
+        configparser section optionally containing the keys 'enabled', 'chunksize'
+        and 'kernels', by default None which uses modmon.config.config["labels"] if
+        it exists.
+
+    Returns
+    -------
+    bool, int, list
+        Whether label metrics are updated after predictions are made, the number of
+        labelled predictions to read at a time, and the names of the metric kernels to
+        calculate (None for all kernels in modmon.metrics.kernels.KERNELS).
+    """
+    if evaluate_config is None:
+        evaluate_config = config["labels"] if "labels" in config else {}
+    enabled = evaluate_config.get("enabled", "True") == "True"
+    chunk_size = int(evaluate_config.get("chunksize", 100000))
+    kernels = evaluate_config.get("kernels")
+    if kernels is not None:
+        kernels = [name.strip() for name in kernels.split(",") if name.strip()]
+    return enabled, chunk_size, kernels
+
+
+def iter_labelled_chunks(session, run_id, chunk_size=100000, numeric=True):
+    """Read the predictions of a run that have labels, joined with their labels, in
+    chunks.
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session
+        ModMon database session
+    run_id : int
+        Run ID of the prediction run
+    chunk_size : int, optional
+        Number of labelled predictions per chunk, by default 100000
+    numeric : bool, optional
+        If True convert all values to floats, by default True
+
+    Yields
+    ------
+    pandas.DataFrame, pandas.DataFrame
+        Chunk of predictions and their labels in the same order, each with a column
+        for each output and indexed by record ID. If numeric is True non-numeric values
+        are NaN.
+    """
+    predictions = Prediction.__table__
+    labels = Label.__table__
+    result = session.execute(
+        select(
+            [
+                predictions.c.recordid,
+                cast(predictions.c["values"], Text),
+                cast(labels.c["values"], Text),
+            ]
+        )
+        .select_from(
+            predictions.join(
+                labels,
+                and_(
+                    labels.c.datasetid == predictions.c.datasetid,
+                    labels.c.recordid == predictions.c.recordid,
+                ),
+            )
+        )
+        .where(predictions.c.runid == run_id)
+        .execution_options(stream_results=True)
+    )
+    while True:
+        rows = result.fetchmany(chunk_size)
+        if not rows:
+            break
+        record_ids = [record_id for record_id, _, _ in rows]
+        prediction_frame = values_to_frame(
+            [prediction for _, prediction, _ in rows], numeric=numeric
+        )
+        label_frame = values_to_frame([label for _, _, label in rows], numeric=numeric)
+        prediction_frame.index = record_ids
+        label_frame.index = record_ids
+        yield prediction_frame, label_frame
+
+
+def evaluate_run(session, run_id, chunk_size=100000, kernels=None, slices=None):
+    """Calculate metrics for each numeric output of a prediction run that has labels,
+    reading the labelled predictions in chunks. Metrics for the whole dataset and for
+    each slice are calculated in the same pass, by grouping the rows of each chunk.
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session
+        ModMon database session
+    run_id : int
+        Run ID of the prediction run
+    chunk_size : int, optional
+        Number of labelled predictions to read at a time, by default 100000
+    kernels : list, optional
+        Names of the metric kernels to calculate, by default None which uses all
+        kernels in modmon.metrics.kernels.KERNELS
+    slices : list, optional
+        SliceDefinition objects of the slices to calculate metrics for (see
+        modmon.metrics.slices), by default None which only calculates metrics for the
+        whole dataset
+
+    Returns
+    -------
+    dict, dict, int
+        {metric_name: value} with the reserved metric names for each metric and
+        output (see modmon.metrics.utils.get_reserved_metric_name),
+        {(metric_name, slice_label): value} for each slice, and the number of
+        predictions that have labels. Metrics that are undefined for a slice (e.g. AUC
+        for a slice with one class) are left out.
+    """
+    grouper = SliceGrouper(slices or [])
+    evaluators = {}
+    n_labels = 0
+    for predictions, labels in iter_labelled_chunks(
+        session, run_id, chunk_size, numeric=False
+    ):
+        n_labels += len(predictions)
+        rows, groups = grouper.assign(predictions, labels)
+        y_pred = to_numeric_frame(predictions)
+        y_true = to_numeric_frame(labels)
+        for column in y_pred.columns.intersection(y_true.columns):
+            if column not in evaluators:
+                evaluators[column] = OutputEvaluator(kernels)
+            evaluators[column].update(
+                y_pred[column].to_numpy()[rows],
+                y_true[column].to_numpy()[rows],
+                groups,
+                grouper.n_groups,
+            )
+
+    values = {}
+    sliced_values = {}
+    for column, evaluator in evaluators.items():
+        if evaluator.n == 0:
+            continue
+        for metric, group_values in evaluator.result().items():
+            name = get_reserved_metric_name(metric, column)
+            for group, value in enumerate(group_values):
+                if np.isnan(value):
+                    continue
+                if group == 0:
+                    values[name] = float(value)
+                else:
+                    sliced_values[(name, grouper.labels[group])] = float(value)
+    return values, sliced_values, n_labels
+
+
+def add_label_scores(session, model_version, dataset_id, run_id, run_time):
+    """Calculate the label metrics of a prediction run and add them to the score
+    table, replacing any label metrics previously calculated for the same model
+    version and dataset, and record that the run has been evaluated. The session is
+    not committed.
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session
+        ModMon database session
+    model_version : modmon.schema.db.ModelVersion
+        Model version object
+    dataset_id : int
+        ID of the dataset the predictions were made for
+    run_id : int
+        Run ID of the prediction run
+    run_time : str or datetime.datetime
+        Time of the prediction run
+
+    Returns
+    -------
+    dict
+        {metric_name: value} of the added scores for the whole dataset
+    """
+    evaluated_time = datetime.now()
+    _, chunk_size, kernels = get_evaluate_config()
+    slices = get_slice_definitions(session, model_version.model.questionid)
+    values, sliced_values, n_labels = evaluate_run(
+        session, run_id, chunk_size, kernels, slices
+    )
+    values = replace_reserved_scores(
+        session,
+        model_version,
+        dataset_id,
+        run_time,
+        values,
+        get_metric_descriptions(kernels),
+        sliced_values,
+    )
+    session.merge(
+        LabelEvaluation(
+            modelid=model_version.modelid,
+            modelversion=model_version.modelversion,
+            datasetid=dataset_id,
+            runid=run_id,
+            evaluatedtime=evaluated_time,
+            nlabels=n_labels,
+        )
+    )
+    return values
+
+
+def update_label_scores(
+    session=None, model_versions=None, force=False, dataset_ids=None, verbose=True
+):
+    """Calculate label metrics for the latest prediction run of each model version on
+    each dataset that has labels, if labels have been added since the run was last
+    evaluated.
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session, optional
+        ModMon database session or None in which case one will be created, by default
+        None
+    model_versions : list, optional
+        ModelVersion objects to calculate metrics for, by default None which uses all
+        model versions
+    force : bool, optional
+        If True recalculate metrics even if they're up to date, by default False
+    dataset_ids : list, optional
+        Only calculate metrics on these datasets, by default None (all datasets with
+        labels)
+    verbose : bool, optional
+        If True print additional progress messages, by default True
+    """
+    if not session:
+        session = get_session()
+        close_session = True  # if session is created in function, close it in function
+    else:
+        close_session = False  # if session given, leave it open
+
+    if model_versions is None:
+        model_versions = session.query(ModelVersion).all()
+
+    # time labels were last added to each dataset
+    label_times = dict(
+        session.query(Label.datasetid, func.max(Label.loadtime))
+        .group_by(Label.datasetid)
+        .all()
+    )
+
+    for mv in model_versions:
+        latest_runs = (
+            session.query(
+                Prediction.datasetid,
+                func.max(Prediction.runid),
+                func.max(Prediction.runtime),
+            )
+            .filter(
+                Prediction.modelid == mv.modelid,
+                Prediction.modelversion == mv.modelversion,
+                Prediction.datasetid.in_(list(label_times.keys())),
+            )
+            .group_by(Prediction.datasetid)
+            .all()
+        )
+        evaluated_times = dict(
+            session.query(LabelEvaluation.runid, LabelEvaluation.evaluatedtime).filter(
+                LabelEvaluation.modelid == mv.modelid,
+                LabelEvaluation.modelversion == mv.modelversion,
+            )
+        )
+
+        for dataset_id, run_id, run_time in latest_runs:
+            if dataset_ids is not None and dataset_id not in dataset_ids:
+                continue
+            if (
+                not force
+                and run_id in evaluated_times
+                and evaluated_times[run_id] >= label_times[dataset_id]
+            ):
+                continue
+            if verbose:
+                print(
+                    f"Calculating label metrics for model {mv.modelid} version "
+                    f"{mv.modelversion} on dataset {dataset_id} (run {run_id})"
+                )
+            add_label_scores(session, mv, dataset_id, run_id, run_time)
+            session.commit()
+
+    if close_session:
+        session.close()
+
+
+def main():
+    """Calculate metrics from labels for prediction runs with new labels.
+
+    Available from the command-line as modmon_labels_score
+    """
+    parser = argparse.ArgumentParser(
+        description=(
+            "Calculate metrics from the stored predictions and labels, for prediction "
+            "runs whose labels have changed since they were last evaluated"
+        )
+    )
+    parser.add_argument(
+        "--force",
+        help="If set, recalculate metrics for all prediction runs with labels",
+        action="store_true",
+    )
+    args = parser.parse_args()
+
+    update_label_scores(force=args.force)
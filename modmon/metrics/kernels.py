@@ -0,0 +1,682 @@
+"""
+Vectorised metric kernels that calculate model performance from predictions and labels.
+Each kernel is updated with chunks of data and can be merged with other kernels of the
+same type, so metrics can be calculated for any amount of data in one pass (and in
+parallel). Kernels calculate metrics for many groups of rows (e.g. slices of the data)
+at once, with the totals for every group updated in the same vectorised operations.
+Kernels are registered by name in KERNELS, and each defines the metrics it calculates,
+which are saved with the reserved metric names modmon.<metric>.<output>.
+"""
+import numpy as np
+
+# {name: kernel class} of all registered kernels (see register_kernel)
+KERNELS = {}
+# Probabilities are clipped to [EPSILON, 1 - EPSILON] when calculating the log loss
+EPSILON = 1e-15
+
+
+def register_kernel(kernel):
+    """Class decorator adding a kernel to KERNELS.
+
+    Parameters
+    ----------
+    kernel : class
+        Subclass of MetricKernel with a unique name
+
+    Returns
+    -------
+    class
+        The kernel class, unchanged
+    """
+    if kernel.name in KERNELS:
+        raise ValueError(f"A kernel called {kernel.name} is already registered")
+    KERNELS[kernel.name] = kernel
+    return kernel
+
+
+def get_kernels(names=None):
+    """Create new instances of registered kernels.
+
+    Parameters
+    ----------
+    names : list, optional
+        Names of the kernels to create, by default None which creates all registered
+        kernels
+
+    Returns
+    -------
+    dict
+        {name: kernel instance}
+
+    Raises
+    ------
+    KeyError
+        If a name is not a registered kernel
+    """
+    if names is None:
+        names = list(KERNELS.keys())
+    unknown = [name for name in names if name not in KERNELS]
+    if unknown:
+        raise KeyError(f"Unknown metric kernels {unknown}, expected {list(KERNELS)}")
+    return {name: KERNELS[name]() for name in names}
+
+
+def get_metric_descriptions(names=None):
+    """Get the descriptions of the metrics calculated by registered kernels, used to
+    add the metrics to the metric table.
+
+    Parameters
+    ----------
+    names : list, optional
+        Names of the kernels, by default None which uses all registered kernels
+
+    Returns
+    -------
+    dict
+        {metric: description}
+    """
+    if names is None:
+        names = list(KERNELS.keys())
+    descriptions = {}
+    for name in names:
+        descriptions.update(KERNELS[name].metrics)
+    return descriptions
+
+
+def is_binary(y_pred, y_true):
+    """Check whether labels and predictions are suitable for binary classification
+    metrics.
+
+    Parameters
+    ----------
+    y_pred : numpy.ndarray
+        Predicted values
+    y_true : numpy.ndarray
+        Labels
+
+    Returns
+    -------
+    bool
+        True if all the labels are 0 or 1 and all the predictions are probabilities
+        between 0 and 1.
+    """
+    return bool(
+        ((y_true == 0) | (y_true == 1)).all() and ((y_pred >= 0) & (y_pred <= 1)).all()
+    )
+
+
+def divide(numerator, denominator):
+    """Divide arrays element-wise, with NaN where the denominator is zero.
+
+    Parameters
+    ----------
+    numerator : numpy.ndarray
+        Numerator
+    denominator : numpy.ndarray
+        Denominator
+
+    Returns
+    -------
+    numpy.ndarray
+        numerator / denominator
+    """
+    numerator = np.asarray(numerator, dtype=float)
+    denominator = np.asarray(denominator, dtype=float)
+    result = np.full(np.broadcast(numerator, denominator).shape, np.nan)
+    np.divide(numerator, denominator, out=result, where=denominator != 0)
+    return result
+
+
+class MetricKernel:
+    """Base class for metric kernels. Subclasses set name and metrics, and keep running
+    totals for each group in the dict self.totals (arrays whose first dimension is the
+    group), which are added together when kernels are merged.
+    """
+
+    # name of the kernel in KERNELS
+    name = None
+    # {metric: description} of the metrics returned by result
+    metrics = {}
+    # whether the metrics are only valid for binary labels and probability predictions
+    binary = False
+
+    def __init__(self, n_groups=1):
+        """Initialise an empty kernel.
+
+        Parameters
+        ----------
+        n_groups : int, optional
+            Number of groups to calculate metrics for, by default 1
+        """
+        self.n_groups = n_groups
+        self.totals = {}
+
+    def resize(self, n_groups):
+        """Increase the number of groups, with empty totals for the new groups.
+
+        Parameters
+        ----------
+        n_groups : int
+            New number of groups
+        """
+        if n_groups <= self.n_groups:
+            return
+        for key, value in self.totals.items():
+            padding = [(0, n_groups - self.n_groups)] + [(0, 0)] * (value.ndim - 1)
+            self.totals[key] = np.pad(value, padding)
+        self.n_groups = n_groups
+
+    def add(self, **totals):
+        """Add values to the running totals.
+
+        Parameters
+        ----------
+        **totals
+            {name: array} to add to self.totals, with a value (or row) for each group
+        """
+        for key, value in totals.items():
+            if key in self.totals:
+                self.totals[key] = self.totals[key] + value
+            else:
+                self.totals[key] = value
+
+    def group_sum(self, groups, values=None):
+        """Sum values in each group.
+
+        Parameters
+        ----------
+        groups : numpy.ndarray
+            Group of each row, integers from 0 to n_groups - 1
+        values : numpy.ndarray, optional
+            Value of each row, by default None which counts the rows in each group
+
+        Returns
+        -------
+        numpy.ndarray
+            Sum for each group
+        """
+        return np.bincount(groups, weights=values, minlength=self.n_groups).astype(
+            float
+        )
+
+    def group_bin_count(self, groups, bins, n_bins, values=None):
+        """Sum values in each bin of each group.
+
+        Parameters
+        ----------
+        groups : numpy.ndarray
+            Group of each row, integers from 0 to n_groups - 1
+        bins : numpy.ndarray
+            Bin of each row, integers from 0 to n_bins - 1
+        n_bins : int
+            Number of bins
+        values : numpy.ndarray, optional
+            Value of each row, by default None which counts the rows in each bin
+
+        Returns
+        -------
+        numpy.ndarray
+            Array with shape (n_groups, n_bins)
+        """
+        counts = np.bincount(
+            groups * n_bins + bins, weights=values, minlength=self.n_groups * n_bins
+        )
+        return counts.reshape(self.n_groups, n_bins)
+
+    def update(self, y_pred, y_true, groups):
+        """Update the kernel with a chunk of data.
+
+        Parameters
+        ----------
+        y_pred : numpy.ndarray
+            Predicted values, with no missing values
+        y_true : numpy.ndarray
+            Labels in the same order as y_pred, with no missing values
+        groups : numpy.ndarray
+            Group of each row, integers from 0 to n_groups - 1
+        """
+        raise NotImplementedError
+
+    def merge(self, other):
+        """Merge another kernel of the same type (and for the same groups) into this
+        one.
+
+        Parameters
+        ----------
+        other : MetricKernel
+            Kernel to merge
+        """
+        self.resize(other.n_groups)
+        other.resize(self.n_groups)
+        self.add(**other.totals)
+
+    def result(self):
+        """Calculate the kernel's metrics for each group.
+
+        Returns
+        -------
+        dict
+            {metric: array} for the metrics in self.metrics, with the value for each
+            group (NaN for groups where the metric can't be calculated)
+        """
+        raise NotImplementedError
+
+    def get(self, key, *shape):
+        """Get a running total, or zeros if there's no data yet.
+
+        Parameters
+        ----------
+        key : str
+            Name of the total
+        *shape : int
+            Size of the dimensions after the group dimension, if any
+
+        Returns
+        -------
+        numpy.ndarray
+            Total for each group
+        """
+        if key in self.totals:
+            return self.totals[key]
+        return np.zeros((self.n_groups,) + shape)
+
+
+@register_kernel
+class CountKernel(MetricKernel):
+    """Number of labelled predictions."""
+
+    name = "count"
+    metrics = {"n": "Number of labelled predictions"}
+
+    def update(self, y_pred, y_true, groups):
+        self.add(n=self.group_sum(groups))
+
+    def result(self):
+        return {"n": self.get("n")}
+
+
+@register_kernel
+class RegressionKernel(MetricKernel):
+    """Mean absolute error, mean squared error, root mean squared error, mean error
+    (bias) and coefficient of determination (R squared).
+    """
+
+    name = "regression"
+    metrics = {
+        "mae": "Mean absolute error",
+        "mse": "Mean squared error",
+        "rmse": "Root mean squared error",
+        "bias": "Mean error (prediction - label)",
+        "r2": "Coefficient of determination (R squared)",
+    }
+
+    def update(self, y_pred, y_true, groups):
+        error = y_pred - y_true
+        self.add(
+            n=self.group_sum(groups),
+            abs_error=self.group_sum(groups, np.abs(error)),
+            error=self.group_sum(groups, error),
+            sq_error=self.group_sum(groups, error * error),
+            y=self.group_sum(groups, y_true),
+            y_sq=self.group_sum(groups, y_true * y_true),
+        )
+
+    def result(self):
+        n = self.get("n")
+        mse = divide(self.get("sq_error"), n)
+        variance = divide(self.get("y_sq"), n) - divide(self.get("y"), n) ** 2
+        # variance is only positive (to within rounding) if the labels aren't constant
+        variance[variance <= 1e-12 * np.abs(divide(self.get("y_sq"), n))] = 0
+        return {
+            "mae": divide(self.get("abs_error"), n),
+            "mse": mse,
+            "rmse": np.sqrt(mse),
+            "bias": divide(self.get("error"), n),
+            "r2": 1 - divide(mse, variance),
+        }
+
+
+@register_kernel
+class AccuracyKernel(MetricKernel):
+    """Accuracy of binary predictions, with probabilities thresholded at 0.5."""
+
+    name = "accuracy"
+    metrics = {"accuracy": "Accuracy (probabilities thresholded at 0.5)"}
+    binary = True
+
+    def update(self, y_pred, y_true, groups):
+        correct = (y_pred >= 0.5) == (y_true == 1)
+        self.add(n=self.group_sum(groups), correct=self.group_sum(groups, correct))
+
+    def result(self):
+        return {"accuracy": divide(self.get("correct"), self.get("n"))}
+
+
+@register_kernel
+class LogLossKernel(MetricKernel):
+    """Mean log loss (binary cross-entropy) of predicted probabilities."""
+
+    name = "logloss"
+    metrics = {"logloss": "Log loss"}
+    binary = True
+
+    def update(self, y_pred, y_true, groups):
+        p = np.clip(y_pred, EPSILON, 1 - EPSILON)
+        # only take the log of the probability of the true class
+        log_loss = -np.log(np.where(y_true == 1, p, 1 - p))
+        self.add(n=self.group_sum(groups), log_loss=self.group_sum(groups, log_loss))
+
+    def result(self):
+        return {"logloss": divide(self.get("log_loss"), self.get("n"))}
+
+
+@register_kernel
+class BrierKernel(MetricKernel):
+    """Brier score (mean squared error of predicted probabilities)."""
+
+    name = "brier"
+    metrics = {"brier": "Brier score"}
+    binary = True
+
+    def update(self, y_pred, y_true, groups):
+        error = y_pred - y_true
+        self.add(
+            n=self.group_sum(groups), sq_error=self.group_sum(groups, error * error)
+        )
+
+    def result(self):
+        return {"brier": divide(self.get("sq_error"), self.get("n"))}
+
+
+@register_kernel
+class ConfusionKernel(MetricKernel):
+    """Confusion matrix of binary predictions (thresholded at 0.5), and the precision,
+    recall, specificity and F1 score calculated from it.
+    """
+
+    name = "confusion"
+    metrics = {
+        "precision": "Precision (positive predictive value)",
+        "recall": "Recall (sensitivity)",
+        "specificity": "Specificity (true negative rate)",
+        "f1": "F1 score",
+    }
+    binary = True
+
+    def update(self, y_pred, y_true, groups):
+        # cells in the order tn, fp, fn, tp
+        cells = 2 * (y_true == 1) + (y_pred >= 0.5)
+        self.add(matrix=self.group_bin_count(groups, cells, 4))
+
+    @property
+    def matrix(self):
+        """Confusion matrix of each group, with shape (n_groups, 2, 2). Rows are labels
+        and columns are predictions, i.e. [[tn, fp], [fn, tp]].
+        """
+        return self.get("matrix", 4).reshape(self.n_groups, 2, 2)
+
+    def result(self):
+        tn, fp, fn, tp = self.get("matrix", 4).T
+        return {
+            "precision": divide(tp, tp + fp),
+            "recall": divide(tp, tp + fn),
+            "specificity": divide(tn, tn + fp),
+            "f1": divide(2 * tp, 2 * tp + fp + fn),
+        }
+
+
+@register_kernel
+class CalibrationKernel(MetricKernel):
+    """Calibration of predicted probabilities in equal-width bins, summarised as the
+    expected calibration error (the mean absolute difference between the mean predicted
+    probability and the fraction of positive labels in each bin, weighted by the number
+    of predictions in the bin).
+    """
+
+    name = "calibration"
+    metrics = {"ece": "Expected calibration error (10 bins)"}
+    binary = True
+    n_bins = 10
+
+    def update(self, y_pred, y_true, groups):
+        bins = np.minimum((y_pred * self.n_bins).astype(np.int64), self.n_bins - 1)
+        self.add(
+            count=self.group_bin_count(groups, bins, self.n_bins),
+            predicted=self.group_bin_count(groups, bins, self.n_bins, y_pred),
+            positive=self.group_bin_count(groups, bins, self.n_bins, y_true),
+        )
+
+    @property
+    def bins(self):
+        """Calibration curve of each group: the number of predictions, mean predicted
+        probability and fraction of positive labels in each bin (NaN for empty bins).
+
+        Returns
+        -------
+        numpy.ndarray, numpy.ndarray, numpy.ndarray
+            Count, mean predicted probability and fraction of positives in each bin,
+            each with shape (n_groups, n_bins)
+        """
+        count = self.get("count", self.n_bins)
+        predicted = divide(self.get("predicted", self.n_bins), count)
+        positive = divide(self.get("positive", self.n_bins), count)
+        return count, predicted, positive
+
+    def result(self):
+        count, predicted, positive = self.bins
+        error = np.nan_to_num(np.abs(predicted - positive))
+        return {"ece": divide((count * error).sum(axis=1), count.sum(axis=1))}
+
+
+@register_kernel
+class AUCKernel(MetricKernel):
+    """Area under the ROC curve, calculated from the ranks of the predictions. The
+    number of positive and negative labels is counted for each distinct prediction in
+    each group, in a table sorted by group and prediction that each chunk (or merged
+    kernel) is sorted into, so the ranks are exact. If the table grows beyond
+    max_values rows, the predictions of groups with more than their share of rows are
+    merged into quantile buckets (each with an equal number of predictions), and
+    predictions in the same bucket are treated as tied. Memory use is then bounded,
+    and the resolution of the ranks still follows the distribution of the predictions
+    (e.g. for models that only predict small probabilities).
+    """
+
+    name = "auc"
+    metrics = {"auc": "Area under the ROC curve"}
+    binary = True
+    # maximum number of (group, prediction) rows in the table before predictions are
+    # merged into quantile buckets
+    max_values = 1_000_000
+
+    def __init__(self, n_groups=1):
+        super().__init__(n_groups)
+        self.table = {
+            "group": np.zeros(0, dtype=np.int64),
+            "value": np.zeros(0),
+            "positives": np.zeros(0),
+            "negatives": np.zeros(0),
+        }
+
+    def update(self, y_pred, y_true, groups):
+        positives = (y_true == 1).astype(float)
+        self.extend(
+            {
+                "group": np.asarray(groups, dtype=np.int64),
+                "value": np.asarray(y_pred, dtype=float),
+                "positives": positives,
+                "negatives": 1 - positives,
+            }
+        )
+
+    def merge(self, other):
+        self.resize(other.n_groups)
+        other.resize(self.n_groups)
+        self.extend(other.table)
+
+    def extend(self, table):
+        """Add rows to the table, combining rows with the same group and prediction.
+
+        Parameters
+        ----------
+        table : dict
+            {column: array} with the same columns as self.table, in any order
+        """
+        table = {key: np.concatenate([self.table[key], table[key]]) for key in table}
+        order = np.lexsort((table["value"], table["group"]))
+        table = {key: value[order] for key, value in table.items()}
+        group = table["group"]
+        value = table["value"]
+        changed = (group[1:] != group[:-1]) | (value[1:] != value[:-1])
+        self.table = self.combine(table, changed)
+        if len(self.table["value"]) > self.max_values:
+            self.coarsen()
+
+    @staticmethod
+    def combine(table, changed):
+        """Combine consecutive rows of a sorted table into one row, keeping the
+        smallest prediction of each.
+
+        Parameters
+        ----------
+        table : dict
+            {column: array} sorted by group and prediction
+        changed : numpy.ndarray
+            Boolean array with one fewer element than the table, True where a row
+            starts a new combined row
+
+        Returns
+        -------
+        dict
+            {column: array} of the combined rows
+        """
+        if len(table["value"]) == 0:
+            return table
+        starts = np.flatnonzero(np.concatenate([[True], changed]))
+        return {
+            "group": table["group"][starts],
+            "value": table["value"][starts],
+            "positives": np.add.reduceat(table["positives"], starts),
+            "negatives": np.add.reduceat(table["negatives"], starts),
+        }
+
+    def coarsen(self):
+        """Merge the predictions of groups with more than their share of the table's
+        rows into quantile buckets, so the table has at most half of max_values rows.
+        """
+        group = self.table["group"]
+        n_groups = max(self.n_groups, int(group.max()) + 1)
+        budget = max(self.max_values // (2 * n_groups), 1)
+        count = self.table["positives"] + self.table["negatives"]
+        group_total = np.bincount(group, weights=count, minlength=n_groups)
+        group_start = (np.cumsum(group_total) - group_total)[group]
+        # fraction of the group's predictions below each row
+        quantile = divide(np.cumsum(count) - count - group_start, group_total[group])
+        bucket = np.floor(quantile * budget)
+        # only merge predictions in groups with more rows than their share
+        large = np.bincount(group, minlength=n_groups)[group] > budget
+        key = np.where(large, bucket, np.arange(len(group)))
+        changed = (group[1:] != group[:-1]) | (key[1:] != key[:-1])
+        self.table = self.combine(self.table, changed)
+
+    def result(self):
+        group = self.table["group"]
+        positives = self.table["positives"]
+        negatives = self.table["negatives"]
+        n_positives = self.group_sum(group, positives)
+        n_negatives = self.group_sum(group, negatives)
+        # positives rank above all negatives in their group with lower predictions,
+        # and tie with negatives with equal predictions
+        negatives_below = (
+            np.cumsum(negatives)
+            - negatives
+            - (np.cumsum(n_negatives) - n_negatives)[group]
+        )
+        wins = self.group_sum(group, positives * (negatives_below + negatives / 2))
+        return {"auc": divide(wins, n_positives * n_negatives)}
+
+
+class OutputEvaluator:
+    """Calculates the metrics of a set of kernels for one model output, for each group
+    of rows, skipping the binary classification kernels if the data isn't binary.
+    """
+
+    def __init__(self, names=None, n_groups=1):
+        """Initialise an instance of OutputEvaluator.
+
+        Parameters
+        ----------
+        names : list, optional
+            Names of the kernels to calculate, by default None which uses all
+            registered kernels
+        n_groups : int, optional
+            Number of groups to calculate metrics for, by default 1
+        """
+        self.kernels = get_kernels(names)
+        for kernel in self.kernels.values():
+            kernel.resize(n_groups)
+        self.binary = True
+        # number of rows with both a prediction and a label
+        self.n = 0
+
+    def update(self, y_pred, y_true, groups=None, n_groups=1):
+        """Update all kernels with a chunk of data, ignoring rows where either the
+        prediction or the label is missing.
+
+        Parameters
+        ----------
+        y_pred : numpy.ndarray
+            Predicted values
+        y_true : numpy.ndarray
+            Labels in the same order as y_pred
+        groups : numpy.ndarray, optional
+            Group of each row, integers from 0 to n_groups - 1, by default None which
+            puts all rows in group 0
+        n_groups : int, optional
+            Total number of groups, by default 1. May increase between chunks.
+        """
+        keep = ~(np.isnan(y_pred) | np.isnan(y_true))
+        if groups is None:
+            groups = np.zeros(len(y_pred), dtype=np.int64)
+        if not keep.all():
+            y_pred = y_pred[keep]
+            y_true = y_true[keep]
+            groups = groups[keep]
+        if len(y_true) == 0:
+            return
+        self.n += len(y_true)
+        self.binary = self.binary and is_binary(y_pred, y_true)
+        for kernel in self.kernels.values():
+            if kernel.binary and not self.binary:
+                continue
+            kernel.resize(n_groups)
+            kernel.update(y_pred, y_true, groups)
+
+    def merge(self, other):
+        """Merge another evaluator with the same kernels (and groups) into this one.
+
+        Parameters
+        ----------
+        other : OutputEvaluator
+            Evaluator to merge
+        """
+        self.binary = self.binary and other.binary
+        self.n += other.n
+        for name, kernel in self.kernels.items():
+            kernel.merge(other.kernels[name])
+
+    def result(self):
+        """Calculate the metrics of all kernels for each group.
+
+        Returns
+        -------
+        dict
+            {metric: array} with the value for each group (NaN where it can't be
+            calculated). Binary classification metrics are only included if all the
+            labels are 0 or 1 and all the predictions are between 0 and 1.
+        """
+        metrics = {}
+        for kernel in self.kernels.values():
+            if kernel.binary and not self.binary:
+                continue
+            metrics.update(kernel.result())
+        return metrics
@@ -0,0 +1,230 @@
+"""
+Functions to load ground-truth labels for the records in a dataset into the ModMon
+database, so model performance can be calculated from the stored predictions when the
+labels become available (see modmon.metrics.evaluate).
+"""
+import argparse
+from datetime import datetime
+import json
+import os
+
+import dateparser
+import pandas as pd
+
+from ..db.connect import get_session
+from ..db.ingest import bulk_insert
+from ..db.schema import Label
+from ..models.run import create_dataset
+from .bootstrap import get_bootstrap_config, update_bootstrap_scores
+from .evaluate import update_label_scores
+
+# Name of the record ID column in labels CSV files
+RECORD_ID_COLUMN = "recordid"
+# Maximum number of record IDs in each query that deletes previous labels
+DELETE_CHUNK_SIZE = 1000
+
+
+def read_labels_file(labels_path):
+    """Load labels from a file, either a JSON file with the same format as
+    predictions.json ({record_id: {output_name: value}}), or a CSV file with a recordid
+    column and a column for each output.
+
+    Parameters
+    ----------
+    labels_path : str or Path
+        Path to the labels file, with the extension .json or .csv
+
+    Returns
+    -------
+    dict
+        Labels as {record_id: {output_name: value}}
+
+    Raises
+    ------
+    FileNotFoundError
+        If labels_path does not exist
+    ValueError
+        If labels_path is not a JSON or CSV file, or a CSV file doesn't have a recordid
+        column
+    """
+    if not os.path.exists(labels_path):
+        raise FileNotFoundError(f"{labels_path} not found.")
+
+    extension = os.path.splitext(str(labels_path))[1].lower()
+    if extension == ".json":
+        with open(labels_path, "r") as f:
+            return {str(idx): values for idx, values in json.load(f).items()}
+    if extension == ".csv":
+        labels = pd.read_csv(labels_path, dtype={RECORD_ID_COLUMN: str})
+        if RECORD_ID_COLUMN not in labels.columns:
+            raise ValueError(f"{labels_path} must have a {RECORD_ID_COLUMN} column")
+        # round trip through JSON to get native Python values, and drop missing values
+        # rather than storing them as null
+        labels = json.loads(labels.set_index(RECORD_ID_COLUMN).to_json(orient="index"))
+        return {
+            idx: {k: v for k, v in values.items() if v is not None}
+            for idx, values in labels.items()
+        }
+    raise ValueError(f"{labels_path} must be a .json or .csv file")
+
+
+def add_labels(session, dataset_id, labels, load_time=None):
+    """Add labels for records in a dataset to the database, replacing any labels
+    previously loaded for the same records. The session is not committed.
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session
+        ModMon database session
+    dataset_id : int
+        ID of the dataset the records are in
+    labels : dict
+        Labels as {record_id: {output_name: value}}
+    load_time : datetime.datetime, optional
+        Time the labels were loaded, by default None which uses the current time
+
+    Returns
+    -------
+    int
+        Number of labels added
+    """
+    if load_time is None:
+        load_time = datetime.now()
+
+    record_ids = list(labels.keys())
+    for i in range(0, len(record_ids), DELETE_CHUNK_SIZE):
+        session.query(Label).filter(
+            Label.datasetid == dataset_id,
+            Label.recordid.in_(record_ids[i : i + DELETE_CHUNK_SIZE]),
+        ).delete(synchronize_session=False)
+
+    return bulk_insert(
+        session.bind,
+        Label.__table__,
+        [
+            {
+                "datasetid": dataset_id,
+                "recordid": idx,
+                "loadtime": load_time,
+                "values": values,
+            }
+            for idx, values in labels.items()
+        ],
+        session=session,
+    )
+
+
+def ingest_labels_file(
+    labels_path,
+    dataset_id=None,
+    start_date=None,
+    end_date=None,
+    database=None,
+    update_scores=True,
+    session=None,
+    verbose=True,
+):
+    """Load labels from a file into the database, then update the label metrics of
+    prediction runs on the dataset.
+
+    Parameters
+    ----------
+    labels_path : str or Path
+        Path to the labels file (see read_labels_file)
+    dataset_id : int, optional
+        ID of the dataset the records are in, by default None in which case the
+        dataset is found (or created) from start_date, end_date and database
+    start_date : str or datetime.datetime , optional
+        Dataset start date, by default None
+    end_date : str or datetime.datetime , optional
+        Dataset end date, by default None
+    database : str, optional
+        Dataset database name, by default None
+    update_scores : bool, optional
+        If True update the metrics of prediction runs affected by the new labels (see
+        modmon.metrics.evaluate.update_label_scores), and their confidence intervals if
+        enabled (see modmon.metrics.bootstrap), by default True
+    session : sqlalchemy.orm.session.Session, optional
+        ModMon database session or None in which case one will be created, by default
+        None
+    verbose : bool, optional
+        If True print additional progress messages, by default True
+
+    Returns
+    -------
+    int
+        Number of labels added
+    """
+    if not session:
+        session = get_session()
+        close_session = True  # if session is created in function, close it in function
+    else:
+        close_session = False  # if session given, leave it open
+
+    labels = read_labels_file(labels_path)
+    if dataset_id is None:
+        dataset_id = create_dataset(
+            session, start_date=start_date, end_date=end_date, database=database
+        )
+    n_labels = add_labels(session, dataset_id, labels)
+    session.commit()
+    if verbose:
+        print(f"Added {n_labels} labels for dataset {dataset_id}")
+
+    if update_scores:
+        update_label_scores(session=session, verbose=verbose)
+        if get_bootstrap_config()[0]:
+            update_bootstrap_scores(session=session, verbose=verbose)
+
+    if close_session:
+        session.close()
+    return n_labels
+
+
+def main():
+    """Load labels into the ModMon database and update the metrics of the affected
+    prediction runs.
+
+    Available from the command-line as modmon_labels_ingest
+    """
+    parser = argparse.ArgumentParser(
+        description=(
+            "Load ground-truth labels for a dataset into the monitoring database and "
+            "recalculate the metrics of prediction runs on the dataset"
+        )
+    )
+    parser.add_argument(
+        "labels_file",
+        help=(
+            "JSON file in the same format as predictions.json, or CSV file with a "
+            "recordid column and a column for each output"
+        ),
+    )
+    parser.add_argument("--dataset_id", help="ID of the dataset", type=int)
+    parser.add_argument("--start_date", help="Start date of dataset")
+    parser.add_argument("--end_date", help="End date of dataset")
+    parser.add_argument("--database", help="Name of the database of the dataset")
+    parser.add_argument(
+        "--skip_scores",
+        help="If set, load the labels without recalculating metrics",
+        action="store_true",
+    )
+    args = parser.parse_args()
+    # TODO currently only deal with dates, not times
+    if args.start_date is not None:
+        start_date = dateparser.parse(args.start_date).date()
+    else:
+        start_date = None
+    if args.end_date is not None:
+        end_date = dateparser.parse(args.end_date).date()
+    else:
+        end_date = None
+
+    ingest_labels_file(
+        args.labels_file,
+        dataset_id=args.dataset_id,
+        start_date=start_date,
+        end_date=end_date,
+        database=args.database,
+        update_scores=not args.skip_scores,
+    )
@@ -0,0 +1,91 @@
+"""
+Functions for reading model predictions from the ModMon database in chunks.
+"""
+import io
+
+import pandas as pd
+from sqlalchemy import Text, cast, select
+
+from ..db.schema import Prediction
+
+
+def iter_prediction_chunks(session, run_id, chunk_size=100000):
+    """Read the predictions of a run in chunks, without loading the whole run into
+    memory.
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session
+        ModMon database session
+    run_id : int
+        Run ID of the prediction run
+    chunk_size : int, optional
+        Number of predictions per chunk, by default 100000
+
+    Yields
+    ------
+    pandas.DataFrame
+        Chunk of predictions with a column for each output. Non-numeric values are
+        NaN.
+    """
+    table = Prediction.__table__
+    # fetch the values as text and parse each chunk at once, which is much faster than
+    # decoding the JSON of each row separately
+    result = session.execute(
+        select([cast(table.c["values"], Text)])
+        .where(table.c.runid == run_id)
+        .execution_options(stream_results=True)
+    )
+    while True:
+        rows = result.fetchmany(chunk_size)
+        if not rows:
+            break
+        yield values_to_frame([values for (values,) in rows])
+
+
+def values_to_frame(values, numeric=True):
+    """Convert a list of prediction values to a DataFrame.
+
+    Parameters
+    ----------
+    values : list
+        List of {output_name: value} dicts (the values column of the prediction
+        table), or of JSON strings of them
+    numeric : bool, optional
+        If True convert all values to floats (see to_numeric_frame), by default True
+
+    Returns
+    -------
+    pandas.DataFrame
+        DataFrame with a column for each output. If numeric is True the columns are
+        floats, with NaN for missing or non-numeric values.
+    """
+    if len(values) > 0 and isinstance(values[0], str):
+        frame = pd.read_json(
+            io.StringIO("\n".join(values)),
+            lines=True,
+            dtype=False,
+            convert_dates=False,
+        )
+    else:
+        frame = pd.DataFrame.from_records(values)
+    if numeric:
+        return to_numeric_frame(frame)
+    return frame
+
+
+def to_numeric_frame(frame):
+    """Convert all columns of a DataFrame to floats.
+
+    Parameters
+    ----------
+    frame : pandas.DataFrame
+        DataFrame of prediction (or label) values
+
+    Returns
+    -------
+    pandas.DataFrame
+        DataFrame with the same columns as floats, with NaN for missing or non-numeric
+        values.
+    """
+    return frame.apply(pd.to_numeric, errors="coerce").astype(float)
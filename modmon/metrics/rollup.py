@@ -0,0 +1,289 @@
+"""
+Functions to summarise each output of prediction runs in the prediction_rollup table:
+the count, sum, sum of squares, minimum, maximum and a coarse histogram of its values,
+keyed by the start of the dataset window. Rollups are added when predictions are added
+to the database, so trends in predictions over time (see modmon.query) can be
+calculated without reading the prediction table.
+"""
+import argparse
+
+import pandas as pd
+from sqlalchemy import func
+
+from ..config import config
+from ..db.connect import get_session
+from ..db.schema import Dataset, ModelVersion, Prediction, PredictionRollup, RunSketch
+from .read import iter_prediction_chunks
+from .sketch import ColumnSketch, GridHistogram, get_sketch_config, sketch_frames
+
+
+def get_rollup_config(rollup_config=None):
+    """Get the rollup settings from the config file.
+
+    Parameters
+    ----------
+    rollup_config : configparser.SectionProxy, optional
+        configparser section optionally containing the keys 'enabled' and 'bins', by
+        default None which uses modmon.config.config["rollup"] if it exists.
+
+    Returns
+    -------
+    bool, int
+        Whether rollups are added when predictions are added, and the maximum number
+        of histogram bins per rollup.
+    """
+    if rollup_config is None:
+        rollup_config = config["rollup"] if "rollup" in config else {}
+    enabled = rollup_config.get("enabled", "True") == "True"
+    max_bins = int(rollup_config.get("bins", 100))
+    return enabled, max_bins
+
+
+def get_period_start(session, dataset_id, run_time):
+    """Get the time a prediction run's rollups are keyed by: the start of its dataset
+    window, or the time of the run if the dataset has no start date.
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session
+        ModMon database session
+    dataset_id : int
+        ID of the dataset the predictions were made for
+    run_time : str or datetime.datetime
+        Time of the run
+
+    Returns
+    -------
+    datetime.datetime
+        Start of the period the run's predictions are for
+    """
+    start_date = (
+        session.query(Dataset.start_date)
+        .filter(Dataset.datasetid == dataset_id)
+        .scalar()
+    )
+    if start_date is None:
+        start_date = run_time
+    return pd.Timestamp(start_date).to_pydatetime()
+
+
+def sketch_to_rollup(sketch, max_bins=100):
+    """Get the values of the columns of the prediction_rollup table from the sketch of
+    an output.
+
+    Parameters
+    ----------
+    sketch : modmon.metrics.sketch.ColumnSketch
+        Sketch of an output of a prediction run
+    max_bins : int, optional
+        Maximum number of histogram bins, by default 100
+
+    Returns
+    -------
+    dict
+        {column_name: value} for the count, missing, sum, sumsq, min, max and
+        histogram columns
+    """
+    # merging into an empty histogram coarsens the sketch's bins to at most max_bins
+    histogram = GridHistogram(max_bins)
+    histogram.merge(sketch.histogram)
+    return {
+        "count": sketch.count,
+        "missing": sketch.missing,
+        "sum": float(sketch.mean * sketch.count),
+        "sumsq": float(sketch.m2 + sketch.count * sketch.mean ** 2),
+        "min": float(sketch.min),
+        "max": float(sketch.max),
+        "histogram": histogram.to_dict(),
+    }
+
+
+def add_prediction_rollups(
+    session,
+    model_version,
+    dataset_id,
+    run_id,
+    run_time,
+    sketches,
+    part,
+    max_bins=None,
+    verbose=False,
+):
+    """Add rollups of a prediction run to the prediction_rollup table. The session is
+    not committed.
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session
+        ModMon database session
+    model_version : modmon.schema.db.ModelVersion
+        Model version object
+    dataset_id : int
+        ID of the dataset the predictions were made for
+    run_id : int
+        Run ID of the prediction run
+    run_time : str or datetime.datetime
+        Time of the run, used as the period start if the dataset has no start date
+    sketches : dict
+        {output_name: ColumnSketch} (see modmon.metrics.sketch.sketch_values)
+    part : str
+        Identifies the part of the run that was summarised, so runs whose predictions
+        are added in several parts (e.g. shards) have a rollup for each part. By
+        convention the smallest record ID in the part, compared as strings (see
+        modmon.metrics.sketch.add_run_sketches).
+    max_bins : int, optional
+        Maximum number of histogram bins, by default None which uses the value in
+        modmon.config.config["rollup"] (see get_rollup_config)
+    verbose : bool, optional
+        If True print the outputs that are skipped, by default False
+    """
+    if max_bins is None:
+        max_bins = get_rollup_config()[1]
+    max_length = PredictionRollup.output.type.length
+    too_long = [column for column in sketches if len(str(column)) > max_length]
+    if too_long and verbose:
+        print(f"Not rolling up outputs with names that are too long: {too_long}")
+
+    period_start = get_period_start(session, dataset_id, run_time)
+    for column, sketch in sketches.items():
+        if column in too_long:
+            continue
+        session.add(
+            PredictionRollup(
+                modelid=model_version.modelid,
+                modelversion=model_version.modelversion,
+                output=str(column),
+                periodstart=period_start,
+                datasetid=dataset_id,
+                runid=run_id,
+                part=str(part)[: PredictionRollup.part.type.length],
+                **sketch_to_rollup(sketch, max_bins),
+            )
+        )
+
+
+def rollup_run(session, model_version, dataset_id, run_id, verbose=True):
+    """Add rollups of a prediction run that's already in the database (e.g. one added
+    before rollups were calculated at ingest time), replacing any existing rollups of
+    the run. The run's sketches are used if it has them, otherwise its predictions are
+    read in chunks. The session is not committed.
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session
+        ModMon database session
+    model_version : modmon.schema.db.ModelVersion
+        Model version object
+    dataset_id : int
+        ID of the dataset the predictions were made for
+    run_id : int
+        Run ID of the prediction run
+    verbose : bool, optional
+        If True print additional progress messages, by default True
+    """
+    run_time, part = (
+        session.query(func.min(Prediction.runtime), func.min(Prediction.recordid))
+        .filter(Prediction.runid == run_id)
+        .one()
+    )
+
+    # {part: {output_name: ColumnSketch}}
+    parts = {}
+    for row in session.query(RunSketch).filter(RunSketch.runid == run_id):
+        parts.setdefault(row.part, {})[row.output] = ColumnSketch.from_row(row)
+    if not parts:
+        _, max_bins, compression, chunk_size = get_sketch_config()
+        parts[part] = sketch_frames(
+            iter_prediction_chunks(session, run_id, chunk_size), max_bins, compression
+        )
+
+    session.query(PredictionRollup).filter(PredictionRollup.runid == run_id).delete(
+        synchronize_session=False
+    )
+    for part, sketches in parts.items():
+        add_prediction_rollups(
+            session,
+            model_version,
+            dataset_id,
+            run_id,
+            run_time,
+            sketches,
+            part,
+            verbose=verbose,
+        )
+
+
+def update_prediction_rollups(
+    session=None, model_versions=None, force=False, verbose=True
+):
+    """Add rollups for all prediction runs that don't have them yet.
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session, optional
+        ModMon database session or None in which case one will be created, by default
+        None
+    model_versions : list, optional
+        ModelVersion objects to add rollups for, by default None which uses all model
+        versions
+    force : bool, optional
+        If True recalculate rollups for runs that already have them, by default False
+    verbose : bool, optional
+        If True print additional progress messages, by default True
+    """
+    if not session:
+        session = get_session()
+        close_session = True  # if session is created in function, close it in function
+    else:
+        close_session = False  # if session given, leave it open
+
+    if model_versions is None:
+        model_versions = session.query(ModelVersion).all()
+
+    rolled_up = {
+        run_id for (run_id,) in session.query(PredictionRollup.runid).distinct()
+    }
+    for mv in model_versions:
+        runs = (
+            session.query(Prediction.datasetid, Prediction.runid)
+            .filter(
+                Prediction.modelid == mv.modelid,
+                Prediction.modelversion == mv.modelversion,
+            )
+            .distinct()
+            .all()
+        )
+        for dataset_id, run_id in runs:
+            if run_id in rolled_up and not force:
+                continue
+            if verbose:
+                print(
+                    f"Rolling up predictions of model {mv.modelid} version "
+                    f"{mv.modelversion} on dataset {dataset_id} (run {run_id})"
+                )
+            rollup_run(session, mv, dataset_id, run_id, verbose=verbose)
+            session.commit()
+
+    if close_session:
+        session.close()
+
+
+def main():
+    """Add rollups for prediction runs that don't have them yet.
+
+    Available from the command-line as modmon_rollup
+    """
+    parser = argparse.ArgumentParser(
+        description=(
+            "Calculate rollups (count, sum, sum of squares, min, max and histogram) of "
+            "each output of prediction runs that don't have them yet"
+        )
+    )
+    parser.add_argument(
+        "--force",
+        help="If set, recalculate rollups for all prediction runs",
+        action="store_true",
+    )
+    args = parser.parse_args()
+
+    update_prediction_rollups(force=args.force)
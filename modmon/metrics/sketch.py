@@ -0,0 +1,906 @@
+"""
+Compact, mergeable summaries (sketches) of the distribution of each output of a
+prediction run: count, mean and variance, a t-digest for quantiles and a histogram with
+power-of-two bin widths. Sketches are calculated when predictions are added to the
+database and stored in the run_sketch table, so summaries of many runs (e.g. for drift
+or quantiles over time) can be read without scanning their predictions.
+"""
+import argparse
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import func
+
+from ..config import config
+from ..db.connect import get_session
+from ..db.schema import ModelVersion, Prediction, RunSketch
+from .read import iter_prediction_chunks, values_to_frame
+
+# Quantiles returned by get_run_quantiles by default
+DEFAULT_QUANTILES = [0.05, 0.25, 0.5, 0.75, 0.95]
+
+
+def get_sketch_config(sketch_config=None):
+    """Get the sketch settings from the config file.
+
+    Parameters
+    ----------
+    sketch_config : configparser.SectionProxy, optional
+        configparser section optionally containing the keys 'enabled', 'bins',
+        'compression' and 'chunksize', by default None which uses
+        modmon.config.config["sketch"] if it exists.
+
+    Returns
+    -------
+    bool, int, int, int
+        Whether sketches are calculated when predictions are added, the maximum number
+        of histogram bins, the t-digest compression, and the number of predictions to
+        sketch at a time.
+    """
+    if sketch_config is None:
+        sketch_config = config["sketch"] if "sketch" in config else {}
+    enabled = sketch_config.get("enabled", "True") == "True"
+    max_bins = int(sketch_config.get("bins", 1000))
+    compression = int(sketch_config.get("compression", 200))
+    chunk_size = int(sketch_config.get("chunksize", 100000))
+    return enabled, max_bins, compression, chunk_size
+
+
+class TDigest:
+    """t-digest (Dunning & Ertl) estimating the quantiles of a distribution from a
+    small number of weighted centroids, which are smallest in the tails so extreme
+    quantiles are accurate. Digests of different data can be merged.
+    """
+
+    def __init__(self, compression=200, means=None, weights=None):
+        """Initialise an instance of TDigest.
+
+        Parameters
+        ----------
+        compression : int, optional
+            Controls the size and accuracy of the digest, which has at most about
+            compression / 2 centroids, by default 200
+        means : array-like, optional
+            Centroid means, by default None (an empty digest)
+        weights : array-like, optional
+            Centroid weights, by default None (an empty digest)
+        """
+        self.compression = compression
+        self.means = np.asarray([] if means is None else means, dtype=float)
+        self.weights = np.asarray([] if weights is None else weights, dtype=float)
+
+    @property
+    def count(self):
+        """Total weight of all centroids."""
+        return float(self.weights.sum())
+
+    def _compress(self, means, weights):
+        """Merge centroids so each spans at most one unit of the k1 scale function,
+        k(q) = compression / (2 pi) * arcsin(2q - 1).
+        """
+        order = np.argsort(means, kind="mergesort")
+        means = means[order]
+        weights = weights[order]
+        total = weights.sum()
+        q_left = (np.cumsum(weights) - weights) / total
+        k = self.compression / (2 * np.pi) * np.arcsin(2 * q_left - 1)
+        _, groups = np.unique(np.floor(k - k[0]), return_inverse=True)
+
+        self.weights = np.bincount(groups, weights=weights)
+        self.means = np.bincount(groups, weights=weights * means) / self.weights
+
+    def update(self, values):
+        """Add values to the digest.
+
+        Parameters
+        ----------
+        values : numpy.ndarray
+            Finite values to add
+        """
+        if len(values) == 0:
+            return
+        self._compress(
+            np.concatenate([self.means, values]),
+            np.concatenate([self.weights, np.ones(len(values))]),
+        )
+
+    def merge(self, other):
+        """Merge another digest into this one.
+
+        Parameters
+        ----------
+        other : TDigest
+            Digest to merge
+        """
+        if len(other.means) == 0:
+            return
+        self._compress(
+            np.concatenate([self.means, other.means]),
+            np.concatenate([self.weights, other.weights]),
+        )
+
+    def quantile(self, quantiles, low=None, high=None):
+        """Estimate quantiles, by interpolating between the centroids.
+
+        Parameters
+        ----------
+        quantiles : float or array-like
+            Quantiles between 0 and 1
+        low : float, optional
+            Minimum value in the data, by default None which uses the first centroid
+        high : float, optional
+            Maximum value in the data, by default None which uses the last centroid
+
+        Returns
+        -------
+        float or numpy.ndarray
+            Estimated value of each quantile (NaN if the digest is empty)
+        """
+        if len(self.means) == 0:
+            return np.full(np.shape(quantiles), np.nan)
+        low = self.means[0] if low is None else low
+        high = self.means[-1] if high is None else high
+        centres = np.cumsum(self.weights) - self.weights / 2
+        return np.interp(
+            np.asarray(quantiles) * self.count,
+            np.concatenate([[0], centres, [self.count]]),
+            np.concatenate([[low], self.means, [high]]),
+        )
+
+    def to_dict(self):
+        """Convert the digest to a JSON serialisable dict.
+
+        Returns
+        -------
+        dict
+            Dict with the keys compression, means and weights
+        """
+        return {
+            "compression": self.compression,
+            "means": self.means.tolist(),
+            "weights": self.weights.tolist(),
+        }
+
+    @classmethod
+    def from_dict(cls, digest):
+        """Create a digest from a dict created by to_dict.
+
+        Parameters
+        ----------
+        digest : dict
+            Dict with the keys compression, means and weights
+
+        Returns
+        -------
+        TDigest
+        """
+        return cls(digest["compression"], digest["means"], digest["weights"])
+
+
+class GridHistogram:
+    """Histogram whose bins are aligned to a grid with a power-of-two width, so
+    histograms of different data can be merged exactly by coarsening the finer one. The
+    bin width doubles (merging pairs of bins) whenever the data would need more than
+    max_bins bins.
+    """
+
+    def __init__(self, max_bins=1000, exponent=None, start=0, counts=None):
+        """Initialise an instance of GridHistogram.
+
+        Parameters
+        ----------
+        max_bins : int, optional
+            Maximum number of bins, by default 1000
+        exponent : int, optional
+            Bins have width 2 ** exponent, by default None (an empty histogram)
+        start : int, optional
+            Index of the first bin, which covers [start * width, (start + 1) * width),
+            by default 0
+        counts : array-like, optional
+            Number of values in each bin, by default None (an empty histogram)
+        """
+        self.max_bins = max_bins
+        self.exponent = exponent
+        self.start = start
+        self.counts = np.asarray([] if counts is None else counts, dtype=np.int64)
+
+    @property
+    def edges(self):
+        """Edges of each bin (one more than the number of bins)."""
+        width = 2.0 ** self.exponent
+        return (self.start + np.arange(len(self.counts) + 1)) * width
+
+    def _min_exponent(self, low, high):
+        """Smallest bin width exponent that covers low to high in at most max_bins
+        bins, and doesn't give bins narrower than the float precision of the values.
+        """
+        span = high - low
+        if span == 0:
+            span = max(abs(low), 1.0)
+        exponent = int(np.ceil(np.log2(span / (self.max_bins - 1))))
+        precision = int(np.ceil(np.log2(max(abs(low), abs(high), 1e-300)))) - 52
+        return max(exponent, precision)
+
+    def coarsen(self, exponent):
+        """Increase the bin width to 2 ** exponent, merging bins.
+
+        Parameters
+        ----------
+        exponent : int
+            New bin width exponent, greater than or equal to the current one
+        """
+        if self.exponent is None:
+            self.exponent = exponent
+            return
+        if exponent <= self.exponent:
+            return
+        shift = min(exponent - self.exponent, 63)
+        index = np.right_shift(self.start + np.arange(len(self.counts)), shift)
+        self.start = int(index[0]) if len(index) > 0 else 0
+        self.counts = np.bincount(index - self.start, weights=self.counts).astype(
+            np.int64
+        )
+        self.exponent = exponent
+
+    def _add_counts(self, start, counts):
+        """Add counts for bins starting at start (with the same width)."""
+        if len(self.counts) == 0:
+            self.start, self.counts = start, counts
+            return
+        new_start = min(self.start, start)
+        stop = max(self.start + len(self.counts), start + len(counts))
+        total = np.zeros(stop - new_start, dtype=np.int64)
+        total[
+            self.start - new_start : self.start - new_start + len(self.counts)
+        ] += self.counts
+        total[start - new_start : start - new_start + len(counts)] += counts
+        self.start, self.counts = new_start, total
+
+    def _fit(self):
+        """Coarsen the bins until there are at most max_bins."""
+        while len(self.counts) > self.max_bins:
+            self.coarsen(self.exponent + 1)
+
+    def update(self, values):
+        """Add values to the histogram.
+
+        Parameters
+        ----------
+        values : numpy.ndarray
+            Finite values to add
+        """
+        if len(values) == 0:
+            return
+        low, high = values.min(), values.max()
+        if len(self.counts) > 0:
+            low, high = min(low, self.edges[0]), max(high, self.edges[-1])
+        self.coarsen(self._min_exponent(low, high))
+
+        index = np.floor(values / 2.0 ** self.exponent).astype(np.int64)
+        start = int(index.min())
+        self._add_counts(start, np.bincount(index - start).astype(np.int64))
+        self._fit()
+
+    def merge(self, other):
+        """Merge another histogram into this one.
+
+        Parameters
+        ----------
+        other : GridHistogram
+            Histogram to merge
+        """
+        if len(other.counts) == 0:
+            return
+        other = other.copy()
+        exponent = other.exponent
+        if self.exponent is not None:
+            exponent = max(exponent, self.exponent)
+        self.coarsen(exponent)
+        other.coarsen(exponent)
+        self._add_counts(other.start, other.counts)
+        self._fit()
+
+    def copy(self):
+        """Copy the histogram.
+
+        Returns
+        -------
+        GridHistogram
+        """
+        return GridHistogram(
+            self.max_bins, self.exponent, self.start, self.counts.copy()
+        )
+
+    def to_dict(self):
+        """Convert the histogram to a JSON serialisable dict.
+
+        Returns
+        -------
+        dict
+            Dict with the keys exponent, start and counts
+        """
+        return {
+            "exponent": self.exponent,
+            "start": self.start,
+            "counts": self.counts.tolist(),
+        }
+
+    @classmethod
+    def from_dict(cls, histogram, max_bins=1000):
+        """Create a histogram from a dict created by to_dict.
+
+        Parameters
+        ----------
+        histogram : dict
+            Dict with the keys exponent, start and counts
+        max_bins : int, optional
+            Maximum number of bins, by default 1000
+
+        Returns
+        -------
+        GridHistogram
+        """
+        max_bins = max(max_bins, len(histogram["counts"]))
+        return cls(
+            max_bins, histogram["exponent"], histogram["start"], histogram["counts"]
+        )
+
+
+def align_histograms(first, second):
+    """Get the counts of two histograms on the same bins.
+
+    Parameters
+    ----------
+    first : GridHistogram
+        First histogram
+    second : GridHistogram
+        Second histogram
+
+    Returns
+    -------
+    numpy.ndarray, numpy.ndarray
+        Counts of each histogram in the same bins, spanning the range of both
+    """
+    exponent = max(first.exponent, second.exponent)
+    first = first.copy()
+    second = second.copy()
+    first.coarsen(exponent)
+    second.coarsen(exponent)
+
+    start = min(first.start, second.start)
+    stop = max(first.start + len(first.counts), second.start + len(second.counts))
+    aligned = []
+    for hist in (first, second):
+        counts = np.zeros(stop - start, dtype=np.int64)
+        counts[hist.start - start : hist.start - start + len(hist.counts)] = hist.counts
+        aligned.append(counts)
+    return aligned[0], aligned[1]
+
+
+class ColumnSketch:
+    """Sketch of the distribution of one output of a prediction run: the number of
+    numeric and missing values, mean, variance, minimum and maximum, a t-digest and a
+    histogram.
+    """
+
+    def __init__(self, max_bins=1000, compression=200):
+        """Initialise an empty instance of ColumnSketch.
+
+        Parameters
+        ----------
+        max_bins : int, optional
+            Maximum number of histogram bins, by default 1000
+        compression : int, optional
+            t-digest compression, by default 200
+        """
+        self.count = 0
+        self.missing = 0
+        self.mean = 0.0
+        self.m2 = 0.0  # sum of squared differences from the mean
+        self.min = np.inf
+        self.max = -np.inf
+        self.digest = TDigest(compression)
+        self.histogram = GridHistogram(max_bins)
+
+    @property
+    def variance(self):
+        """Population variance of the values (NaN if there are none)."""
+        return self.m2 / self.count if self.count > 0 else np.nan
+
+    def _merge_moments(self, count, mean, m2, low, high):
+        """Combine the count, mean and m2 of other values with this sketch's (Chan et
+        al.'s parallel algorithm).
+        """
+        if count == 0:
+            return
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta ** 2 * self.count * count / total
+        self.count = total
+        self.min = min(self.min, low)
+        self.max = max(self.max, high)
+
+    def update(self, values):
+        """Add values to the sketch.
+
+        Parameters
+        ----------
+        values : numpy.ndarray
+            Values to add. Values that aren't finite (e.g. NaN for missing or
+            non-numeric predictions) are counted as missing.
+        """
+        finite = values[np.isfinite(values)]
+        self.missing += len(values) - len(finite)
+        if len(finite) == 0:
+            return
+        mean = finite.mean()
+        self._merge_moments(
+            len(finite),
+            mean,
+            ((finite - mean) ** 2).sum(),
+            finite.min(),
+            finite.max(),
+        )
+        self.digest.update(finite)
+        self.histogram.update(finite)
+
+    def merge(self, other):
+        """Merge another sketch into this one.
+
+        Parameters
+        ----------
+        other : ColumnSketch
+            Sketch to merge
+        """
+        self.missing += other.missing
+        self._merge_moments(other.count, other.mean, other.m2, other.min, other.max)
+        self.digest.merge(other.digest)
+        self.histogram.merge(other.histogram)
+
+    def quantile(self, quantiles):
+        """Estimate quantiles of the values.
+
+        Parameters
+        ----------
+        quantiles : float or array-like
+            Quantiles between 0 and 1
+
+        Returns
+        -------
+        float or numpy.ndarray
+            Estimated value of each quantile
+        """
+        return self.digest.quantile(quantiles, self.min, self.max)
+
+    def to_row(self):
+        """Get the values of the sketch's columns in the run_sketch table.
+
+        Returns
+        -------
+        dict
+            {column_name: value} for the count, missing, mean, variance, min, max,
+            histogram and digest columns
+        """
+        return {
+            "count": self.count,
+            "missing": self.missing,
+            "mean": float(self.mean),
+            "variance": float(self.variance),
+            "min": float(self.min),
+            "max": float(self.max),
+            "histogram": self.histogram.to_dict(),
+            "digest": self.digest.to_dict(),
+        }
+
+    @classmethod
+    def from_row(cls, row):
+        """Create a sketch from a row of the run_sketch table.
+
+        Parameters
+        ----------
+        row : modmon.db.schema.RunSketch
+            RunSketch object (or any object with the same attributes)
+
+        Returns
+        -------
+        ColumnSketch
+        """
+        sketch = cls()
+        sketch.count = row.count
+        sketch.missing = row.missing
+        sketch.mean = row.mean
+        sketch.m2 = row.variance * row.count
+        sketch.min = row.min
+        sketch.max = row.max
+        sketch.digest = TDigest.from_dict(row.digest)
+        sketch.histogram = GridHistogram.from_dict(row.histogram)
+        return sketch
+
+
+class RunSketcher:
+    """Sketches each output of a prediction run as its predictions are read, a chunk at
+    a time, so a run can be sketched in the same pass that adds it to the database.
+    """
+
+    def __init__(self, max_bins=1000, compression=200, chunk_size=100000):
+        """Initialise an instance of RunSketcher with no predictions.
+
+        Parameters
+        ----------
+        max_bins : int, optional
+            Maximum number of histogram bins, by default 1000
+        compression : int, optional
+            t-digest compression, by default 200
+        chunk_size : int, optional
+            Number of predictions to sketch at a time (see sketch), by default 100000
+        """
+        self.max_bins = max_bins
+        self.compression = compression
+        self.chunk_size = chunk_size
+        self.sketches = {}
+        self.n_rows = 0
+        # smallest record ID, compared as strings as in the predictions table
+        self.part = None
+
+    def update_frame(self, frame):
+        """Add a chunk of predictions to the sketches.
+
+        Parameters
+        ----------
+        frame : pandas.DataFrame
+            Chunk of predictions with a float column for each output (see
+            modmon.metrics.read.values_to_frame)
+        """
+        for column in frame.columns:
+            if column not in self.sketches:
+                self.sketches[column] = ColumnSketch(self.max_bins, self.compression)
+                # the output was missing in all earlier chunks
+                self.sketches[column].missing = self.n_rows
+            self.sketches[column].update(frame[column].to_numpy())
+        for column, sketch in self.sketches.items():
+            if column not in frame.columns:
+                sketch.missing += len(frame)
+        self.n_rows += len(frame)
+
+    def sketch(self, results):
+        """Sketch predictions as they're read from results.
+
+        Parameters
+        ----------
+        results : iterable
+            (record_id, {output_name: value}) pairs
+
+        Yields
+        ------
+        str, dict
+            Each record ID (as a string) and its predictions, unchanged, after adding
+            them to the sketches. The last chunk is only sketched once results is
+            exhausted.
+        """
+        chunk = []
+        for record_id, values in results:
+            record_id = str(record_id)
+            if self.part is None or record_id < self.part:
+                self.part = record_id
+            chunk.append(values)
+            if len(chunk) >= self.chunk_size:
+                self.update_frame(values_to_frame(chunk))
+                chunk = []
+            yield record_id, values
+        if chunk:
+            self.update_frame(values_to_frame(chunk))
+
+    def get_sketches(self):
+        """Get the sketches of the predictions read so far.
+
+        Returns
+        -------
+        dict
+            {output_name: ColumnSketch} for outputs with at least one numeric value
+        """
+        return {
+            column: sketch
+            for column, sketch in self.sketches.items()
+            if sketch.count > 0
+        }
+
+
+def sketch_frames(frames, max_bins=1000, compression=200):
+    """Sketch each output in chunks of predictions.
+
+    Parameters
+    ----------
+    frames : iterable
+        pandas.DataFrame chunks with a float column for each output (see
+        modmon.metrics.read.values_to_frame)
+    max_bins : int, optional
+        Maximum number of histogram bins, by default 1000
+    compression : int, optional
+        t-digest compression, by default 200
+
+    Returns
+    -------
+    dict
+        {output_name: ColumnSketch} for outputs with at least one numeric value
+    """
+    sketcher = RunSketcher(max_bins, compression)
+    for frame in frames:
+        sketcher.update_frame(frame)
+    return sketcher.get_sketches()
+
+
+def sketch_values(values, max_bins=None, compression=None, chunk_size=None):
+    """Sketch each output of a list of predictions.
+
+    Parameters
+    ----------
+    values : list
+        List of {output_name: value} dicts
+    max_bins : int, optional
+        Maximum number of histogram bins, by default None which uses the value in
+        modmon.config.config["sketch"] (see get_sketch_config)
+    compression : int, optional
+        t-digest compression, by default None which uses the config value
+    chunk_size : int, optional
+        Number of predictions to sketch at a time, by default None which uses the
+        config value
+
+    Returns
+    -------
+    dict
+        {output_name: ColumnSketch} for outputs with at least one numeric value
+    """
+    _, default_bins, default_compression, default_chunk_size = get_sketch_config()
+    max_bins = default_bins if max_bins is None else max_bins
+    compression = default_compression if compression is None else compression
+    chunk_size = default_chunk_size if chunk_size is None else chunk_size
+
+    frames = (
+        values_to_frame(values[i : i + chunk_size])
+        for i in range(0, len(values), chunk_size)
+    )
+    return sketch_frames(frames, max_bins, compression)
+
+
+def add_run_sketches(
+    session, model_version, dataset_id, run_id, sketches, part, verbose=False
+):
+    """Add sketches of a prediction run to the run_sketch table. The session is not
+    committed.
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session
+        ModMon database session
+    model_version : modmon.schema.db.ModelVersion
+        Model version object
+    dataset_id : int
+        ID of the dataset the predictions were made for
+    run_id : int
+        Run ID of the prediction run
+    sketches : dict
+        {output_name: ColumnSketch} (see sketch_values)
+    part : str
+        Identifies the part of the run that was sketched, so runs whose predictions
+        are added in several parts (e.g. shards) have a sketch for each part. By
+        convention the smallest record ID in the part, compared as strings (as the
+        recordid column is a string, so it's the same as min(recordid) in SQL).
+    verbose : bool, optional
+        If True print the outputs that are skipped, by default False
+    """
+    max_length = RunSketch.output.type.length
+    too_long = [column for column in sketches if len(str(column)) > max_length]
+    if too_long and verbose:
+        print(f"Not sketching outputs with names that are too long: {too_long}")
+
+    for column, sketch in sketches.items():
+        if column in too_long:
+            continue
+        session.add(
+            RunSketch(
+                modelid=model_version.modelid,
+                modelversion=model_version.modelversion,
+                datasetid=dataset_id,
+                runid=run_id,
+                output=str(column),
+                part=str(part)[: RunSketch.part.type.length],
+                **sketch.to_row(),
+            )
+        )
+
+
+def get_run_sketches(session, run_id):
+    """Load the sketches of a prediction run, merging the sketches of each part.
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session
+        ModMon database session
+    run_id : int
+        Run ID of the prediction run
+
+    Returns
+    -------
+    dict
+        {output_name: ColumnSketch}, empty if the run hasn't been sketched
+    """
+    return get_many_run_sketches(session, [run_id]).get(run_id, {})
+
+
+def get_many_run_sketches(session, run_ids):
+    """Load the sketches of many prediction runs in one query, merging the sketches of
+    each part.
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session
+        ModMon database session
+    run_ids : list
+        Run IDs of the prediction runs
+
+    Returns
+    -------
+    dict
+        {run_id: {output_name: ColumnSketch}} for runs that have been sketched
+    """
+    sketches = {}
+    rows = session.query(RunSketch).filter(RunSketch.runid.in_(list(run_ids)))
+    for row in rows:
+        run_sketches = sketches.setdefault(row.runid, {})
+        sketch = ColumnSketch.from_row(row)
+        if row.output in run_sketches:
+            run_sketches[row.output].merge(sketch)
+        else:
+            run_sketches[row.output] = sketch
+    return sketches
+
+
+def get_run_quantiles(session, run_ids, quantiles=None):
+    """Estimate quantiles and summary statistics of each output of many prediction
+    runs from their sketches, without reading their predictions.
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session
+        ModMon database session
+    run_ids : list
+        Run IDs of the prediction runs
+    quantiles : list, optional
+        Quantiles between 0 and 1 to estimate, by default None which uses
+        DEFAULT_QUANTILES
+
+    Returns
+    -------
+    pandas.DataFrame
+        DataFrame with a row for each run and output (columns runid and output), and
+        the columns count, missing, mean, std, min, max and a column for each quantile
+        (e.g. q0.5). Runs that haven't been sketched are not included.
+    """
+    if quantiles is None:
+        quantiles = DEFAULT_QUANTILES
+
+    rows = []
+    for run_id, run_sketches in get_many_run_sketches(session, run_ids).items():
+        for output, sketch in run_sketches.items():
+            row = {
+                "runid": run_id,
+                "output": output,
+                "count": sketch.count,
+                "missing": sketch.missing,
+                "mean": sketch.mean,
+                "std": np.sqrt(sketch.variance),
+                "min": sketch.min,
+                "max": sketch.max,
+            }
+            for q, value in zip(quantiles, sketch.quantile(quantiles)):
+                row[f"q{q}"] = value
+            rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def sketch_run(session, model_version, dataset_id, run_id, verbose=True):
+    """Sketch a prediction run that's already in the database (e.g. one added before
+    sketches were calculated at ingest time), replacing any existing sketches of the
+    run. The session is not committed.
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session
+        ModMon database session
+    model_version : modmon.schema.db.ModelVersion
+        Model version object
+    dataset_id : int
+        ID of the dataset the predictions were made for
+    run_id : int
+        Run ID of the prediction run
+    verbose : bool, optional
+        If True print additional progress messages, by default True
+    """
+    _, max_bins, compression, chunk_size = get_sketch_config()
+    sketches = sketch_frames(
+        iter_prediction_chunks(session, run_id, chunk_size), max_bins, compression
+    )
+    part = (
+        session.query(func.min(Prediction.recordid))
+        .filter(Prediction.runid == run_id)
+        .scalar()
+    )
+    session.query(RunSketch).filter(RunSketch.runid == run_id).delete(
+        synchronize_session=False
+    )
+    add_run_sketches(
+        session, model_version, dataset_id, run_id, sketches, part, verbose=verbose
+    )
+
+
+def update_run_sketches(session=None, model_versions=None, force=False, verbose=True):
+    """Sketch all prediction runs that don't have sketches yet.
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session, optional
+        ModMon database session or None in which case one will be created, by default
+        None
+    model_versions : list, optional
+        ModelVersion objects to sketch runs for, by default None which uses all model
+        versions
+    force : bool, optional
+        If True re-sketch runs that already have sketches, by default False
+    verbose : bool, optional
+        If True print additional progress messages, by default True
+    """
+    if not session:
+        session = get_session()
+        close_session = True  # if session is created in function, close it in function
+    else:
+        close_session = False  # if session given, leave it open
+
+    if model_versions is None:
+        model_versions = session.query(ModelVersion).all()
+
+    sketched = {run_id for (run_id,) in session.query(RunSketch.runid).distinct()}
+    for mv in model_versions:
+        runs = (
+            session.query(Prediction.datasetid, Prediction.runid)
+            .filter(
+                Prediction.modelid == mv.modelid,
+                Prediction.modelversion == mv.modelversion,
+            )
+            .distinct()
+            .all()
+        )
+        for dataset_id, run_id in runs:
+            if run_id in sketched and not force:
+                continue
+            if verbose:
+                print(
+                    f"Sketching predictions of model {mv.modelid} version "
+                    f"{mv.modelversion} on dataset {dataset_id} (run {run_id})"
+                )
+            sketch_run(session, mv, dataset_id, run_id, verbose=verbose)
+            session.commit()
+
+    if close_session:
+        session.close()
+
+
+def main():
+    """Sketch prediction runs that don't have sketches yet.
+
+    Available from the command-line as modmon_sketch
+    """
+    parser = argparse.ArgumentParser(
+        description=(
+            "Calculate sketches of the distribution of each output of prediction runs "
+            "that don't have them yet"
+        )
+    )
+    parser.add_argument(
+        "--force",
+        help="If set, recalculate sketches for all prediction runs",
+        action="store_true",
+    )
+    args = parser.parse_args()
+
+    update_run_sketches(force=args.force)
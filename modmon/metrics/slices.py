@@ -0,0 +1,277 @@
+"""
+Functions to define slices (subgroups, e.g. age bands or regions) of the records in a
+dataset for each research question, and to assign labelled predictions to slices so
+metrics can be calculated for all slices in one grouped pass (see
+modmon.metrics.evaluate).
+"""
+import argparse
+import json
+
+import numpy as np
+import pandas as pd
+
+from ..db.connect import get_session
+from ..db.schema import SliceDefinition
+from .utils import OVERALL_SLICE
+
+
+def get_slice_label(name, value):
+    """Get the label of a slice, as stored in the slice column of the score table.
+
+    Parameters
+    ----------
+    name : str
+        Name of the slice definition
+    value : str
+        Value (or bin) of the slice
+
+    Returns
+    -------
+    str
+        Slice label with the format <name>=<value>
+    """
+    return f"{name}={value}"
+
+
+def format_slice_value(value):
+    """Format the value (or bin) of a slice for its label, so the same value gets the
+    same label whatever the type of the column it was read from. Integral floats are
+    written as integers, as integer columns become floats in chunks with missing
+    values (e.g. 1.0 is written as 1), including the edges of bins.
+
+    Parameters
+    ----------
+    value : object
+        Value (or pandas.Interval bin) of the slice
+
+    Returns
+    -------
+    str
+        Formatted value
+    """
+    if isinstance(value, pd.Interval):
+        left = "[" if value.closed_left else "("
+        right = "]" if value.closed_right else ")"
+        return (
+            f"{left}{format_slice_value(value.left)}, "
+            f"{format_slice_value(value.right)}{right}"
+        )
+    if isinstance(value, (bool, np.bool_)):
+        return str(bool(value))
+    if isinstance(value, (int, np.integer)):
+        return str(int(value))
+    if isinstance(value, (float, np.floating)) and float(value).is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def get_slice_definitions(session, question_id):
+    """Get the slice definitions of a research question.
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session
+        ModMon database session
+    question_id : int
+        ID of the research question
+
+    Returns
+    -------
+    list
+        SliceDefinition objects, ordered by name
+    """
+    return (
+        session.query(SliceDefinition)
+        .filter(SliceDefinition.questionid == question_id)
+        .order_by(SliceDefinition.name)
+        .all()
+    )
+
+
+def read_slices_file(slices_path):
+    """Load slice definitions from a JSON file.
+
+    Parameters
+    ----------
+    slices_path : str or Path
+        Path to a JSON file containing a list of slice definitions, each a dict with
+        the keys "name" and "column", and optionally "bins" (a list of bin edges for
+        numeric values) and "description". For example:
+        [{"name": "age_band", "column": "age", "bins": [0, 18, 40, 65, 120]},
+         {"name": "region", "column": "region"}]
+
+    Returns
+    -------
+    list
+        List of slice definition dicts
+
+    Raises
+    ------
+    ValueError
+        If a definition doesn't have a name and column
+    """
+    with open(slices_path, "r") as f:
+        definitions = json.load(f)
+    for definition in definitions:
+        if "name" not in definition or "column" not in definition:
+            raise ValueError(
+                f"Slice definition {definition} must have a name and a column"
+            )
+    return definitions
+
+
+def add_slice_definitions(session, question_id, definitions):
+    """Add slice definitions for a research question, replacing any existing
+    definitions with the same names. The session is not committed.
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session
+        ModMon database session
+    question_id : int
+        ID of the research question
+    definitions : list
+        List of slice definition dicts (see read_slices_file)
+    """
+    for definition in definitions:
+        session.merge(
+            SliceDefinition(
+                questionid=question_id,
+                name=definition["name"],
+                column=definition["column"],
+                bins=definition.get("bins"),
+                description=definition.get("description"),
+            )
+        )
+
+
+class SliceGrouper:
+    """Assigns rows to groups for the overall dataset (group 0) and each slice defined
+    for a research question. Groups are numbered in the order slices are first seen,
+    and keep the same number across chunks.
+    """
+
+    def __init__(self, definitions):
+        """Initialise an instance of SliceGrouper.
+
+        Parameters
+        ----------
+        definitions : list
+            SliceDefinition objects (or objects with the attributes name, column and
+            bins)
+        """
+        self.definitions = definitions
+        # slice label of each group, and group number of each slice label
+        self.labels = [OVERALL_SLICE]
+        self.groups = {OVERALL_SLICE: 0}
+
+    @property
+    def n_groups(self):
+        """Number of groups seen so far, including the overall group."""
+        return len(self.labels)
+
+    def get_group(self, label):
+        """Get the group number of a slice, adding a new group if it hasn't been seen
+        before.
+        """
+        if label not in self.groups:
+            self.groups[label] = len(self.labels)
+            self.labels.append(label)
+        return self.groups[label]
+
+    def slice_values(self, definition, predictions, labels):
+        """Get the value (or bin) of a slice definition for each row, taking the
+        definition's column from the labels if present there, otherwise from the
+        predictions.
+
+        Returns
+        -------
+        pandas.Series
+            Slice value (or bin) of each row, or NaN if the row isn't in any slice
+        """
+        if definition.column in labels.columns:
+            values = labels[definition.column]
+        elif definition.column in predictions.columns:
+            values = predictions[definition.column]
+        else:
+            return pd.Series(np.nan, index=labels.index)
+
+        if definition.bins:
+            # always cut floats, so bins are labelled the same in every chunk
+            return pd.cut(
+                pd.to_numeric(values, errors="coerce").astype(float),
+                definition.bins,
+                right=False,
+            )
+        return values
+
+    def assign(self, predictions, labels):
+        """Assign the rows of a chunk to groups. Each row is in the overall group and
+        in one slice of each definition (if it has a value for it).
+
+        Parameters
+        ----------
+        predictions : pandas.DataFrame
+            Chunk of predictions (see modmon.metrics.evaluate.iter_labelled_chunks)
+        labels : pandas.DataFrame
+            Labels of the predictions, in the same order
+
+        Returns
+        -------
+        numpy.ndarray, numpy.ndarray
+            Row numbers and the group of each. Rows appear once for the overall group
+            and once for each slice they're in.
+        """
+        rows = [np.arange(len(labels))]
+        groups = [np.zeros(len(labels), dtype=np.int64)]
+        for definition in self.definitions:
+            values = self.slice_values(definition, predictions, labels)
+            codes, uniques = pd.factorize(values)
+            # map the chunk's slice values to group numbers (one lookup per value)
+            group_numbers = np.array(
+                [
+                    self.get_group(
+                        get_slice_label(definition.name, format_slice_value(value))
+                    )
+                    for value in uniques
+                ],
+                dtype=np.int64,
+            )
+            in_slice = codes >= 0
+            rows.append(np.flatnonzero(in_slice))
+            groups.append(group_numbers[codes[in_slice]])
+        return np.concatenate(rows), np.concatenate(groups)
+
+
+def main():
+    """Add slice definitions for a research question, or list the existing ones.
+
+    Available from the command-line as modmon_slices
+    """
+    parser = argparse.ArgumentParser(
+        description=(
+            "Define slices (subgroups) of the data for a research question, for which "
+            "metrics are calculated from labels"
+        )
+    )
+    parser.add_argument("question_id", help="ID of the research question", type=int)
+    parser.add_argument(
+        "--slices_file",
+        help=(
+            "JSON file with a list of slice definitions, each with a name, column and "
+            "optionally bins and description. If not given list the existing slices."
+        ),
+    )
+    args = parser.parse_args()
+
+    session = get_session()
+    if args.slices_file is not None:
+        add_slice_definitions(
+            session, args.question_id, read_slices_file(args.slices_file)
+        )
+        session.commit()
+
+    for definition in get_slice_definitions(session, args.question_id):
+        bins = f" in bins {definition.bins}" if definition.bins else ""
+        print(f"{definition.name}: {definition.column}{bins}")
+    session.close()
@@ -0,0 +1,154 @@
+"""
+Utility functions for saving metrics calculated by ModMon (rather than by the models
+themselves) to the score table.
+"""
+from ..db.schema import Metric, Score
+from ..db.summary import update_latest_scores
+from ..db.utils import get_unique_id
+from .alerts import check_alerts
+
+# Prefix of metric names reserved for metrics calculated by ModMon
+RESERVED_PREFIX = "modmon."
+# Slice of scores calculated for the whole dataset
+OVERALL_SLICE = ""
+
+
+def get_reserved_metric_name(statistic, column):
+    """Get the reserved metric name for a statistic of a model output.
+
+    Parameters
+    ----------
+    statistic : str
+        Name of the statistic, e.g. "psi"
+    column : str
+        Name of the model output
+
+    Returns
+    -------
+    str
+        Metric name with the format modmon.<statistic>.<column>
+    """
+    return f"{RESERVED_PREFIX}{statistic}.{column}"
+
+
+def parse_reserved_metric_name(name):
+    """Get the statistic and model output from a reserved metric name.
+
+    Parameters
+    ----------
+    name : str
+        Metric name with the format modmon.<statistic>.<column>
+
+    Returns
+    -------
+    str, str
+        Name of the statistic and of the model output
+    """
+    statistic, column = name[len(RESERVED_PREFIX) :].split(".", 1)
+    return statistic, column
+
+
+def replace_reserved_scores(
+    session,
+    model_version,
+    dataset_id,
+    run_time,
+    values,
+    descriptions,
+    sliced_values=None,
+):
+    """Add metrics calculated by ModMon to the score table as a new run, replacing any
+    scores (in any slice) with the same metric names for the same model version and
+    dataset. Metrics that aren't in the metric table yet are added to it, the
+    latest_score summary is updated (see modmon.db.summary), and the scores for the
+    whole dataset are checked against the alert rules (see modmon.metrics.alerts). The
+    session is not committed.
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session
+        ModMon database session
+    model_version : modmon.schema.db.ModelVersion
+        Model version object
+    dataset_id : int
+        ID of the dataset the metrics were calculated for
+    run_time : str or datetime.datetime
+        Time of the run the metrics were calculated for
+    values : dict
+        {metric_name: value} with reserved metric names (see get_reserved_metric_name)
+    descriptions : dict
+        {statistic: description}, used to describe new metrics
+    sliced_values : dict, optional
+        {(metric_name, slice_label): value} for metrics calculated for slices of the
+        dataset (see modmon.metrics.slices), by default None
+
+    Returns
+    -------
+    dict
+        {metric_name: value} of the added scores for the whole dataset. Metrics with
+        names too long for the metric table, and slices with labels too long for the
+        score table, are skipped.
+    """
+    if sliced_values is None:
+        sliced_values = {}
+    names = set(values) | {name for name, _ in sliced_values}
+    too_long = {name for name in names if len(name) > Metric.metric.type.length}
+    if too_long:
+        print(f"Skipping metrics with names that are too long: {sorted(too_long)}")
+        names -= too_long
+    slices_too_long = {
+        label for _, label in sliced_values if len(label) > Score.slice.type.length
+    }
+    if slices_too_long:
+        print(
+            f"Skipping slices with labels that are too long: {sorted(slices_too_long)}"
+        )
+    values = {name: value for name, value in values.items() if name in names}
+    sliced_values = {
+        (name, label): value
+        for (name, label), value in sliced_values.items()
+        if name in names and label not in slices_too_long
+    }
+    if not names:
+        return values
+
+    metrics_in_db = {m for (m,) in session.query(Metric.metric)}
+    for name in sorted(names):
+        if name not in metrics_in_db:
+            statistic, _ = parse_reserved_metric_name(name)
+            session.add(
+                Metric(
+                    metric=name,
+                    description=f"{descriptions[statistic]} (calculated by ModMon)",
+                )
+            )
+
+    session.query(Score).filter(
+        Score.modelid == model_version.modelid,
+        Score.modelversion == model_version.modelversion,
+        Score.datasetid == dataset_id,
+        Score.metric.in_(list(names)),
+    ).delete(synchronize_session=False)
+
+    score_run_id = get_unique_id(session, Score.runid)
+    scores = {(name, OVERALL_SLICE): value for name, value in values.items()}
+    scores.update(sliced_values)
+    for (name, label), value in scores.items():
+        session.add(
+            Score(
+                modelid=model_version.modelid,
+                modelversion=model_version.modelversion,
+                datasetid=dataset_id,
+                isreference=False,
+                runtime=run_time,
+                runid=score_run_id,
+                metric=name,
+                slice=label,
+                value=value,
+            )
+        )
+    update_latest_scores(
+        session, model_version, dataset_id, score_run_id, run_time, scores
+    )
+    check_alerts(session, model_version, dataset_id, score_run_id, values)
+    return values
@@ -224,6 +224,20 @@ def check_metadata_values(metadata, result_dict=None):
             except ValueError:
                 checked_values[cmd] = False
 
+    # python entry-points - "module:function" string or dict of them
+    if "python_entrypoint" in metadata.keys():
+        entrypoints = metadata["python_entrypoint"]
+        if isinstance(entrypoints, str):
+            entrypoints = {"score": entrypoints}
+        checked_values["python_entrypoint"] = (
+            isinstance(entrypoints, dict)
+            and set(entrypoints.keys()) <= {"score", "predict"}
+            and all(
+                isinstance(ep, str) and re.fullmatch(r"^[\w.]+:\w+$", ep)
+                for ep in entrypoints.values()
+            )
+        )
+
     if all(checked_values.values()):
         print_success("Metadata: All keys have valid values")
         result_dict["success"] += 1
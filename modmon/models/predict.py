@@ -6,9 +6,25 @@ import argparse
 import json
 
 import dateparser
+import ijson
 
+from ..db.ingest import bulk_insert, get_ingest_config
+from ..db.connect import get_session
 from ..db.schema import Prediction
-from .run import run_model, run_all_models
+from ..metrics.drift import get_drift_config, update_drift_scores
+from ..metrics.anomaly import get_anomaly_config, update_anomalies
+from ..metrics.bootstrap import get_bootstrap_config, update_bootstrap_scores
+from ..metrics.evaluate import get_evaluate_config, update_label_scores
+from ..metrics.rollup import add_prediction_rollups, get_rollup_config
+from ..metrics.sketch import RunSketcher, add_run_sketches, get_sketch_config
+from .run import (
+    find_dataset,
+    run_model,
+    run_all_models,
+    load_windows_file,
+    get_model_versions,
+    SHARD_MODES,
+)
 
 PREDICTIONS_FILE = "predictions.json"
 PREDICTIONS_COMMAND_ATTR = "predict_command"
@@ -40,37 +56,209 @@ def add_predictions_from_file(
     FileNotFoundError
         If the file model_version.location/predictions.csv does not exist
     """
+    results = iter_predictions_file(results_path)
+    add_predictions_from_dict(
+        session, model_version, results, dataset_id, run_time, run_id
+    )
+
+
+def read_predictions_file(results_path):
+    """Load the predictions from a model version's predictions file.
+
+    Parameters
+    ----------
+    results_path : str or Path
+       Full path to file containing model predictions (usually called
+       predictions.json)
+
+    Returns
+    -------
+    dict
+        Predictions as {record_id: {output_name: value}}
+
+    Raises
+    ------
+    FileNotFoundError
+        If results_path does not exist
+    """
     if not os.path.exists(results_path):
         raise FileNotFoundError(f"{results_path} not found.")
 
     with open(results_path, "r") as f:
-        results = json.load(f)
+        return json.load(f)
+
+
+def iter_predictions_file(results_path):
+    """Parse the predictions in a model version's predictions file one record at a
+    time, so the whole file doesn't need to be loaded into memory.
+
+    Parameters
+    ----------
+    results_path : str or Path
+       Full path to file containing model predictions (usually called
+       predictions.json)
+
+    Yields
+    ------
+    str, dict
+        Record ID and its predictions as {output_name: value}
+
+    Raises
+    ------
+    FileNotFoundError
+        If results_path does not exist
+    """
+    if not os.path.exists(results_path):
+        raise FileNotFoundError(f"{results_path} not found.")
+
+    with open(results_path, "rb") as f:
+        # use_float gives floats rather than Decimals, as with json.load
+        yield from ijson.kvitems(f, "", use_float=True)
+
+
+def add_predictions_from_dict(
+    session, model_version, results, dataset_id, run_time, run_id
+):
+    """Add predictions returned in memory by a model version's Python entry-point (or
+    loaded from its predictions file) to the database after a new run.
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session
+        ModMon database session
+    model_version : modmon.schema.db.ModelVersion
+        Model version object
+    results : dict, pandas.DataFrame or iterable
+        Predictions, either a dict of {record_id: {output_name: value}} (as in
+        predictions.json), a DataFrame with record IDs as the index and a column for
+        each output, or an iterable of (record_id, {output_name: value}) pairs (e.g.
+        from iter_predictions_file). The predictions are read once, as they're
+        inserted, so a generator is never fully loaded into memory.
+    dataset_id : int
+        ID of the dataset the predictions were made for
+    run_time : str or datetime.datetime
+        Time the model version was run to generate the predictions
+    run_id : int
+        Run ID to assign to this data
+
+    Notes
+    -----
+    If sketches are enabled in modmon.config.config["sketch"], a sketch of the
+    distribution of each output is also added to the run_sketch table (see
+    modmon.metrics.sketch). If rollups are enabled in modmon.config.config["rollup"],
+    a rollup of each output is added to the prediction_rollup table (see
+    modmon.metrics.rollup).
+    """
+    if hasattr(results, "to_dict"):
+        results = iter_frame_items(results)
+    elif hasattr(results, "items"):
+        results = results.items()
 
     modelid = model_version.modelid
     modelversion = model_version.modelversion
 
-    # session may have new objects added that are needed for insert to be valid (e.g.
-    # a new dataset may have been defined earlier in the run). So commit any changes
-    # here first before continuing.
-    session.commit()
+    sketch_enabled, max_bins, compression, chunk_size = get_sketch_config()
+    rollup_enabled = get_rollup_config()[0]
+    sketcher = None
+    if sketch_enabled or rollup_enabled:
+        # summarise the distribution of each output as the predictions are inserted,
+        # so later comparisons between runs don't need to read them again
+        sketcher = RunSketcher(max_bins, compression, chunk_size)
+        results = sketcher.sketch(results)
 
-    engine = session.bind
-    engine.execute(
-        Prediction.__table__.insert(),
-        [
+    # publish in the session's transaction, which may contain objects the predictions
+    # refer to (e.g. a new dataset defined earlier in the run), so the run is only
+    # saved if the whole run succeeds
+    bulk_insert(
+        session.bind,
+        Prediction.__table__,
+        (
             {
                 "modelid": modelid,
                 "modelversion": modelversion,
                 "datasetid": dataset_id,
                 "runtime": run_time,
                 "runid": run_id,
-                "recordid": idx,
+                "recordid": str(idx),
                 "values": values,
             }
-            for idx, values in results.items()
-        ]
+            for idx, values in results
+        ),
+        session=session,
     )
 
+    if sketcher is not None and sketcher.n_rows > 0:
+        sketches = sketcher.get_sketches()
+        if sketch_enabled:
+            add_run_sketches(
+                session, model_version, dataset_id, run_id, sketches, sketcher.part
+            )
+        if rollup_enabled:
+            add_prediction_rollups(
+                session,
+                model_version,
+                dataset_id,
+                run_id,
+                run_time,
+                sketches,
+                sketcher.part,
+            )
+
+
+def iter_frame_items(frame, chunk_size=None):
+    """Convert a DataFrame of predictions to (record_id, {output_name: value}) pairs,
+    a chunk of rows at a time.
+
+    Parameters
+    ----------
+    frame : pandas.DataFrame
+        Predictions with record IDs as the index and a column for each output
+    chunk_size : int, optional
+        Number of rows to convert at a time, by default None which uses the chunk size
+        in modmon.config.config["ingest"] (see modmon.db.ingest.get_ingest_config)
+
+    Yields
+    ------
+    str, dict
+        Record ID and its predictions as {output_name: value}
+    """
+    if chunk_size is None:
+        chunk_size = get_ingest_config()[1]
+    for start in range(0, len(frame), chunk_size):
+        chunk = frame.iloc[start : start + chunk_size].to_dict("index")
+        for idx, values in chunk.items():
+            yield str(idx), values
+
+
+def get_replaced_datasets(windows, session=None):
+    """Get the IDs of the datasets of windows that models were re-run on with replace,
+    so that drift and label metrics are recalculated for the new runs.
+
+    Parameters
+    ----------
+    windows : list
+        Dataset windows, each a dict with the keys "start_date", "end_date" and
+        "database"
+    session : sqlalchemy.orm.session.Session, optional
+        ModMon database session or None in which case one will be created, by default
+        None
+
+    Returns
+    -------
+    list
+        IDs of the datasets of the windows that exist in the database
+    """
+    if not session:
+        session = get_session()
+        close_session = True  # if session is created in function, close it in function
+    else:
+        close_session = False  # if session given, leave it open
+
+    dataset_ids = [find_dataset(session, **window) for window in windows]
+    if close_session:
+        session.close()
+    return [dataset_id for dataset_id in dataset_ids if dataset_id is not None]
+
 
 def prediction_model(
     model_version,
@@ -78,6 +266,7 @@ def prediction_model(
     end_date=None,
     database=None,
     force=False,
+    replace=False,
     session=None,
     save_to_db=True,
     verbose=True,
@@ -99,6 +288,9 @@ def prediction_model(
     force : bool, optional
         If True regenerate results for a model version even if they already exist in the
         database for the same dataset, by default False
+    replace : bool, optional
+        If True regenerate results even if they already exist, and replace the previous
+        results for the same model version and dataset, by default False
     session : sqlalchemy.orm.session.Session, optional
         ModMon database session or None in which case one will be created, by default
         None
@@ -125,19 +317,55 @@ def prediction_model(
         results_file=PREDICTIONS_FILE,
         results_table=Prediction,
         file_to_db=add_predictions_from_file,
+        results_to_db=add_predictions_from_dict,
         start_date=start_date,
         end_date=end_date,
         database=database,
         force=force,
+        replace=replace,
         session=session,
         save_to_db=save_to_db,
         verbose=verbose,
         capture_output=capture_output,
     )
+    # drift and label metrics of replaced runs are recalculated for the new run
+    dataset_ids = None
+    if save_to_db and replace:
+        window = {"start_date": start_date, "end_date": end_date, "database": database}
+        dataset_ids = get_replaced_datasets([window], session=session)
+    drift_enabled = get_drift_config()[0]
+    if save_to_db and drift_enabled:
+        update_drift_scores(
+            session=session,
+            model_versions=[model_version],
+            force=replace,
+            dataset_ids=dataset_ids,
+        )
+    if save_to_db and get_evaluate_config()[0]:
+        update_label_scores(
+            session=session,
+            model_versions=[model_version],
+            force=replace,
+            dataset_ids=dataset_ids,
+        )
+        if get_bootstrap_config()[0]:
+            update_bootstrap_scores(session=session, model_versions=[model_version])
+    if save_to_db and get_anomaly_config()[0]:
+        # drift and label metrics are saved as scores
+        update_anomalies(session=session, verbose=verbose)
 
 
 def prediction_all_models(
-    start_date=None, end_date=None, database=None, force=False, run_inactive=False
+    start_date=None,
+    end_date=None,
+    database=None,
+    force=False,
+    replace=False,
+    run_inactive=False,
+    windows=None,
+    jobs=1,
+    num_shards=1,
+    shard_by="hash",
 ):
     """Run all active model versions in the database to generate metrics values for a
     new dataset.
@@ -153,6 +381,26 @@ def prediction_all_models(
     force : bool, optional
         If True regenerate results for a model version even if they already exist in the
         database for the same dataset, by default False
+    replace : bool, optional
+        If True regenerate results even if they already exist, and replace the previous
+        results for the same model version and dataset, by default False
+    run_inactive : bool, optional
+        If True also run inactive model versions, by default False
+    windows : list, optional
+        List of dataset windows to run all models on, each a dict with the keys
+        "start_date", "end_date" and "database" (see
+        modmon.models.run.load_windows_file). If set start_date, end_date and database
+        are ignored. By default None.
+    jobs : int, optional
+        Number of model versions to run at the same time, with their results saved to
+        the database in batches (see modmon.models.run.run_models_parallel), by default
+        1
+    num_shards : int, optional
+        Number of parallel shards to split each window into for models whose
+        predict_command contains the <shard> placeholder (see
+        modmon.models.run.run_model_shards), by default 1
+    shard_by : str, optional
+        How to split windows into shards, "hash" or "date", by default "hash"
     """
 
     run_all_models(
@@ -160,13 +408,57 @@ def prediction_all_models(
         results_file=PREDICTIONS_FILE,
         results_table=Prediction,
         file_to_db=add_predictions_from_file,
+        results_to_db=add_predictions_from_dict,
         start_date=start_date,
         end_date=end_date,
         database=database,
         force=force,
+        replace=replace,
         run_inactive=run_inactive,
+        windows=windows,
+        read_results=read_predictions_file,
+        jobs=jobs,
+        num_shards=num_shards,
+        shard_by=shard_by,
     )
 
+    drift_enabled = get_drift_config()[0]
+    labels_enabled = get_evaluate_config()[0]
+    if drift_enabled or labels_enabled:
+        session = get_session()
+        model_versions = get_model_versions(session, get_inactive=run_inactive)
+        # drift and label metrics of replaced runs are recalculated for the new runs
+        dataset_ids = None
+        if replace:
+            if windows is None:
+                windows = [
+                    {
+                        "start_date": start_date,
+                        "end_date": end_date,
+                        "database": database,
+                    }
+                ]
+            dataset_ids = get_replaced_datasets(windows, session=session)
+        if drift_enabled:
+            update_drift_scores(
+                session=session,
+                model_versions=model_versions,
+                force=replace,
+                dataset_ids=dataset_ids,
+            )
+        if labels_enabled:
+            update_label_scores(
+                session=session,
+                model_versions=model_versions,
+                force=replace,
+                dataset_ids=dataset_ids,
+            )
+            if get_bootstrap_config()[0]:
+                update_bootstrap_scores(session=session, model_versions=model_versions)
+        if get_anomaly_config()[0]:
+            update_anomalies(session=session)
+        session.close()
+
 
 def main():
     """Run predictions for all active model versions in the datbase on a new dataset.
@@ -186,11 +478,48 @@ def main():
         help="If set, run models even if results already exist in the database",
         action="store_true",
     )
+    parser.add_argument(
+        "--replace",
+        help=(
+            "If set, run models even if results already exist in the database, and "
+            "replace the existing results with the new ones"
+        ),
+        action="store_true",
+    )
     parser.add_argument(
         "--run_inactive",
         help="If set, also run models marked as inactive",
         action="store_true",
     )
+    parser.add_argument(
+        "--windows_file",
+        help=(
+            "CSV file of dataset windows to run all models on (with columns "
+            "start_date, end_date and/or database), e.g. to backfill results"
+        ),
+    )
+    parser.add_argument(
+        "--shards",
+        help=(
+            "Number of shards to split each dataset into and run in parallel, for "
+            "models whose predict_command contains <shard>"
+        ),
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--shard_by",
+        help="How to split datasets into shards (default: hash)",
+        choices=SHARD_MODES,
+        default="hash",
+    )
+
+    parser.add_argument(
+        "--jobs",
+        help="Number of models to run at the same time (default: 1)",
+        type=int,
+        default=1,
+    )
 
     args = parser.parse_args()
     # TODO currently only deal with dates, not times
@@ -202,11 +531,20 @@ def main():
         end_date = dateparser.parse(args.end_date).date()
     else:
         end_date = None
+    if args.windows_file is not None:
+        windows = load_windows_file(args.windows_file)
+    else:
+        windows = None
 
     prediction_all_models(
         start_date,
         end_date,
         args.database,
         force=args.force,
+        replace=args.replace,
         run_inactive=args.run_inactive,
+        windows=windows,
+        jobs=args.jobs,
+        num_shards=args.shards,
+        shard_by=args.shard_by,
     )
@@ -3,17 +3,24 @@ from datetime import datetime
 import json
 import os
 from pathlib import Path
-import shutil
 import subprocess
 import tempfile
 
 import dateparser
 
+from ..config import config
 from ..db.connect import get_session
-from ..db.schema import ModelVersion
+from ..db.schema import Alert, AlertRule, ModelVersion, Score
+from ..metrics.alerts import get_severity
+from ..metrics.utils import RESERVED_PREFIX, parse_reserved_metric_name
 from .run import run_model_command, create_dataset, result_exists, get_iso_time, get_model_versions
 from .score import score_model
 from .setup import setup_model
+from .store import copy_model_from_storage
+
+# Policies for choosing which model versions to retrain: all retrains every model
+# version, drift only those whose latest scores breach the configured thresholds
+RETRAIN_POLICIES = ["all", "drift"]
 
 
 def increment_version_str(version_str):
@@ -66,7 +73,7 @@ def retrain_model(
     with tempfile.TemporaryDirectory() as tmp_dir:
         # copy model version to a temporary directory
         print("Copying model to temporary directory...")
-        shutil.copytree(model_version.location, tmp_dir, dirs_exist_ok=True)
+        copy_model_from_storage(model_version.location, tmp_dir)
 
         # delete old outputs
         # TODO delete old model files
@@ -112,15 +119,163 @@ def retrain_model(
         setup_model(tmp_dir, check_first=False, set_old_inactive=True, session=session)
 
 
+def get_retrain_config(retrain_config=None):
+    """Get the retraining policy settings from the config file.
+
+    Parameters
+    ----------
+    retrain_config : configparser.SectionProxy, optional
+        configparser section optionally containing the key 'driftthresholds', by
+        default None which uses modmon.config.config["retrain"] if it exists.
+
+    Returns
+    -------
+    dict
+        {statistic: threshold} for drift statistics (see modmon.metrics.drift). Model
+        versions whose latest drift for any output is above the threshold are
+        retrained by the drift policy.
+    """
+    if retrain_config is None:
+        retrain_config = config["retrain"] if "retrain" in config else {}
+    thresholds = retrain_config.get("driftthresholds", "psi:0.2")
+    drift_thresholds = {}
+    for item in thresholds.split(","):
+        if item.strip():
+            statistic, threshold = item.split(":")
+            drift_thresholds[statistic.strip()] = float(threshold)
+    return drift_thresholds
+
+
+def get_degradation(session, model_version, drift_thresholds):
+    """Check whether the latest scores of a model version breach the retraining
+    thresholds: the drift thresholds in the config file, or any alert rule (see
+    modmon.metrics.alerts).
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session
+        ModMon database session
+    model_version : modmon.schema.db.ModelVersion
+        Model version object
+    drift_thresholds : dict
+        {statistic: threshold} for drift statistics (see get_retrain_config)
+
+    Returns
+    -------
+    float, list
+        How far the scores are beyond the thresholds (the largest severity of any
+        breach, see modmon.metrics.alerts.get_severity, or 0 if there are none), and a
+        description of each breach
+    """
+    # dataset of the model version's most recent scores
+    latest = (
+        session.query(Score.datasetid)
+        .filter(
+            Score.modelid == model_version.modelid,
+            Score.modelversion == model_version.modelversion,
+            ~Score.isreference,
+        )
+        .order_by(Score.runtime.desc(), Score.runid.desc())
+        .first()
+    )
+    if latest is None:
+        return 0, []
+    dataset_id = latest[0]
+    scores = (
+        session.query(Score.metric, Score.value, Score.runid)
+        .filter(
+            Score.modelid == model_version.modelid,
+            Score.modelversion == model_version.modelversion,
+            Score.datasetid == dataset_id,
+            ~Score.isreference,
+            Score.slice == "",
+        )
+        .order_by(Score.runid)
+        .all()
+    )
+    # latest score for each metric on the dataset
+    scores = {metric: (value, run_id) for metric, value, run_id in scores}
+
+    breaches = []
+    for metric, (value, _) in scores.items():
+        if not metric.startswith(RESERVED_PREFIX):
+            continue
+        statistic, column = parse_reserved_metric_name(metric)
+        threshold = drift_thresholds.get(statistic)
+        if threshold is not None and value > threshold:
+            breaches.append(
+                (
+                    get_severity("max", threshold, value),
+                    f"{statistic} of {column} is {value:.4g} (threshold {threshold})",
+                )
+            )
+
+    alerts = (
+        session.query(Alert, AlertRule.kind, AlertRule.threshold)
+        .join(AlertRule)
+        .filter(
+            Alert.modelid == model_version.modelid,
+            Alert.modelversion == model_version.modelversion,
+            Alert.datasetid == dataset_id,
+            Alert.runid.in_({run_id for _, run_id in scores.values()}),
+        )
+        .all()
+    )
+    for alert, kind, threshold in alerts:
+        breaches.append(
+            (
+                get_severity(kind, threshold, alert.value, alert.baseline),
+                alert.message,
+            )
+        )
+
+    if not breaches:
+        return 0, []
+    breaches.sort(key=lambda breach: breach[0], reverse=True)
+    return breaches[0][0], [reason for _, reason in breaches]
+
+
+def select_degraded_models(session, model_versions, drift_thresholds=None):
+    """Select the model versions whose latest scores breach the retraining thresholds,
+    most degraded first.
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session
+        ModMon database session
+    model_versions : list
+        ModelVersion objects to check
+    drift_thresholds : dict, optional
+        {statistic: threshold} for drift statistics, by default None which uses the
+        values in the config file (see get_retrain_config)
+
+    Returns
+    -------
+    list
+        (model_version, severity, reasons) for each degraded model version, in
+        decreasing order of severity (see get_degradation)
+    """
+    if drift_thresholds is None:
+        drift_thresholds = get_retrain_config()
+    degraded = []
+    for mv in model_versions:
+        severity, reasons = get_degradation(session, mv, drift_thresholds)
+        if reasons:
+            degraded.append((mv, severity, reasons))
+    degraded.sort(key=lambda item: item[1], reverse=True)
+    return degraded
+
+
 def retrain_all_models(
     start_date=None,
     end_date=None,
     database=None,
     force=False,
     retrain_inactive=False,
+    policy="all",
 ):
-    """Retrain all models in the database for the specified dataset and save
-    the new models to the database.
+    """Retrain all models in the database (or only those that have degraded) for the
+    specified dataset and save the new models to the database.
 
     Parameters
     ----------
@@ -133,7 +288,16 @@ def retrain_all_models(
     force : bool, optional
         If True regenerate results for a model version even if they already exist in the
         database for the same dataset, by default False
+    retrain_inactive : bool, optional
+        If True also retrain inactive model versions, by default False
+    policy : str, optional
+        Which model versions to retrain, one of RETRAIN_POLICIES: "all" retrains all of
+        them, "drift" only those whose latest drift or scores breach the configured
+        thresholds (see select_degraded_models), most degraded first. By default "all".
     """
+    if policy not in RETRAIN_POLICIES:
+        raise ValueError(f"policy must be one of {RETRAIN_POLICIES}, not {policy}")
+
     # Set up db connection
     print("Connecting to monitoring database...")
     session = get_session()
@@ -143,6 +307,16 @@ def retrain_all_models(
     model_versions = get_model_versions(session, get_inactive=retrain_inactive)
     print(f"found {len(model_versions)} model versions.")
 
+    if policy == "drift":
+        degraded = select_degraded_models(session, model_versions)
+        print(f"{len(degraded)} model versions breach the retraining thresholds.")
+        for mv, severity, reasons in degraded:
+            print(
+                f"ID {mv.modelid} VERSION {mv.modelversion} "
+                f"(severity {severity:.2f}): {'; '.join(reasons)}"
+            )
+        model_versions = [mv for mv, _, _ in degraded]
+
     if len(model_versions) == 0:
         print("No model versions found. Returning.")
         return
@@ -200,6 +374,16 @@ def main():
         help="If set, also retrain models marked as inactive",
         action="store_true",
     )
+    parser.add_argument(
+        "--policy",
+        help=(
+            "Which model versions to retrain: all (default), or drift to only retrain "
+            "those whose latest drift or scores breach the configured thresholds, "
+            "most degraded first"
+        ),
+        choices=RETRAIN_POLICIES,
+        default="all",
+    )
 
     args = parser.parse_args()
     # TODO currently only deal with dates, not times
@@ -218,4 +402,5 @@ def main():
         database=args.database,
         force=args.force,
         retrain_inactive=args.run_inactive,
+        policy=args.policy,
     )
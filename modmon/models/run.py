@@ -1,14 +1,43 @@
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
+import csv
+from datetime import datetime, timedelta
+from functools import partial
+import json
 import os
+import shlex
 import subprocess
 from pathlib import Path
+import shutil
 
+import dateparser
 from sqlalchemy import func
 
+from ..data.cache import cache_enabled, cached_window
 from ..db.connect import get_session
-from ..db.schema import ModelVersion, Dataset
+from ..db.schema import (
+    ModelVersion,
+    Dataset,
+    LabelEvaluation,
+    PredictionRollup,
+    RunSketch,
+)
 from ..db.utils import get_unique_id
+from ..db.writer import ResultWriter
+from ..metrics.utils import RESERVED_PREFIX
 from ..envs.utils import create_env
+from ..envs.worker import ModelWorker, WorkerError, WorkerPool, workers_enabled
+
+# Files and directories created in the model directory for models run on many dataset
+# windows at once
+WINDOWS_FILE = "windows.json"
+WINDOWS_OUTPUT_DIR = "modmon_windows"
+
+# Ways of splitting a dataset window into shards (see run_model_shards)
+SHARD_MODES = ["hash", "date"]
+
+# Tables summarising each run of a results table, which are deleted with the run
+RUN_SUMMARY_TABLES = {"prediction": [RunSketch, PredictionRollup, LabelEvaluation]}
 
 
 def result_exists(session, table, model_id, model_version, dataset_id):
@@ -53,6 +82,54 @@ def result_exists(session, table, model_id, model_version, dataset_id):
         return False
 
 
+def delete_previous_results(session, table, model_version, dataset_id, run_id):
+    """Delete all results for a model version and dataset except those from one run,
+    in a single statement in the session's current transaction. Used to replace the
+    previous results when a model is re-run. Reference results (where the table has an
+    isreference column) are kept, as are scores of reserved metrics (drift and label
+    metrics calculated by ModMon, see modmon.metrics.utils), which are replaced when
+    they're recalculated for the new run. Summaries of the deleted runs (see
+    RUN_SUMMARY_TABLES) are also deleted.
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session
+        ModMon database session
+    table : class
+        Results table from modmon.db.schema, e.g. Prediction
+    model_version : modmon.schema.db.ModelVersion
+        Model version object
+    dataset_id : int
+        ID of the dataset to delete results for
+    run_id : int
+        ID of the run to keep
+
+    Returns
+    -------
+    int
+        Number of rows deleted
+    """
+    for summary_table in RUN_SUMMARY_TABLES.get(table.__tablename__, []):
+        session.query(summary_table).filter(
+            summary_table.modelid == model_version.modelid,
+            summary_table.modelversion == model_version.modelversion,
+            summary_table.datasetid == dataset_id,
+            summary_table.runid != run_id,
+        ).delete(synchronize_session=False)
+
+    query = session.query(table).filter(
+        table.modelid == model_version.modelid,
+        table.modelversion == model_version.modelversion,
+        table.datasetid == dataset_id,
+        table.runid != run_id,
+    )
+    if hasattr(table, "isreference"):
+        query = query.filter(table.isreference.is_(False))
+    if hasattr(table, "metric"):
+        query = query.filter(~table.metric.like(f"{RESERVED_PREFIX}%"))
+    return query.delete(synchronize_session=False)
+
+
 def get_model_version_file(model_version, file_path):
     """Build the path to the expected location of a model_version file.
 
@@ -72,7 +149,183 @@ def get_model_version_file(model_version, file_path):
     return Path(model_version.location, file_path)
 
 
-def build_run_cmd(raw_cmd, start_date=None, end_date=None, database=None):
+def get_python_entrypoint(model_version, command_attr, run_dir=None):
+    """Get the Python entry-point (if any) defined in a model's metadata for the task
+    run by command_attr. The "python_entrypoint" metadata key can either be a string
+    "module:function" (the entry-point for scoring), or a dict with the keys "score"
+    and/or "predict" and entry-point strings as values.
+
+    Parameters
+    ----------
+    model_version : modmon.schema.db.ModelVersion
+        Model version object
+    command_attr : str
+        Attribute of model_version that contains the model command the entry-point
+        replaces, e.g. "score_command"
+    run_dir : str or Path, optional
+        If set the directory containing the model code and metadata, otherwise uses
+        model_version.location, by default None
+
+    Returns
+    -------
+    str or None
+        Entry-point in the format "module:function", or None if the model doesn't
+        define an entry-point for this task.
+    """
+    if run_dir is None:
+        run_dir = model_version.location
+    metadata_path = Path(run_dir, "metadata.json")
+    if not os.path.exists(metadata_path):
+        return None
+
+    with open(metadata_path, "r") as f:
+        entrypoints = json.load(f).get("python_entrypoint")
+    if entrypoints is None:
+        return None
+    if isinstance(entrypoints, str):
+        entrypoints = {"score": entrypoints}
+
+    task = command_attr.replace("_command", "")
+    return entrypoints.get(task)
+
+
+def write_windows_file(run_dir, windows, output_dirs):
+    """Write the JSON file listing dataset windows passed to model commands containing
+    the <windows_file> placeholder. The file contains a list with an entry for each
+    window, with the keys "start_date", "end_date", "database" and "output_dir". The
+    model must write its results file (e.g. scores.csv) for each window to output_dir
+    (a path relative to the model directory).
+
+    Parameters
+    ----------
+    run_dir : str or Path
+        Model directory to write the file to
+    windows : list
+        List of windows, each a dict with the keys "start_date", "end_date" and
+        "database"
+    output_dirs : list
+        Output directory for each window, relative to run_dir
+
+    Returns
+    -------
+    pathlib.Path
+        Path to the created file
+    """
+    windows_path = Path(run_dir, WINDOWS_FILE)
+    contents = [
+        {
+            "start_date": None if w["start_date"] is None else str(w["start_date"]),
+            "end_date": None if w["end_date"] is None else str(w["end_date"]),
+            "database": w["database"],
+            "output_dir": str(output_dir),
+        }
+        for w, output_dir in zip(windows, output_dirs)
+    ]
+    with open(windows_path, "w") as f:
+        json.dump(contents, f, indent=2)
+
+    return windows_path
+
+
+def get_shard_file(results_file, shard):
+    """Get the name of the results file created by one shard of a sharded run.
+
+    Parameters
+    ----------
+    results_file : str or Path
+        Name of the results file for an unsharded run, e.g. predictions.json
+    shard : int
+        Shard index
+
+    Returns
+    -------
+    str
+        Results file name with the shard index appended, e.g. predictions_0.json
+    """
+    results_file = Path(results_file)
+    return f"{results_file.stem}_{shard}{results_file.suffix}"
+
+
+def get_unsharded_results_file(command, results_file):
+    """Get the name of the results file created by a model command run on a whole
+    dataset window, rather than in shards. Commands that contain the <shard>
+    placeholder are run as shard 0 of 1, and write the results file of shard 0.
+
+    Parameters
+    ----------
+    command : str
+        Model command, possibly containing the <shard> placeholder
+    results_file : str or Path
+        Name of the results file for an unsharded run, e.g. predictions.json
+
+    Returns
+    -------
+    str or Path
+        Name of the results file the command creates, e.g. predictions_0.json for
+        commands containing <shard>
+    """
+    if "<shard>" in command:
+        return get_shard_file(results_file, 0)
+    return results_file
+
+
+def split_date_range(start_date, end_date, num_shards):
+    """Split a date range into contiguous, non-overlapping sub-ranges of whole days.
+
+    Parameters
+    ----------
+    start_date : str, datetime.date or datetime.datetime
+        First day in the range
+    end_date : str, datetime.date or datetime.datetime
+        Last day in the range (inclusive)
+    num_shards : int
+        Number of sub-ranges to split the range into. Fewer are returned if the range
+        contains fewer than num_shards days.
+
+    Returns
+    -------
+    list
+        List of (start_date, end_date) tuples of datetime.date, with end_date
+        inclusive.
+
+    Raises
+    ------
+    ValueError
+        If end_date is before start_date
+    """
+    if isinstance(start_date, str):
+        start_date = dateparser.parse(start_date)
+    if isinstance(end_date, str):
+        end_date = dateparser.parse(end_date)
+    if isinstance(start_date, datetime):
+        start_date = start_date.date()
+    if isinstance(end_date, datetime):
+        end_date = end_date.date()
+
+    n_days = (end_date - start_date).days + 1
+    if n_days < 1:
+        raise ValueError(f"end_date {end_date} is before start_date {start_date}")
+
+    num_shards = min(num_shards, n_days)
+    return [
+        (
+            start_date + timedelta(days=i * n_days // num_shards),
+            start_date + timedelta(days=(i + 1) * n_days // num_shards - 1),
+        )
+        for i in range(num_shards)
+    ]
+
+
+def build_run_cmd(
+    raw_cmd,
+    start_date=None,
+    end_date=None,
+    database=None,
+    data_dir=None,
+    windows_file=None,
+    shard=None,
+    num_shards=None,
+):
     """Replace placeholder inputs in the model command with given values.
 
     Parameters
@@ -91,6 +344,18 @@ def build_run_cmd(raw_cmd, start_date=None, end_date=None, database=None):
     database : str, optional
         Name of the database to pass to command (metrics script should use this to
         modify the database it connects to), by default None
+    data_dir : str or Path, optional
+        Path to the locally cached copy of the dataset window to pass to command (see
+        modmon.data.cache), by default None
+    windows_file : str or Path, optional
+        Path to a JSON file listing the dataset windows to pass to command, for models
+        that process many windows in one run (see write_windows_file), by default None
+    shard : int, optional
+        Index of the shard of the dataset to process, for models run in parallel
+        shards (see run_model_shards), by default None which runs the command on the
+        whole dataset as shard 0 (see get_unsharded_results_file)
+    num_shards : int, optional
+        Total number of shards the dataset is split into, by default None (1 shard)
 
     Returns
     -------
@@ -104,10 +369,20 @@ def build_run_cmd(raw_cmd, start_date=None, end_date=None, database=None):
         If raw_cmd does not contain at least one of the <start_date>, <end_date> and
         <database> placeholders.
     """
+    if shard is None:
+        # not run in shards, so the whole dataset is the only shard
+        shard, num_shards = 0, 1
     placeholders = {
         "<start_date>": start_date,
         "<end_date>": end_date,
         "<database>": database,
+        # paths are quoted in case they contain spaces
+        "<data_dir>": None if data_dir is None else shlex.quote(str(data_dir)),
+        "<windows_file>": (
+            None if windows_file is None else shlex.quote(str(windows_file))
+        ),
+        "<shard>": shard,
+        "<num_shards>": num_shards,
     }
 
     no_placeholders_found = True
@@ -160,6 +435,39 @@ def get_iso_time():
     return datetime.now().replace(microsecond=0).isoformat()
 
 
+def find_dataset(session, start_date=None, end_date=None, database=None):
+    """Find the ID of the dataset with the specified start_date, end_date and database.
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session
+        ModMon database session
+    start_date : str or datetime.datetime, optional
+        Dataset start date, by default None
+    end_date : str or datetime.datetime, optional
+        Dataset end date, by default None
+    database : str , optional
+        Dataset database name, by default None
+
+    Returns
+    -------
+    int or None
+        ID of the matching dataset, or None if there isn't one
+    """
+    # query database for a dataset that matches the given inputs
+    # TODO currently only checks by date, not times
+    query = session.query(Dataset)
+    if start_date is not None:
+        query = query.filter(func.date(Dataset.start_date) == start_date)
+    if end_date is not None:
+        query = query.filter(func.date(Dataset.end_date) == end_date)
+    if database is not None:
+        query = query.filter_by(databasename=database)
+
+    dataset = query.first()
+    return dataset.datasetid if dataset else None
+
+
 def create_dataset(session, start_date=None, end_date=None, database=None):
     """Create a new Dataset in the database. If a dataset already exists for the
     specified start_date, end_date and database, return the ID of that dataset instead.
@@ -191,21 +499,10 @@ def create_dataset(session, start_date=None, end_date=None, database=None):
             "At least one of start_date, end_date and database " "must be defined"
         )
 
-    # query database for a dataset that matches the given inputs
-    # TODO currently only checks by date, not times
-    query = session.query(Dataset)
-    if start_date is not None:
-        query = query.filter(func.date(Dataset.start_date) == start_date)
-    if end_date is not None:
-        query = query.filter(func.date(Dataset.end_date) == end_date)
-    if database is not None:
-        query = query.filter_by(databasename=database)
-
-    dataset = query.first()
-
     # if matching dataset exists return its id
-    if dataset:
-        return dataset.datasetid
+    dataset_id = find_dataset(session, start_date, end_date, database)
+    if dataset_id is not None:
+        return dataset_id
 
     else:
         # create id for dataset
@@ -226,6 +523,45 @@ def create_dataset(session, start_date=None, end_date=None, database=None):
         return dataset_id
 
 
+def run_shell_command(
+    run_cmd, env_cmd=None, run_dir=None, verbose=True, capture_output=False
+):
+    """Run a (model) command in a shell, optionally in an environment.
+
+    Parameters
+    ----------
+    run_cmd : str
+        Command to run, with any placeholders already replaced (see build_run_cmd)
+    env_cmd : str, optional
+        Command to activate the environment to run run_cmd in, by default None
+    run_dir : str or Path, optional
+        Working directory to run the command in, by default None
+    verbose : bool, optional
+        If True print additional progress messages, by default True
+    capture_output : bool, optional
+        Passed to subprocess.run, by default False
+    """
+    if verbose:
+        print(f"Running this command:\n{run_cmd}")
+    if env_cmd is not None:
+        run_cmd = f"{env_cmd} && {run_cmd}"
+        if verbose:
+            print(f"Running in this environment:\n{env_cmd}")
+
+    if verbose:
+        print("--- start subprocess ---")
+    subprocess.run(
+        run_cmd,
+        cwd=run_dir,
+        shell=True,
+        check=True,
+        capture_output=capture_output,
+        executable="/bin/bash",
+    )
+    if verbose:
+        print("--- end subprocess ---")
+
+
 def run_model_command(
     model_version,
     command=None,
@@ -237,9 +573,12 @@ def run_model_command(
     verbose=True,
     capture_output=False,
     run_dir=None,
+    windows_file=None,
 ):
     """
-    run a command for a model_version in its environment
+    run a command for a model_version in its environment, in a new subprocess.
+    windows_file replaces the <windows_file> placeholder for models that are run on
+    many dataset windows at once.
     """
     if command is None and command_attr is None:
         raise ValueError("Either the 'command' or 'command_attr' argument must be set")
@@ -268,47 +607,107 @@ def run_model_command(
         except FileNotFoundError:
             pass
 
-    run_cmd = build_run_cmd(command, start_date, end_date, database)
-    # run command
-    if verbose:
-        print(f"Running this command:\n{run_cmd}")
-    if env_cmd is not None:
-        run_cmd = f"{env_cmd} && {run_cmd}"
+    if "<data_dir>" in command and cache_enabled():
+        # extract the dataset window to the local cache (or reuse it if another model
+        # has already been run on this window) and keep it available during the run
+        data_window = cached_window(start_date, end_date, database, verbose=verbose)
+    else:
+        data_window = nullcontext()
+
+    with data_window as data_dir:
+        run_cmd = build_run_cmd(
+            command, start_date, end_date, database, data_dir, windows_file
+        )
+        run_shell_command(run_cmd, env_cmd, run_dir, verbose, capture_output)
+
+
+def run_model_entrypoint(
+    model_version,
+    entrypoint,
+    start_date=None,
+    end_date=None,
+    database=None,
+    verbose=True,
+    capture_output=False,
+    run_dir=None,
+    pool=None,
+):
+    """Call a model version's Python entry-point in a worker process running in its
+    environment, and return its results in memory.
+
+    Parameters
+    ----------
+    model_version : modmon.schema.db.ModelVersion
+        Model version object
+    entrypoint : str
+        Entry-point in the format "module:function". The function will be called with
+        the keyword arguments start_date, end_date and database.
+    start_date : str or datetime.datetime , optional
+        Dataset start date, by default None
+    end_date : str or datetime.datetime , optional
+        Dataset end date, by default None
+    database : str , optional
+        Dataset database name, by default None
+    verbose: bool, optional
+        If True print additional progress messages, by default True
+    capture_output: bool, optional
+        If True capture stdout and stderr of environment creation rather than printing
+        to console, by default False
+    run_dir: str or Path, optional
+        If set the directory containing the model code, otherwise uses
+        model_version.location, by default None
+    pool : modmon.envs.worker.WorkerPool, optional
+        If set call the entry-point in the model version's persistent worker from this
+        pool, so modules (and any artefacts they load) are only imported once. By
+        default None, which starts a new worker for this call.
+
+    Returns
+    -------
+    pandas.DataFrame, pandas.Series, dict or list
+        Value returned by the entry-point
+    """
+    if run_dir is None:
+        run_dir = model_version.location
+
+    kwargs = {
+        "start_date": None if start_date is None else str(start_date),
+        "end_date": None if end_date is None else str(end_date),
+        "database": database,
+    }
+    if pool is not None:
+        worker = pool.get_worker(model_version, run_dir, create_env, capture_output)
         if verbose:
-            print(f"Running in this environment:\n{env_cmd}")
+            print(f"Calling entry-point {entrypoint} with {kwargs}")
+        return worker.call(entrypoint, **kwargs)
 
     if verbose:
-        print("--- start subprocess ---")
-    subprocess.run(
-        run_cmd,
-        cwd=run_dir,
-        shell=True,
-        check=True,
+        print("Creating environment...")
+    env_cmd = create_env(
+        run_dir,
+        model_version.modelid,
+        model_version.modelversion,
         capture_output=capture_output,
-        executable="/bin/bash",
     )
+
     if verbose:
-        print("--- end subprocess ---")
+        print(f"Calling entry-point {entrypoint} with {kwargs}")
+    with ModelWorker(run_dir, env_cmd=env_cmd, verbose=verbose) as worker:
+        return worker.call(entrypoint, **kwargs)
 
 
-def run_model(
+def run_model_to_file(
     model_version,
     command_attr,
     results_file,
-    results_table,
-    file_to_db=None,
     start_date=None,
     end_date=None,
     database=None,
-    force=False,
-    session=None,
-    save_to_db=True,
     verbose=True,
     capture_output=False,
     run_dir=None,
 ):
-    """Run a model version's command to generate new results with the specified dataset
-    inputs.
+    """Run a model version's command to create its results file for a dataset,
+    deleting any results file left by a previous run first.
 
     Parameters
     ----------
@@ -317,27 +716,13 @@ def run_model(
     command_attr: str
         Attribute of model_version that contains the model command to run
     results_file : str or Path
-        Path to file that will be created by running model command
-    results_table : class
-        Table to save results to from modmon.db.schema
-    file_to_db : function , optional
-        Function to load results from results_file and add them to the results_table
-        table. Must be defined if reference is False. Must take arguments session,
-        model_version, results_path, dataset_id, run_time, run_id. By default None.
+        Name of the results file created by running the model command
     start_date : str or datetime.datetime , optional
         Dataset start date, by default None
     end_date : str or datetime.datetime , optional
         Dataset end date, by default None
     database : str , optional
         Dataset database name, by default None
-    force : bool, optional
-        If True regenerate results for a model version even if they already exist in the
-        database for the same dataset, by default False
-    session : sqlalchemy.orm.session.Session, optional
-        ModMon database session or None in which case one will be created, by default
-        None
-    save_to_db : bool, optional
-        If True add results to database, by default True
     verbose: bool, optional
         If True print additional progress messages, by default True
     capture_output: bool, optional
@@ -347,26 +732,145 @@ def run_model(
         If set the directory containing the model code and outputs, otherwise uses
         model_versioin.location, by default None
 
-    Raises
-    ------
-    FileNotFoundError
-        If the metrics file is not successfully created at
-        model_version.location/scores.csv after the model run.
+    Returns
+    -------
+    pathlib.Path
+        Path where the model should have created its results file (it's not checked
+        that the file exists)
     """
-    if not session:
-        session = get_session()
-        close_session = True  # if session is created in function, close it in function
+    results_file = get_unsharded_results_file(
+        getattr(model_version, command_attr), results_file
+    )
+    # delete any pre-existing metrics file
+    if run_dir is None:
+        results_path = get_model_version_file(model_version, results_file)
     else:
-        close_session = False  # if session given, leave it open
+        results_path = Path(run_dir, results_file)
+    try:
+        os.remove(results_path)
+    except FileNotFoundError:
+        pass
 
-    if save_to_db:
-        if verbose:
-            print("Creating dataset...")
-        dataset_id = create_dataset(session, start_date, end_date, database)
+    # models that take a list of windows are given a list with only this window,
+    # and write their results to the model directory as usual
+    if "<windows_file>" in getattr(model_version, command_attr):
+        window = {
+            "start_date": start_date,
+            "end_date": end_date,
+            "database": database,
+        }
+        windows_file = write_windows_file(results_path.parent, [window], ["."])
+    else:
+        windows_file = None
 
-        # Check whether scores already exists for this model version and dataset
-        if not force and result_exists(
-            session,
+    run_model_command(
+        model_version,
+        command_attr=command_attr,
+        start_date=start_date,
+        end_date=end_date,
+        database=database,
+        output_file=results_path,
+        verbose=verbose,
+        capture_output=capture_output,
+        run_dir=run_dir,
+        windows_file=windows_file,
+    )
+    return results_path
+
+
+def run_model(
+    model_version,
+    command_attr,
+    results_file,
+    results_table,
+    file_to_db=None,
+    start_date=None,
+    end_date=None,
+    database=None,
+    force=False,
+    replace=False,
+    session=None,
+    save_to_db=True,
+    verbose=True,
+    capture_output=False,
+    run_dir=None,
+    results_to_db=None,
+    pool=None,
+):
+    """Run a model version's command to generate new results with the specified dataset
+    inputs.
+
+    Parameters
+    ----------
+    model_version : modmon.schema.db.ModelVersion
+        Model version object
+    command_attr: str
+        Attribute of model_version that contains the model command to run
+    results_file : str or Path
+        Path to file that will be created by running model command
+    results_table : class
+        Table to save results to from modmon.db.schema
+    file_to_db : function , optional
+        Function to load results from results_file and add them to the results_table
+        table. Must be defined if reference is False. Must take arguments session,
+        model_version, results_path, dataset_id, run_time, run_id. By default None.
+    start_date : str or datetime.datetime , optional
+        Dataset start date, by default None
+    end_date : str or datetime.datetime , optional
+        Dataset end date, by default None
+    database : str , optional
+        Dataset database name, by default None
+    force : bool, optional
+        If True regenerate results for a model version even if they already exist in the
+        database for the same dataset, by default False
+    replace : bool, optional
+        If True regenerate results even if they already exist (as for force), and
+        replace the previous results for the same model version and dataset with the
+        new run in the same transaction, by default False
+    session : sqlalchemy.orm.session.Session, optional
+        ModMon database session or None in which case one will be created, by default
+        None
+    save_to_db : bool, optional
+        If True add results to database, by default True
+    verbose: bool, optional
+        If True print additional progress messages, by default True
+    capture_output: bool, optional
+        If True capture stdout and stderr of subprocess calls rather than printing to
+        console, by default False
+    run_dir: str or Path, optional
+        If set the directory containing the model code and outputs, otherwise uses
+        model_versioin.location, by default None
+    results_to_db : function, optional
+        Function to add in-memory results returned by a Python entry-point to the
+        results_table table. Must take arguments session, model_version, results,
+        dataset_id, run_time, run_id. If set, and the model defines a Python
+        entry-point for this command (see get_python_entrypoint), the entry-point is
+        called instead of running the command. By default None.
+    pool : modmon.envs.worker.WorkerPool, optional
+        If set call the model's Python entry-point (if it has one) in its persistent
+        worker from this pool, by default None. Model commands are always run in a new
+        subprocess.
+
+    Raises
+    ------
+    FileNotFoundError
+        If the metrics file is not successfully created at
+        model_version.location/scores.csv after the model run.
+    """
+    if not session:
+        session = get_session()
+        close_session = True  # if session is created in function, close it in function
+    else:
+        close_session = False  # if session given, leave it open
+
+    if save_to_db:
+        if verbose:
+            print("Creating dataset...")
+        dataset_id = create_dataset(session, start_date, end_date, database)
+
+        # Check whether scores already exists for this model version and dataset
+        if not (force or replace) and result_exists(
+            session,
             results_table,
             model_version.modelid,
             model_version.modelversion,
@@ -380,65 +884,630 @@ def run_model(
                 )
             return
 
-    if verbose:
-        print("Running script...")
-    # delete any pre-existing metrics file
-    
-    if run_dir is None:
-        results_path = get_model_version_file(model_version, results_file)
+    # Python entry-points are only used when saving to the database, as runs that
+    # aren't saved (e.g. reproducibility checks) need the results file.
+    entrypoint = None
+    if save_to_db and results_to_db is not None:
+        entrypoint = get_python_entrypoint(model_version, command_attr, run_dir)
+
+    if entrypoint is not None:
+        if verbose:
+            print("Running entry-point...")
+        run_time = get_iso_time()
+        results = run_model_entrypoint(
+            model_version,
+            entrypoint,
+            start_date=start_date,
+            end_date=end_date,
+            database=database,
+            verbose=verbose,
+            capture_output=capture_output,
+            run_dir=run_dir,
+            pool=pool,
+        )
+
     else:
-        results_path = Path(run_dir, results_file)
-    try:
-        os.remove(results_path)
-    except FileNotFoundError:
-        pass
+        if verbose:
+            print("Running script...")
+        run_time = get_iso_time()
+        results_path = run_model_to_file(
+            model_version,
+            command_attr,
+            results_file,
+            start_date=start_date,
+            end_date=end_date,
+            database=database,
+            verbose=verbose,
+            capture_output=capture_output,
+            run_dir=run_dir,
+        )
 
-    # run command
-    run_time = get_iso_time()
+    if save_to_db:
+        if verbose:
+            print("Adding results to database...")
+        if entrypoint is not None:
+            run_id = get_unique_id(session, results_table.runid)
+            results_to_db(session, model_version, results, dataset_id, run_time, run_id)
+        elif not os.path.exists(results_path):
+            run_cmd = getattr(model_version, command_attr)
+            raise FileNotFoundError(
+                f"{results_path} not found. "
+                f"This should be created by running {run_cmd}."
+            )
+        else:
+            run_id = get_unique_id(session, results_table.runid)
+            file_to_db(
+                session, model_version, results_path, dataset_id, run_time, run_id
+            )
+        if replace:
+            n_deleted = delete_previous_results(
+                session, results_table, model_version, dataset_id, run_id
+            )
+            if verbose:
+                print(f"Replaced {n_deleted} previous results")
+    # the dataset and results are committed together, so a failed run saves nothing
+    session.commit()
+
+    if close_session:
+        session.close()
+
+
+def run_model_windows(
+    model_version,
+    command_attr,
+    results_file,
+    results_table,
+    file_to_db,
+    windows,
+    force=False,
+    replace=False,
+    session=None,
+    save_to_db=True,
+    verbose=True,
+    capture_output=False,
+    run_dir=None,
+):
+    """Run a model version's command once to generate results for many dataset windows,
+    and save the results for each window as a separate dataset and run. The command
+    must contain the <windows_file> placeholder (see write_windows_file).
 
+    Parameters
+    ----------
+    model_version : modmon.schema.db.ModelVersion
+        Model version object
+    command_attr: str
+        Attribute of model_version that contains the model command to run
+    results_file : str or Path
+        Name of the results file the model creates for each window
+    results_table : class
+        Table to save results to from modmon.db.schema
+    file_to_db : function
+        Function to load results from a results file and add them to the results_table
+        table (see run_model)
+    windows : list
+        List of windows, each a dict with the keys "start_date", "end_date" and
+        "database"
+    force : bool, optional
+        If True regenerate results for windows that already have results in the
+        database, by default False
+    replace : bool, optional
+        If True regenerate results even if they already exist (as for force), and
+        replace the previous results for the same model version and dataset with the
+        new run in the same transaction, by default False
+    session : sqlalchemy.orm.session.Session, optional
+        ModMon database session or None in which case one will be created, by default
+        None
+    save_to_db : bool, optional
+        If True add results to database, by default True
+    verbose: bool, optional
+        If True print additional progress messages, by default True
+    capture_output: bool, optional
+        If True capture stdout and stderr of subprocess calls rather than printing to
+        console, by default False
+    run_dir: str or Path, optional
+        If set the directory containing the model code and outputs, otherwise uses
+        model_versioin.location, by default None
+
+    Raises
+    ------
+    FileNotFoundError
+        If the model didn't create results for all windows (results for the windows it
+        did create results for are still saved).
+    """
+    if not session:
+        session = get_session()
+        close_session = True  # if session is created in function, close it in function
+    else:
+        close_session = False  # if session given, leave it open
+
+    if run_dir is None:
+        run_dir = model_version.location
+
+    # only run windows that don't already have results
+    to_run = []
+    for window in windows:
+        dataset_id = None
+        if save_to_db:
+            dataset_id = create_dataset(session, **window)
+            if not (force or replace) and result_exists(
+                session,
+                results_table,
+                model_version.modelid,
+                model_version.modelversion,
+                dataset_id,
+            ):
+                if verbose:
+                    print(f"DB already contains results for window {window}. Skipping.")
+                continue
+        to_run.append((window, dataset_id))
+
+    if len(to_run) == 0:
+        if verbose:
+            print("No windows to run.")
+        return
+
+    # delete old outputs and create an empty output directory for each window
+    shutil.rmtree(Path(run_dir, WINDOWS_OUTPUT_DIR), ignore_errors=True)
+    output_dirs = [Path(WINDOWS_OUTPUT_DIR, str(i)) for i in range(len(to_run))]
+    for output_dir in output_dirs:
+        os.makedirs(Path(run_dir, output_dir))
+    windows_file = write_windows_file(
+        run_dir, [window for window, _ in to_run], output_dirs
+    )
+
+    if verbose:
+        print(f"Running script on {len(to_run)} windows...")
+    run_time = get_iso_time()
     run_model_command(
         model_version,
         command_attr=command_attr,
-        start_date=start_date,
-        end_date=end_date,
-        database=database,
-        output_file=results_path,
         verbose=verbose,
         capture_output=capture_output,
         run_dir=run_dir,
+        windows_file=windows_file,
     )
 
+    missing = []
     if save_to_db:
         if verbose:
             print("Adding results to database...")
-        if not os.path.exists(results_path):
-            run_cmd = getattr(model_version, command_attr)
-            raise FileNotFoundError(
-                f"{results_path} not found. "
-                f"This should be created by running {run_cmd}."
+        for (window, dataset_id), output_dir in zip(to_run, output_dirs):
+            results_path = Path(
+                run_dir,
+                output_dir,
+                get_unsharded_results_file(
+                    getattr(model_version, command_attr), results_file
+                ),
             )
-        else:
+            if not os.path.exists(results_path):
+                missing.append(str(results_path))
+                continue
             run_id = get_unique_id(session, results_table.runid)
             file_to_db(
                 session, model_version, results_path, dataset_id, run_time, run_id
             )
+            if replace:
+                delete_previous_results(
+                    session, results_table, model_version, dataset_id, run_id
+                )
     session.commit()
 
     if close_session:
         session.close()
 
+    if missing:
+        run_cmd = getattr(model_version, command_attr)
+        raise FileNotFoundError(
+            f"{missing} not found. These should be created by running {run_cmd}."
+        )
+
+
+def run_model_shards(
+    model_version,
+    command_attr,
+    results_file,
+    results_table,
+    file_to_db,
+    num_shards,
+    shard_by="hash",
+    start_date=None,
+    end_date=None,
+    database=None,
+    force=False,
+    replace=False,
+    session=None,
+    save_to_db=True,
+    verbose=True,
+    capture_output=False,
+    run_dir=None,
+):
+    """Split a dataset window into shards, run a model version's command on each shard
+    in parallel, and save the results of all the shards as a single run. The command
+    must contain the <shard> placeholder, and each shard must write its results to
+    results_file with the shard index appended (see get_shard_file). Each shard's
+    results are loaded as it finishes, and the run is committed in one transaction once
+    all the shards have succeeded, so a partial run is never saved.
+
+    Shards are defined either by the model itself (shard_by="hash"), which is given the
+    whole window and must only process the records with (a hash of) the record ID
+    modulo <num_shards> equal to <shard>, or by ModMon (shard_by="date"), which splits
+    the window into contiguous date ranges passed to each shard as <start_date> and
+    <end_date>.
+
+    Parameters
+    ----------
+    model_version : modmon.schema.db.ModelVersion
+        Model version object
+    command_attr: str
+        Attribute of model_version that contains the model command to run
+    results_file : str or Path
+        Name of the results file for an unsharded run, e.g. predictions.json
+    results_table : class
+        Table to save results to from modmon.db.schema
+    file_to_db : function
+        Function to load results from a results file and add them to the results_table
+        table (see run_model)
+    num_shards : int
+        Number of shards to split the window into
+    shard_by : str, optional
+        How to split the window, "hash" or "date", by default "hash"
+    start_date : str or datetime.datetime , optional
+        Dataset start date, by default None
+    end_date : str or datetime.datetime , optional
+        Dataset end date, by default None
+    database : str , optional
+        Dataset database name, by default None
+    force : bool, optional
+        If True regenerate results for a model version even if they already exist in the
+        database for the same dataset, by default False
+    replace : bool, optional
+        If True regenerate results even if they already exist (as for force), and
+        replace the previous results for the same model version and dataset with the
+        new run in the same transaction, by default False
+    session : sqlalchemy.orm.session.Session, optional
+        ModMon database session or None in which case one will be created, by default
+        None
+    save_to_db : bool, optional
+        If True add results to database, by default True
+    verbose: bool, optional
+        If True print additional progress messages, by default True
+    capture_output: bool, optional
+        If True capture stdout and stderr of subprocess calls rather than printing to
+        console, by default False
+    run_dir: str or Path, optional
+        If set the directory containing the model code and outputs, otherwise uses
+        model_versioin.location, by default None
+
+    Raises
+    ------
+    ValueError
+        If shard_by is not a valid mode, the command doesn't contain <shard>, or the
+        window can't be split by date.
+    FileNotFoundError
+        If a shard's results file is not created by the model run. The results of the
+        other shards are not saved.
+    """
+    if shard_by not in SHARD_MODES:
+        raise ValueError(f"shard_by must be one of {SHARD_MODES}, not {shard_by}")
+    command = getattr(model_version, command_attr)
+    if "<shard>" not in command:
+        raise ValueError(f"Command must contain <shard> to be run in shards: {command}")
+
+    if shard_by == "date":
+        if start_date is None or end_date is None:
+            raise ValueError("start_date and end_date are needed to shard by date")
+        shards = [
+            {"start_date": first, "end_date": last, "database": database}
+            for first, last in split_date_range(start_date, end_date, num_shards)
+        ]
+    else:
+        shards = [
+            {"start_date": start_date, "end_date": end_date, "database": database}
+        ] * num_shards
+
+    if not session:
+        session = get_session()
+        close_session = True  # if session is created in function, close it in function
+    else:
+        close_session = False  # if session given, leave it open
+
+    if run_dir is None:
+        run_dir = model_version.location
+
+    if save_to_db:
+        if verbose:
+            print("Creating dataset...")
+        dataset_id = create_dataset(session, start_date, end_date, database)
+
+        if not (force or replace) and result_exists(
+            session,
+            results_table,
+            model_version.modelid,
+            model_version.modelversion,
+            dataset_id,
+        ):
+            if verbose:
+                print(
+                    f"DB already contains results for model {model_version.modelid}, "
+                    f"version {model_version.modelversion} on dataset {dataset_id}. "
+                    "Skipping."
+                )
+            return
+        run_id = get_unique_id(session, results_table.runid)
+
+    # create the environment once, rather than concurrently in each shard
+    if verbose:
+        print("Creating environment...")
+    env_cmd = create_env(
+        run_dir,
+        model_version.modelid,
+        model_version.modelversion,
+        capture_output=capture_output,
+    )
+    run_time = get_iso_time()
+
+    def run_shard(shard, window):
+        results_path = Path(run_dir, get_shard_file(results_file, shard))
+        try:
+            os.remove(results_path)
+        except FileNotFoundError:
+            pass
+
+        run_cmd = build_run_cmd(
+            command,
+            window["start_date"],
+            window["end_date"],
+            window["database"],
+            shard=shard,
+            num_shards=len(shards),
+        )
+        run_shell_command(run_cmd, env_cmd, run_dir, verbose, capture_output)
+
+        if save_to_db and not os.path.exists(results_path):
+            raise FileNotFoundError(
+                f"{results_path} not found. This should be created by running "
+                f"{run_cmd}."
+            )
+        if verbose:
+            print(f"Finished shard {shard + 1} out of {len(shards)}")
+        return results_path
+
+    if verbose:
+        print(f"Running script in {len(shards)} shards...")
+    errors = []
+    with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+        futures = [
+            executor.submit(run_shard, shard, window)
+            for shard, window in enumerate(shards)
+        ]
+        # load each shard's results as it finishes, all in the session's transaction
+        # (sessions can't be shared between threads, so not in the shard's thread), so
+        # the run is only visible to other readers once every shard has been loaded
+        for future in as_completed(futures):
+            try:
+                results_path = future.result()
+                if save_to_db and not errors:
+                    file_to_db(
+                        session,
+                        model_version,
+                        results_path,
+                        dataset_id,
+                        run_time,
+                        run_id,
+                    )
+            except Exception as e:
+                errors.append(e)
+
+    if errors and save_to_db:
+        # nothing from the run has been committed
+        session.rollback()
+    elif replace and save_to_db:
+        delete_previous_results(
+            session, results_table, model_version, dataset_id, run_id
+        )
+    session.commit()
+
+    if close_session:
+        session.close()
+
+    if errors:
+        raise errors[0]
+
+
+def save_run(
+    session,
+    run_id,
+    model_version,
+    results,
+    dataset_id,
+    run_time,
+    results_table,
+    results_to_db,
+    replace=False,
+):
+    """Add the results of a model run to a session, without committing it. Used by the
+    ResultWriter when running models in parallel (see run_models_parallel).
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session
+        ModMon database session
+    run_id : int
+        Run ID to assign to the results
+    model_version : modmon.schema.db.ModelVersion
+        Model version object
+    results : pandas.DataFrame, dict or list
+        Results loaded from the model's results file or returned by its entry-point
+    dataset_id : int
+        ID of the dataset the model was run on
+    run_time : str or datetime.datetime
+        Time the model was run
+    results_table : class
+        Table to save results to from modmon.db.schema
+    results_to_db : function
+        Function to add the results to the results_table table (see run_model)
+    replace : bool, optional
+        If True delete the previous results for the model version and dataset, by
+        default False
+    """
+    results_to_db(session, model_version, results, dataset_id, run_time, run_id)
+    if replace:
+        delete_previous_results(
+            session, results_table, model_version, dataset_id, run_id
+        )
+
+
+def run_models_parallel(
+    session,
+    model_versions,
+    command_attr,
+    results_file,
+    results_table,
+    read_results,
+    results_to_db,
+    windows,
+    jobs,
+    force=False,
+    replace=False,
+):
+    """Run many model versions at once, each in its own thread, and save their results
+    with a single ResultWriter (see modmon.db.writer) that commits them in batches.
+    Each model version is run on its windows one at a time.
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session
+        ModMon database session
+    model_versions : list
+        List of ModelVersion objects to run
+    command_attr : str
+        Attribute of model_version that contains the model command to run
+    results_file : str or Path
+        Name of the results file created by running the model command
+    results_table : class
+        Table to save results to from modmon.db.schema
+    read_results : function
+        Function to load results from a results file, taking the argument results_path
+    results_to_db : function
+        Function to add loaded (or in-memory) results to the results_table table (see
+        run_model)
+    windows : list
+        List of dataset windows to run each model on, each a dict with the keys
+        "start_date", "end_date" and "database"
+    jobs : int
+        Number of model versions to run at the same time
+    force : bool, optional
+        If True regenerate results for a model version even if they already exist in the
+        database for the same dataset, by default False
+    replace : bool, optional
+        If True regenerate results even if they already exist (as for force), and
+        replace the previous results for the same model version and dataset, by default
+        False
+    """
+    # create all the datasets up front, so runs only write to the database through the
+    # result writer
+    tasks = {}
+    for mv in model_versions:
+        for window in windows:
+            dataset_id = create_dataset(session, **window)
+            if not (force or replace) and result_exists(
+                session, results_table, mv.modelid, mv.modelversion, dataset_id
+            ):
+                print(
+                    f"DB already contains results for model {mv.modelid}, version "
+                    f"{mv.modelversion} on dataset {dataset_id}. Skipping."
+                )
+                continue
+            tasks.setdefault(mv, []).append((window, dataset_id))
+    session.commit()
+
+    # sessions can't be shared between threads, so detach the (loaded) model versions
+    for mv in tasks:
+        session.refresh(mv)
+        session.expunge(mv)
+
+    def run_tasks(mv, mv_tasks, writer):
+        name = f"model {mv.modelid} version {mv.modelversion}"
+        entrypoint = get_python_entrypoint(mv, command_attr)
+        pool = None
+        if entrypoint is not None and workers_enabled():
+            pool = WorkerPool(verbose=False)
+        futures = []
+        try:
+            for window, dataset_id in mv_tasks:
+                print(f"Running {name} on dataset {dataset_id}...")
+                run_time = get_iso_time()
+                try:
+                    if entrypoint is not None:
+                        results = run_model_entrypoint(
+                            mv, entrypoint, **window, verbose=False, pool=pool
+                        )
+                    else:
+                        results_path = run_model_to_file(
+                            mv, command_attr, results_file, **window
+                        )
+                        results = read_results(results_path)
+                except Exception as e:
+                    # any failure (e.g. the environment can't be built or the results
+                    # file is invalid) only skips this window, so it can't abort the
+                    # writes of other windows and models
+                    print(f"FAILED: {name} on dataset {dataset_id}: {e}")
+                    continue
+
+                # blocks if the writer has too many runs waiting to be saved
+                write = partial(
+                    save_run,
+                    model_version=mv,
+                    results=results,
+                    dataset_id=dataset_id,
+                    run_time=run_time,
+                    results_table=results_table,
+                    results_to_db=results_to_db,
+                    replace=replace,
+                )
+                futures.append((dataset_id, writer.submit(write)))
+        finally:
+            if pool is not None:
+                pool.close_all()
+        return name, futures
+
+    with ResultWriter(results_table) as writer:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            model_futures = {
+                mv: executor.submit(run_tasks, mv, mv_tasks, writer)
+                for mv, mv_tasks in tasks.items()
+            }
+            for mv, model_future in model_futures.items():
+                try:
+                    name, futures = model_future.result()
+                except Exception as e:
+                    print(f"FAILED: model {mv.modelid} version {mv.modelversion}: {e}")
+                    continue
+                for dataset_id, future in futures:
+                    try:
+                        future.result()
+                    except Exception as e:
+                        print(f"FAILED: saving {name} on dataset {dataset_id}: {e}")
+
 
 def run_all_models(
     command_attr,
     results_file,
     results_table,
     file_to_db,
+    results_to_db=None,
     start_date=None,
     end_date=None,
     database=None,
     force=False,
+    replace=False,
     run_inactive=False,
     save_to_db=True,
+    windows=None,
+    num_shards=1,
+    shard_by="hash",
+    read_results=None,
+    jobs=1,
 ):
     """Run a command for all models in the database for the specified dataset and save
     them to the database.
@@ -455,6 +1524,9 @@ def run_all_models(
         Function to load results from results_file and add them to the results_table
         table. Must take arguments session, model_version, results_path, dataset_id,
         run_time, run_id. By default None.
+    results_to_db : function, optional
+        Function to add in-memory results from a Python entry-point to the
+        results_table table (see run_model), by default None
     start_date : str or datetime.datetime , optional
         Dataset start date, by default None
     end_date : str or datetime.datetime , optional
@@ -464,7 +1536,34 @@ def run_all_models(
     force : bool, optional
         If True regenerate results for a model version even if they already exist in the
         database for the same dataset, by default False
+    replace : bool, optional
+        If True regenerate results even if they already exist (as for force), and
+        replace the previous results for the same model version and dataset with the
+        new run in the same transaction, by default False
+    windows : list, optional
+        List of dataset windows to run each model on (e.g. to backfill results), each a
+        dict with the keys "start_date", "end_date" and "database" (see
+        load_windows_file). If set start_date, end_date and database are ignored. By
+        default None.
+    num_shards : int, optional
+        If greater than 1, models whose command contains the <shard> placeholder are
+        run on each window in num_shards parallel shards (see run_model_shards), by
+        default 1
+    shard_by : str, optional
+        How to split windows into shards, "hash" or "date", by default "hash"
+    read_results : function, optional
+        Function to load results from a results file, taking the argument
+        results_path. Needed if jobs is greater than 1, by default None
+    jobs : int, optional
+        Number of model versions to run at the same time (see run_models_parallel). If
+        greater than 1 shards and the <windows_file> placeholder aren't used. By default
+        1.
     """
+    if windows is None:
+        windows = [
+            {"start_date": start_date, "end_date": end_date, "database": database}
+        ]
+
     # Set up db connection
     print("Connecting to monitoring database...")
     session = get_session()
@@ -478,6 +1577,27 @@ def run_all_models(
         print("No model versions found. Returning.")
         return
 
+    if jobs > 1 and save_to_db:
+        run_models_parallel(
+            session,
+            model_versions,
+            command_attr,
+            results_file,
+            results_table,
+            read_results,
+            results_to_db,
+            windows,
+            jobs,
+            force=force,
+            replace=replace,
+        )
+        session.close()
+        return
+
+    # keep the entry-point modules of models with a Python entry-point loaded while
+    # they're run on all the windows
+    pool = WorkerPool() if workers_enabled() else None
+
     # run metrics script for all model versions
     for i, mv in enumerate(model_versions):
         print("=" * 30)
@@ -487,27 +1607,130 @@ def run_all_models(
         )
         print("=" * 30)
 
-        try:
-            run_model(
-                model_version=mv,
-                command_attr=command_attr,
-                results_file=results_file,
-                results_table=results_table,
-                file_to_db=file_to_db,
-                start_date=start_date,
-                end_date=end_date,
-                database=database,
-                force=force,
-                session=session,
-                save_to_db=save_to_db,
-                verbose=True,
-                capture_output=False,
-            )
-        except subprocess.CalledProcessError as e:
-            print(f"FAILED: subprocess error: {e}")
-        except FileNotFoundError as e:
-            print(f"FAILED: File not found: {e}")
-        except ValueError as e:
-            print(f"FAILED: ValueError: {e}")
+        # models with the <windows_file> placeholder are run once for all windows
+        if (
+            len(windows) > 1
+            and "<windows_file>" in getattr(mv, command_attr)
+            and not (num_shards > 1 and "<shard>" in getattr(mv, command_attr))
+        ):
+            batches = [windows]
+        else:
+            batches = [[window] for window in windows]
+
+        for j, batch in enumerate(batches):
+            if len(batches) > 1:
+                print("-" * 30)
+                print(f"WINDOW {j + 1} OUT OF {len(batches)}: {batch[0]}")
+                print("-" * 30)
+
+            try:
+                if num_shards > 1 and "<shard>" in getattr(mv, command_attr):
+                    run_model_shards(
+                        model_version=mv,
+                        command_attr=command_attr,
+                        results_file=results_file,
+                        results_table=results_table,
+                        file_to_db=file_to_db,
+                        num_shards=num_shards,
+                        shard_by=shard_by,
+                        start_date=batch[0]["start_date"],
+                        end_date=batch[0]["end_date"],
+                        database=batch[0]["database"],
+                        force=force,
+                        replace=replace,
+                        session=session,
+                        save_to_db=save_to_db,
+                        verbose=True,
+                        capture_output=False,
+                    )
+                elif len(batch) > 1:
+                    run_model_windows(
+                        model_version=mv,
+                        command_attr=command_attr,
+                        results_file=results_file,
+                        results_table=results_table,
+                        file_to_db=file_to_db,
+                        windows=batch,
+                        force=force,
+                        replace=replace,
+                        session=session,
+                        save_to_db=save_to_db,
+                        verbose=True,
+                        capture_output=False,
+                    )
+                else:
+                    run_model(
+                        model_version=mv,
+                        command_attr=command_attr,
+                        results_file=results_file,
+                        results_table=results_table,
+                        file_to_db=file_to_db,
+                        results_to_db=results_to_db,
+                        start_date=batch[0]["start_date"],
+                        end_date=batch[0]["end_date"],
+                        database=batch[0]["database"],
+                        force=force,
+                        replace=replace,
+                        session=session,
+                        save_to_db=save_to_db,
+                        verbose=True,
+                        capture_output=False,
+                        pool=pool,
+                    )
+            except subprocess.CalledProcessError as e:
+                print(f"FAILED: subprocess error: {e}")
+            except WorkerError as e:
+                print(f"FAILED: entry-point error: {e}")
+            except FileNotFoundError as e:
+                print(f"FAILED: File not found: {e}")
+            except ValueError as e:
+                print(f"FAILED: ValueError: {e}")
+            finally:
+                # discard anything a failed run left uncommitted
+                session.rollback()
+
+        if pool is not None:
+            # this model version won't be run again
+            pool.close_all()
 
     session.close()
+
+
+def load_windows_file(path):
+    """Load a list of dataset windows from a CSV file, e.g. to backfill results for
+    many windows in one run.
+
+    Parameters
+    ----------
+    path : str or Path
+        Path to CSV file with a row for each window and (at least one of) the columns
+        "start_date", "end_date" and "database".
+
+    Returns
+    -------
+    list
+        List of windows, each a dict with the keys "start_date", "end_date" and
+        "database" (values are None if the column is not present in the file)
+
+    Raises
+    ------
+    ValueError
+        If the file contains none of the expected columns
+    """
+    columns = ["start_date", "end_date", "database"]
+    with open(path, "r", newline="") as f:
+        rows = list(csv.DictReader(f))
+
+    if len(rows) == 0 or not any(col in rows[0] for col in columns):
+        raise ValueError(f"{path} must contain at least one of the columns {columns}")
+
+    windows = []
+    for row in rows:
+        window = {col: row.get(col) or None for col in columns}
+        # TODO currently only deal with dates, not times
+        for col in ["start_date", "end_date"]:
+            if window[col] is not None:
+                window[col] = dateparser.parse(window[col]).date()
+        windows.append(window)
+
+    return windows
@@ -9,7 +9,10 @@ import dateparser
 
 from ..report.report import generate_report
 from ..db.schema import Score
-from .run import run_model, run_all_models
+from ..db.summary import update_latest_scores
+from ..metrics.alerts import check_alerts
+from ..metrics.anomaly import get_anomaly_config, update_anomalies
+from .run import run_model, run_all_models, load_windows_file
 
 SCORES_FILE = "scores.csv"
 SCORES_COMMAND_ATTR = "score_command"
@@ -41,14 +44,67 @@ def add_scores_from_file(
     FileNotFoundError
         If the file model_version.location/scores.csv does not exist
     """
+    metrics = read_scores_file(results_path)
+    add_scores_from_frame(session, model_version, metrics, dataset_id, run_time, run_id)
 
+
+def read_scores_file(results_path):
+    """Load the metric values from a model version's metrics file.
+
+    Parameters
+    ----------
+    results_path : str or Path
+       Full path to file containing model metrics (usually called scores.csv)
+
+    Returns
+    -------
+    pandas.DataFrame
+        DataFrame with two columns, metric name and value
+
+    Raises
+    ------
+    FileNotFoundError
+        If results_path does not exist
+    """
     if not os.path.exists(results_path):
         raise FileNotFoundError(f"{results_path} not found.")
 
-    metrics = pd.read_csv(results_path)
+    return pd.read_csv(results_path)
+
+
+def add_scores_from_frame(
+    session, model_version, metrics, dataset_id, run_time, run_id
+):
+    """Add metric values returned in memory by a model version's Python entry-point to
+    the database after a new run, update the latest_score summary (see
+    modmon.db.summary) and check them against the alert rules (see
+    modmon.metrics.alerts).
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session
+        ModMon database session
+    model_version : modmon.schema.db.ModelVersion
+        Model version object
+    metrics : pandas.DataFrame, pandas.Series or dict
+        Metric values, either a DataFrame with two columns (metric name and value, as in
+        scores.csv), or a Series or dict with metric names as keys.
+    dataset_id : int
+        ID of the dataset the metrics were calculated for
+    run_time : str or datetime.datetime
+        Time the model version was run to generate the metrics
+    run_id : int
+        Run ID to assign to this data
+    """
+    if isinstance(metrics, dict):
+        metrics = pd.Series(metrics)
+    if isinstance(metrics, pd.Series):
+        metrics = metrics.reset_index()
 
+    values = {}
     for _, row in metrics.iterrows():
         metric_name, metric_value = row
+        values[metric_name] = metric_value
 
         score = Score(
             modelid=model_version.modelid,
@@ -62,6 +118,16 @@ def add_scores_from_file(
         )
         session.add(score)
 
+    update_latest_scores(
+        session,
+        model_version,
+        dataset_id,
+        run_id,
+        run_time,
+        {(metric, ""): value for metric, value in values.items()},
+    )
+    check_alerts(session, model_version, dataset_id, run_id, values)
+
 
 def score_model(
     model_version,
@@ -69,6 +135,7 @@ def score_model(
     end_date=None,
     database=None,
     force=False,
+    replace=False,
     session=None,
     save_to_db=True,
     verbose=True,
@@ -91,6 +158,9 @@ def score_model(
     force : bool, optional
         If True regenerate results for a model version even if they already exist in the
         database for the same dataset, by default False
+    replace : bool, optional
+        If True regenerate results even if they already exist, and replace the previous
+        results for the same model version and dataset, by default False
     session : sqlalchemy.orm.session.Session, optional
         ModMon database session or None in which case one will be created, by default
         None
@@ -117,20 +187,31 @@ def score_model(
         results_file=SCORES_FILE,
         results_table=Score,
         file_to_db=add_scores_from_file,
+        results_to_db=add_scores_from_frame,
         start_date=start_date,
         end_date=end_date,
         database=database,
         force=force,
+        replace=replace,
         session=session,
         save_to_db=save_to_db,
         verbose=verbose,
         capture_output=capture_output,
         run_dir=run_dir,
     )
+    if save_to_db and get_anomaly_config()[0]:
+        update_anomalies(session=session, verbose=verbose)
 
 
 def score_all_models(
-    start_date=None, end_date=None, database=None, force=False, run_inactive=False
+    start_date=None,
+    end_date=None,
+    database=None,
+    force=False,
+    replace=False,
+    run_inactive=False,
+    windows=None,
+    jobs=1,
 ):
     """Run all active model versions in the database to generate metrics values for a
     new dataset.
@@ -146,6 +227,20 @@ def score_all_models(
     force : bool, optional
         If True regenerate results for a model version even if they already exist in the
         database for the same dataset, by default False
+    replace : bool, optional
+        If True regenerate results even if they already exist, and replace the previous
+        results for the same model version and dataset, by default False
+    run_inactive : bool, optional
+        If True also run inactive model versions, by default False
+    windows : list, optional
+        List of dataset windows to run all models on, each a dict with the keys
+        "start_date", "end_date" and "database" (see
+        modmon.models.run.load_windows_file). If set start_date, end_date and database
+        are ignored. By default None.
+    jobs : int, optional
+        Number of model versions to run at the same time, with their results saved to
+        the database in batches (see modmon.models.run.run_models_parallel), by default
+        1
     """
 
     run_all_models(
@@ -153,12 +248,19 @@ def score_all_models(
         results_file=SCORES_FILE,
         results_table=Score,
         file_to_db=add_scores_from_file,
+        results_to_db=add_scores_from_frame,
         start_date=start_date,
         end_date=end_date,
         database=database,
         force=force,
+        replace=replace,
         run_inactive=run_inactive,
+        windows=windows,
+        read_results=read_scores_file,
+        jobs=jobs,
     )
+    if get_anomaly_config()[0]:
+        update_anomalies()
 
 
 def main():
@@ -179,11 +281,33 @@ def main():
         help="If set, run models even if results already exist in the database",
         action="store_true",
     )
+    parser.add_argument(
+        "--replace",
+        help=(
+            "If set, run models even if results already exist in the database, and "
+            "replace the existing results with the new ones"
+        ),
+        action="store_true",
+    )
     parser.add_argument(
         "--run_inactive",
         help="If set, also run models marked as inactive",
         action="store_true",
     )
+    parser.add_argument(
+        "--windows_file",
+        help=(
+            "CSV file of dataset windows to run all models on (with columns "
+            "start_date, end_date and/or database), e.g. to backfill results"
+        ),
+    )
+
+    parser.add_argument(
+        "--jobs",
+        help="Number of models to run at the same time (default: 1)",
+        type=int,
+        default=1,
+    )
 
     args = parser.parse_args()
     # TODO currently only deal with dates, not times
@@ -195,12 +319,19 @@ def main():
         end_date = dateparser.parse(args.end_date).date()
     else:
         end_date = None
+    if args.windows_file is not None:
+        windows = load_windows_file(args.windows_file)
+    else:
+        windows = None
 
     score_all_models(
         start_date,
         end_date,
         args.database,
         force=args.force,
+        replace=args.replace,
         run_inactive=args.run_inactive,
+        windows=windows,
+        jobs=args.jobs,
     )
-    #generate_report()
+    # generate_report()
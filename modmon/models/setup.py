@@ -12,6 +12,7 @@ import sys
 import pandas as pd
 
 from ..db.connect import get_session
+from ..db.summary import update_latest_scores
 from ..db.utils import get_unique_id
 from ..db.schema import (
     Team,
@@ -259,8 +260,10 @@ def setup_model(
 
         # Save analyst reference scores for this model version
         run_id = get_unique_id(session, Score.runid)
+        reference_values = {}
         for index, row in metrics.iterrows():
             metric, value = row
+            reference_values[(metric, "")] = value
             reference_result = Score(
                 modelid=model_id,
                 modelversion=metadata["model_version"],
@@ -272,6 +275,15 @@ def setup_model(
                 value=value,
             )
             session.add(reference_result)
+        update_latest_scores(
+            session,
+            model_version,
+            test_dataset_id,
+            run_id,
+            metadata["model_run_datetime"],
+            reference_values,
+            is_reference=True,
+        )
 
     else:
         print(f"Model Version: Already exists: \"{metadata['model_version']}\"")
@@ -1,6 +1,12 @@
+import argparse
+import fcntl
+import hashlib
+import json
 import os
 from pathlib import Path
 import shutil
+import stat
+import tempfile
 
 from ..config import config
 from ..utils.utils import build_model_identifier, ask_for_confirmation
@@ -87,11 +93,373 @@ def get_report_dir(storage_config=config["reports"], create=True, exist_ok=True)
 
 REPORT_DIR = get_report_dir()
 
+# Name of the directory (inside the model storage directory) containing the
+# content-addressed store of model files.
+BLOB_DIR_NAME = ".blobs"
+# Name of the directory (inside the blob store) containing the manifest of the blobs
+# used by each model version directory
+MANIFEST_DIR_NAME = "manifests"
+# How version directories are created: "copy" (independent copies, without using the
+# blob store), "reflink" (copy-on-write clones of blobs where the file system supports
+# them, otherwise independent copies) or "hardlink" (shared with the blob store and all
+# other versions).
+LINK_MODES = ["copy", "reflink", "hardlink"]
+# ioctl request to clone a file on Linux file systems with copy-on-write support
+FICLONE = 0x40049409
+
+
+def get_link_mode(storage_config=config["models"]):
+    """Get how files in the blob store should be materialised in model version
+    directories, as defined by the 'linkmode' key in the [models] config section.
+
+    Parameters
+    ----------
+    storage_config : configparser.SectionProxy, optional
+        configparser section optionally containing the key 'linkmode', by default
+        modmon.config.config["models"]
+
+    Returns
+    -------
+    str
+        One of LINK_MODES, "reflink" if 'linkmode' is not set.
+
+    Raises
+    ------
+    ValueError
+        If 'linkmode' is not one of LINK_MODES
+    """
+    link_mode = storage_config.get("linkmode", "reflink")
+    if link_mode not in LINK_MODES:
+        raise ValueError(f"linkmode must be one of {LINK_MODES}, not {link_mode}")
+    return link_mode
+
+
+def get_blob_dir(storage_dir=STORAGE_DIR, create=True):
+    """Get the path to the content-addressed blob store in the model storage area.
+
+    Parameters
+    ----------
+    storage_dir : str or Path, optional
+        Path to the ModMon storage area, by default STORAGE_DIR
+    create : bool, optional
+        Whether to create the blob directory, by default True
+
+    Returns
+    -------
+    pathlib.Path
+        Path to the blob store.
+    """
+    blob_dir = Path(storage_dir, BLOB_DIR_NAME)
+    if create:
+        os.makedirs(blob_dir, exist_ok=True)
+    return blob_dir
+
+
+def get_manifest_path(model_dir, storage_dir=STORAGE_DIR):
+    """Get the path to the manifest of the blobs used by a model version directory.
+
+    Parameters
+    ----------
+    model_dir : str or Path
+        Path to the model version directory in storage
+    storage_dir : str or Path, optional
+        Path to the ModMon storage area, by default STORAGE_DIR
+
+    Returns
+    -------
+    pathlib.Path
+        Path to the manifest
+    """
+    return Path(
+        get_blob_dir(storage_dir, create=False),
+        MANIFEST_DIR_NAME,
+        f"{Path(model_dir).name}.json",
+    )
+
+
+def write_manifest(model_dir, digests, storage_dir=STORAGE_DIR):
+    """Save the hashes of the blobs used by a model version directory, so blobs that
+    are still in use can be found without relying on hard link counts (see
+    collect_garbage).
+
+    Parameters
+    ----------
+    model_dir : str or Path
+        Path to the model version directory in storage
+    digests : dict
+        {relative_path: digest} of each file in model_dir from the blob store
+    storage_dir : str or Path, optional
+        Path to the ModMon storage area, by default STORAGE_DIR
+    """
+    manifest_path = get_manifest_path(model_dir, storage_dir)
+    os.makedirs(manifest_path.parent, exist_ok=True)
+    tmp_path = manifest_path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(digests, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+def get_used_digests(storage_dir=STORAGE_DIR, remove_stale=True):
+    """Get the hashes of all blobs used by model version directories in storage, from
+    their manifests (see write_manifest).
+
+    Parameters
+    ----------
+    storage_dir : str or Path, optional
+        Path to the ModMon storage area, by default STORAGE_DIR
+    remove_stale : bool, optional
+        If True delete the manifests of model version directories that no longer
+        exist, by default True
+
+    Returns
+    -------
+    set
+        Hex digests of the blobs in use
+    """
+    manifest_dir = Path(get_blob_dir(storage_dir, create=False), MANIFEST_DIR_NAME)
+    used = set()
+    for manifest_path in manifest_dir.glob("*.json"):
+        if not Path(storage_dir, manifest_path.stem).exists():
+            if remove_stale:
+                os.remove(manifest_path)
+            continue
+        with open(manifest_path, "r") as f:
+            used.update(json.load(f).values())
+    return used
+
+
+def hash_file(path, chunk_size=2 ** 20):
+    """Compute the SHA-256 hash of a file's contents.
+
+    Parameters
+    ----------
+    path : str or Path
+        Path to the file to hash
+    chunk_size : int, optional
+        Number of bytes to read at a time, by default 1 MiB
+
+    Returns
+    -------
+    str
+        Hex digest of the file contents
+    """
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def add_file_to_blob_store(path, blob_dir):
+    """Add a file to the blob store, unless a file with identical contents is already
+    stored. Blobs are made read-only as they may be shared between model versions.
+
+    Parameters
+    ----------
+    path : str or Path
+        Path to the file to add
+    blob_dir : str or Path
+        Path to the blob store
+
+    Returns
+    -------
+    pathlib.Path, bool
+        Path to the blob containing the file's contents, and whether the blob was
+        created (rather than already stored)
+    """
+    digest = hash_file(path)
+    blob_path = Path(blob_dir, digest[:2], digest)
+
+    created = not blob_path.exists()
+    if created:
+        os.makedirs(blob_path.parent, exist_ok=True)
+        # copy to a temporary name first so a partially written blob is never visible
+        fd, tmp_path = tempfile.mkstemp(dir=blob_path.parent, prefix=".tmp-")
+        os.close(fd)
+        try:
+            shutil.copy2(path, tmp_path)
+            mode = os.stat(tmp_path).st_mode
+            os.chmod(tmp_path, mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+            os.replace(tmp_path, blob_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    return blob_path, created
+
+
+def reflink_file(source_path, target_path):
+    """Create target_path as a copy-on-write clone of source_path, which shares its
+    data blocks until either file is modified.
+
+    Parameters
+    ----------
+    source_path : str or Path
+        Path to the file to clone
+    target_path : str or Path
+        Path to create
+
+    Raises
+    ------
+    OSError
+        If the file system doesn't support cloning files (target_path is removed)
+    """
+    try:
+        with open(source_path, "rb") as src, open(target_path, "wb") as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    except OSError:
+        if os.path.exists(target_path):
+            os.remove(target_path)
+        raise
+    shutil.copystat(source_path, target_path)
+
+
+def link_from_blob_store(blob_path, target_path, link_mode="reflink", move=False):
+    """Materialise a blob at target_path as a copy-on-write clone or a hard link. If
+    neither can be created (e.g. the file system doesn't support them or target_path
+    is on a different file system) the blob is copied, or moved if move is True so that
+    its contents aren't stored twice. Clones and copies are made writable by their
+    owner, as they're independent of the blob and can be modified without changing
+    other model versions.
+
+    Parameters
+    ----------
+    blob_path : str or Path
+        Path to the blob in the blob store
+    target_path : str or Path
+        Path to create
+    link_mode : str, optional
+        "reflink" or "hardlink", by default "reflink"
+    move : bool, optional
+        If True move the blob to target_path if it can't be linked, e.g. if it was
+        only just added to the blob store, by default False
+
+    Returns
+    -------
+    bool
+        Whether target_path shares its contents with the blob
+    """
+    shared = True
+    try:
+        if link_mode == "hardlink":
+            # shared with every version with the same file, so must not be modified
+            os.link(blob_path, target_path)
+            return shared
+        reflink_file(blob_path, target_path)
+    except OSError:
+        shared = False
+        if move:
+            os.replace(blob_path, target_path)
+        else:
+            shutil.copy2(blob_path, target_path)
+    os.chmod(target_path, os.stat(target_path).st_mode | stat.S_IWUSR)
+    return shared
+
+
+def copy_file_writable(source_path, target_path):
+    """Copy a file, making the copy writable by its owner.
+
+    Parameters
+    ----------
+    source_path : str or Path
+        Path to the file to copy
+    target_path : str or Path
+        Path to create
+
+    Returns
+    -------
+    str or Path
+        target_path
+    """
+    target_path = shutil.copy2(source_path, target_path)
+    os.chmod(target_path, os.stat(target_path).st_mode | stat.S_IWUSR)
+    return target_path
+
+
+def copy_tree_to_blob_store(
+    source_dir, target_dir, storage_dir=STORAGE_DIR, link_mode=None
+):
+    """Copy a directory into the ModMon storage area. Unless link_mode is "copy", each
+    file is stored once in the blob store, target_dir is created from links to the
+    stored blobs, and the blobs it uses are saved in a manifest (see write_manifest).
+    With link_mode "copy" the files are copied to target_dir without using the blob
+    store, so they're only stored once.
+
+    Parameters
+    ----------
+    source_dir : str or Path
+        Directory to copy
+    target_dir : str or Path
+        Directory to create, must not already exist
+    storage_dir : str or Path, optional
+        Path to the ModMon storage area, by default STORAGE_DIR
+    link_mode : str, optional
+        One of LINK_MODES, by default None which uses the value from the config file
+        (see get_link_mode)
+    """
+    if link_mode is None:
+        link_mode = get_link_mode()
+    if link_mode == "copy":
+        shutil.copytree(
+            source_dir, target_dir, symlinks=True, copy_function=copy_file_writable
+        )
+        # the directory doesn't use any blobs (e.g. from a version it replaced)
+        manifest_path = get_manifest_path(target_dir, storage_dir)
+        if manifest_path.exists():
+            os.remove(manifest_path)
+        return
+    blob_dir = get_blob_dir(storage_dir)
+
+    digests = {}
+    os.makedirs(target_dir)
+    for root, dirs, files in os.walk(source_dir):
+        rel_root = Path(root).relative_to(source_dir)
+        for d in dirs:
+            src = Path(root, d)
+            dst = Path(target_dir, rel_root, d)
+            if src.is_symlink():
+                os.symlink(os.readlink(src), dst)
+            else:
+                os.makedirs(dst)
+        for f in files:
+            src = Path(root, f)
+            dst = Path(target_dir, rel_root, f)
+            if src.is_symlink():
+                os.symlink(os.readlink(src), dst)
+            else:
+                blob_path, created = add_file_to_blob_store(src, blob_dir)
+                # a new blob that can't be shared is moved rather than copied, so
+                # it's not stored twice
+                link_from_blob_store(blob_path, dst, link_mode=link_mode, move=created)
+                digests[str(Path(rel_root, f))] = blob_path.name
+    write_manifest(target_dir, digests, storage_dir=storage_dir)
+
+
+def copy_model_from_storage(model_dir, target_dir):
+    """Copy a model directory out of the ModMon storage area, for example to a temporary
+    directory to retrain it. Files are copied (rather than linked to the blob store) and
+    made writable, so they can safely be modified in place.
+
+    Parameters
+    ----------
+    model_dir : str or Path
+        Path to the model version directory in storage
+    target_dir : str or Path
+        Directory to copy the model to. May already exist.
+    """
+
+    shutil.copytree(
+        model_dir, target_dir, copy_function=copy_file_writable, dirs_exist_ok=True
+    )
+
 
 def copy_model_to_storage(
     model_source_dir, model_id, model_version, storage_dir=STORAGE_DIR
 ):
-    """Copy a model directory to the ModMon storage area.
+    """Copy a model directory to the ModMon storage area. Unless linkmode is "copy",
+    files are added to the content-addressed blob store, so files that are unchanged
+    between model versions are only stored once (see copy_tree_to_blob_store).
 
     Parameters
     ----------
@@ -133,7 +501,7 @@ def copy_model_to_storage(
                 f"{model_target_dir}"
             )
 
-    shutil.copytree(model_source_dir, model_target_dir)
+    copy_tree_to_blob_store(model_source_dir, model_target_dir, storage_dir=storage_dir)
 
     return model_target_dir
 
@@ -167,6 +535,9 @@ def delete_model_from_storage(
     model_dir = Path(storage_dir, model_identifier)
 
     shutil.rmtree(model_dir)
+    manifest_path = get_manifest_path(model_dir, storage_dir)
+    if manifest_path.exists():
+        os.remove(manifest_path)
     print(f"Deleted {model_dir}")
 
 
@@ -190,3 +561,66 @@ def delete_all_models_from_storage(storage_dir=STORAGE_DIR, force=False):
             return
 
     shutil.rmtree(storage_dir)
+
+
+def collect_garbage(storage_dir=STORAGE_DIR, dry_run=False):
+    """Delete blobs that are no longer used by any model version in storage. A blob is
+    unused if it's not in the manifest of any model version directory (see
+    write_manifest) and has no hard links other than the one in the blob store (as in
+    directories created before manifests were saved).
+
+    Parameters
+    ----------
+    storage_dir : str or Path, optional
+        Path to the ModMon storage area, by default STORAGE_DIR
+    dry_run : bool, optional
+        If True only report what would be deleted, by default False
+
+    Returns
+    -------
+    int, int
+        Number of blobs deleted and the number of bytes reclaimed.
+    """
+    blob_dir = get_blob_dir(storage_dir, create=False)
+    n_blobs = 0
+    n_bytes = 0
+    if not blob_dir.exists():
+        return n_blobs, n_bytes
+
+    used = get_used_digests(storage_dir, remove_stale=not dry_run)
+    for blob_path in blob_dir.glob("*/*"):
+        if blob_path.parent.name == MANIFEST_DIR_NAME or blob_path.name in used:
+            continue
+        blob_stat = blob_path.stat()
+        if blob_stat.st_nlink == 1:
+            n_blobs += 1
+            n_bytes += blob_stat.st_size
+            if not dry_run:
+                os.remove(blob_path)
+
+    return n_blobs, n_bytes
+
+
+def main():
+    """Manage the ModMon model storage area.
+
+    Available from the command-line as modmon_storage
+    """
+    parser = argparse.ArgumentParser(description="Manage the ModMon model storage area")
+    subparsers = parser.add_subparsers(dest="command")
+    gc_parser = subparsers.add_parser(
+        "gc", help="Delete stored files no longer used by any model version"
+    )
+    gc_parser.add_argument(
+        "--dry_run",
+        help="If set, report reclaimable space without deleting anything",
+        action="store_true",
+    )
+    args = parser.parse_args()
+
+    if args.command == "gc":
+        n_blobs, n_bytes = collect_garbage(dry_run=args.dry_run)
+        action = "Would reclaim" if args.dry_run else "Reclaimed"
+        print(f"{action} {n_bytes / 2 ** 20:.1f} MiB from {n_blobs} unused files.")
+    else:
+        parser.print_help()
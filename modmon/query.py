@@ -0,0 +1,189 @@
+"""
+Functions to query trends in model results over time from the summary tables in the
+ModMon database, without reading the raw prediction table.
+"""
+import numpy as np
+import pandas as pd
+from sqlalchemy import and_, func
+
+from .db.connect import get_session
+from .db.schema import PredictionRollup
+from .metrics.rollup import get_rollup_config
+from .metrics.sketch import GridHistogram
+
+# Columns of the prediction_rollup table that are combined across rollups
+ROLLUP_COLUMNS = ["count", "missing", "sum", "sumsq", "min", "max"]
+
+
+def get_prediction_rollups(
+    session,
+    model_id=None,
+    model_version=None,
+    outputs=None,
+    start_date=None,
+    end_date=None,
+):
+    """Load the rollups of the latest prediction run of each model version on each
+    dataset (see modmon.metrics.rollup).
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session
+        ModMon database session
+    model_id : int, optional
+        Only load rollups for this model, by default None (all models)
+    model_version : str, optional
+        Only load rollups for this version of the model, by default None (all versions)
+    outputs : list, optional
+        Only load rollups for these outputs, by default None (all outputs)
+    start_date : str or datetime.datetime, optional
+        Only load rollups for datasets starting on or after this date, by default None
+    end_date : str or datetime.datetime, optional
+        Only load rollups for datasets starting before this date, by default None
+
+    Returns
+    -------
+    pandas.DataFrame
+        A row for each part of each run and output, with the columns of the
+        prediction_rollup table
+    """
+    filters = []
+    if model_id is not None:
+        filters.append(PredictionRollup.modelid == model_id)
+    if model_version is not None:
+        filters.append(PredictionRollup.modelversion == model_version)
+    if outputs is not None:
+        filters.append(PredictionRollup.output.in_(list(outputs)))
+    if start_date is not None:
+        filters.append(PredictionRollup.periodstart >= pd.Timestamp(start_date))
+    if end_date is not None:
+        filters.append(PredictionRollup.periodstart < pd.Timestamp(end_date))
+
+    # rollups of earlier runs on the same dataset (e.g. with --force) are not counted
+    latest_runs = (
+        session.query(
+            PredictionRollup.modelid,
+            PredictionRollup.modelversion,
+            PredictionRollup.datasetid,
+            func.max(PredictionRollup.runid).label("runid"),
+        )
+        .filter(*filters)
+        .group_by(
+            PredictionRollup.modelid,
+            PredictionRollup.modelversion,
+            PredictionRollup.datasetid,
+        )
+        .subquery()
+    )
+    query = (
+        session.query(PredictionRollup)
+        .join(
+            latest_runs,
+            and_(
+                PredictionRollup.modelid == latest_runs.c.modelid,
+                PredictionRollup.modelversion == latest_runs.c.modelversion,
+                PredictionRollup.datasetid == latest_runs.c.datasetid,
+                PredictionRollup.runid == latest_runs.c.runid,
+            ),
+        )
+        .filter(*filters)
+    )
+    columns = [column.name for column in PredictionRollup.__table__.columns]
+    return pd.DataFrame(
+        [[getattr(row, column) for column in columns] for row in query],
+        columns=columns,
+    )
+
+
+def get_prediction_trends(
+    session=None,
+    model_id=None,
+    model_version=None,
+    outputs=None,
+    start_date=None,
+    end_date=None,
+    freq="M",
+    histograms=False,
+):
+    """Get summary statistics of each output of each model version's predictions in
+    each time period (e.g. the mean predicted probability of each class by month),
+    calculated from the prediction_rollup table. Each dataset is counted in the period
+    its window starts in, using the latest prediction run on the dataset.
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session, optional
+        ModMon database session or None in which case one will be created, by default
+        None
+    model_id : int, optional
+        Only include this model, by default None (all models)
+    model_version : str, optional
+        Only include this version of the model, by default None (all versions)
+    outputs : list, optional
+        Only include these outputs, by default None (all outputs)
+    start_date : str or datetime.datetime, optional
+        Only include datasets starting on or after this date, by default None
+    end_date : str or datetime.datetime, optional
+        Only include datasets starting before this date, by default None
+    freq : str, optional
+        Length of each period as a pandas period alias, e.g. "D", "W" or "M", by
+        default "M" (calendar months)
+    histograms : bool, optional
+        If True include a histogram column with the merged histogram of each period
+        (a modmon.metrics.sketch.GridHistogram), by default False
+
+    Returns
+    -------
+    pandas.DataFrame
+        A row for each model version, output and period (columns modelid,
+        modelversion, output and period, the start of the period), with the columns
+        datasets (number of datasets in the period), count, missing, mean, std, min and
+        max, and optionally histogram
+    """
+    if not session:
+        session = get_session()
+        close_session = True  # if session is created in function, close it in function
+    else:
+        close_session = False  # if session given, leave it open
+
+    rollups = get_prediction_rollups(
+        session, model_id, model_version, outputs, start_date, end_date
+    )
+    if close_session:
+        session.close()
+
+    key = ["modelid", "modelversion", "output", "period"]
+    rollups["period"] = (
+        pd.to_datetime(rollups["periodstart"]).dt.to_period(freq).dt.start_time
+    )
+    for column in ROLLUP_COLUMNS:
+        rollups[column] = rollups[column].astype(float)
+    groups = rollups.groupby(key, sort=True)
+    trends = groups.agg(
+        datasets=("datasetid", "nunique"),
+        count=("count", "sum"),
+        missing=("missing", "sum"),
+        sum=("sum", "sum"),
+        sumsq=("sumsq", "sum"),
+        min=("min", "min"),
+        max=("max", "max"),
+    )
+    count = trends["count"].where(trends["count"] > 0)
+    trends["mean"] = trends["sum"] / count
+    variance = trends["sumsq"] / count - trends["mean"] ** 2
+    trends["std"] = np.sqrt(variance.clip(lower=0))
+    trends = trends[
+        ["datasets", "count", "missing", "mean", "std", "min", "max"]
+    ].astype({"count": np.int64, "missing": np.int64})
+
+    if histograms:
+        max_bins = get_rollup_config()[1]
+        merged = {}
+        for group, rows in groups["histogram"]:
+            histogram = GridHistogram(max_bins)
+            for row in rows:
+                histogram.merge(GridHistogram.from_dict(row))
+            merged[group] = histogram
+        trends["histogram"] = pd.Series(merged)
+
+    return trends.reset_index()
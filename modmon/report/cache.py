@@ -0,0 +1,185 @@
+"""
+Functions for caching rendered report figures on disk, so the report only renders the
+figures whose data has changed since the last report. Each rendered figure is stored
+in a file named after a hash of the figure code, the models on its page and
+fingerprints of the tables it reads (see
+modmon.report.figures.TABLE_FINGERPRINTS).
+"""
+from functools import lru_cache
+import hashlib
+import inspect
+import os
+from pathlib import Path
+
+from . import data, figures
+from .data import model_filter
+from .figures import FIGURES, TABLE_FINGERPRINTS
+
+# Subdirectory of the report directory rendered figures are cached in
+CACHE_DIR = ".figure_cache"
+
+# Version of the format of cached figures. Increase it when figures are rendered
+# differently in a way their code doesn't show (e.g. changes to the rendering in
+# modmon.report.report), to invalidate all cached figures.
+CACHE_VERSION = 1
+
+
+def get_figure_cache_dir(report_dir, create=True):
+    """Get the path to the rendered figure cache in a report directory.
+
+    Parameters
+    ----------
+    report_dir : str or Path
+        Directory reports are saved to
+    create : bool, optional
+        Whether to create the cache directory, by default True
+
+    Returns
+    -------
+    pathlib.Path
+        Path to the figure cache directory
+    """
+    cache_dir = Path(report_dir, CACHE_DIR)
+    if create:
+        os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+
+def get_table_fingerprint(connection, table, model_ids=None):
+    """Summarise the rows of a table that a figure reads.
+
+    Parameters
+    ----------
+    connection : sqlalchemy.engine.Connection
+        ModMon database connection
+    table : str
+        Name of the table, a key of modmon.report.figures.TABLE_FINGERPRINTS
+    model_ids : list, optional
+        IDs of the models on the figure's page, by default None (all models)
+
+    Returns
+    -------
+    list
+        Rows of the table's fingerprint query, as tuples
+    """
+    query = TABLE_FINGERPRINTS[table].format(
+        models=model_filter("t.modelid", model_ids)
+    )
+    return [tuple(row) for row in connection.execute(query)]
+
+
+@lru_cache(maxsize=None)
+def get_code_digest():
+    """Hash the code figures are built with: the figures themselves and their helpers
+    in modmon.report.figures, and the functions in modmon.report.data that load,
+    downsample and compact their data.
+
+    Returns
+    -------
+    str
+        Hex digest of the code
+    """
+    code = hashlib.sha256()
+    for module in [figures, data]:
+        code.update(inspect.getsource(module).encode())
+    return code.hexdigest()
+
+
+def get_figure_key(connection, name, model_ids=None, max_points=None):
+    """Get the key of a rendered figure in the cache, which changes when
+    the code figures are built with (see get_code_digest and CACHE_VERSION) or the data
+    the figure reads changes.
+
+    Parameters
+    ----------
+    connection : sqlalchemy.engine.Connection
+        ModMon database connection
+    name : str
+        Name of the figure in modmon.report.figures.FIGURES
+    model_ids : list, optional
+        IDs of the models on the figure's page, by default None (all models)
+    max_points : int, optional
+        Maximum number of points in each series of interactive charts, by default None
+
+    Returns
+    -------
+    str
+        Hex digest identifying the rendered figure
+    """
+    figure = FIGURES[name]
+    key = hashlib.sha256()
+    key.update(f"{CACHE_VERSION}:{name}".encode())
+    key.update(get_code_digest().encode())
+    key.update(repr(model_ids).encode())
+    if figure.type == "chart":
+        key.update(repr(max_points).encode())
+    for table in figure.tables:
+        key.update(repr(get_table_fingerprint(connection, table, model_ids)).encode())
+    return key.hexdigest()
+
+
+def read_cached_figure(cache_dir, key):
+    """Load a rendered figure from the cache.
+
+    Parameters
+    ----------
+    cache_dir : str or Path
+        Figure cache directory (see get_figure_cache_dir)
+    key : str
+        Key of the figure (see get_figure_key)
+
+    Returns
+    -------
+    str or None
+        Content of the figure (SVG or HTML), or None if it isn't in the cache
+    """
+    path = Path(cache_dir, key)
+    if not path.exists():
+        return None
+    with open(path, "r") as f:
+        return f.read()
+
+
+def write_cached_figure(cache_dir, key, content):
+    """Save a rendered figure to the cache.
+
+    Parameters
+    ----------
+    cache_dir : str or Path
+        Figure cache directory (see get_figure_cache_dir)
+    key : str
+        Key of the figure (see get_figure_key)
+    content : str
+        Content of the figure (SVG or HTML)
+    """
+    path = Path(cache_dir, key)
+    # write to a temporary file first so a partly written figure is never read
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def prune_figure_cache(cache_dir, keep):
+    """Delete cached figures that aren't in the latest report, so the cache doesn't
+    grow as the data changes.
+
+    Parameters
+    ----------
+    cache_dir : str or Path
+        Figure cache directory (see get_figure_cache_dir)
+    keep : iterable
+        Keys of the figures to keep
+
+    Returns
+    -------
+    int
+        Number of cached figures deleted
+    """
+    keep = set(keep)
+    n_deleted = 0
+    for path in Path(cache_dir).iterdir():
+        if path.name not in keep:
+            path.unlink()
+            n_deleted += 1
+    return n_deleted
@@ -0,0 +1,351 @@
+"""
+Functions to load the data plotted in the report. Filtering, de-duplication and
+first/last selection are done in SQL, so only the rows and columns that are plotted
+are sent to the report, and results are fetched in chunks with server-side cursors.
+Series shown in interactive charts are downsampled to a fixed number of points, so the
+size of the report doesn't grow with the length of the history.
+"""
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+
+
+def model_filter(column, model_ids):
+    """SQL condition restricting a query to some models.
+
+    Parameters
+    ----------
+    column : str
+        Model ID column in the query, e.g. "m.modelid"
+    model_ids : list or None
+        IDs of the models to include, or None to include all models
+
+    Returns
+    -------
+    str
+        Condition to add to the query's WHERE clause, e.g. "AND m.modelid IN (1, 2)"
+    """
+    if model_ids is None:
+        return ""
+    if len(model_ids) == 0:
+        return "AND FALSE"
+    return f"AND {column} IN ({', '.join(str(int(i)) for i in model_ids)})"
+
+
+def read_query(connection, query, chunk_size=10000):
+    """Run a query and load its results into a DataFrame, fetching chunk_size rows at a
+    time from a server-side cursor (where the database supports them).
+
+    Parameters
+    ----------
+    connection : sqlalchemy.engine.Connection
+        ModMon database connection
+    query : str
+        SQL query
+    chunk_size : int, optional
+        Number of rows to fetch at a time, by default 10000
+
+    Returns
+    -------
+    pandas.DataFrame
+        Results of the query, with a column for each column in the query
+    """
+    result = connection.execution_options(stream_results=True).execute(text(query))
+    columns = list(result.keys())
+    chunks = []
+    while True:
+        rows = result.fetchmany(chunk_size)
+        if not rows:
+            break
+        chunks.append(pd.DataFrame(rows, columns=columns))
+    if not chunks:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(chunks, ignore_index=True)
+
+
+def get_models(connection):
+    """Get the ID, name and research question of each model.
+
+    Parameters
+    ----------
+    connection : sqlalchemy.engine.Connection
+        ModMon database connection
+
+    Returns
+    -------
+    pandas.DataFrame
+        A row for each model, ordered by ID, with the columns modelid, name,
+        questionid and question (the research question's description)
+    """
+    query = """
+    SELECT m.modelid, m.name, m.questionid, q.description AS question
+    FROM model AS m
+    JOIN research_question AS q ON q.questionid = m.questionid
+    ORDER BY m.modelid
+    """
+    return read_query(connection, query)
+
+
+def get_model_metadata(connection, model_ids=None):
+    """Get the name, number of versions, active version, research question and team of
+    each model.
+
+    Parameters
+    ----------
+    connection : sqlalchemy.engine.Connection
+        ModMon database connection
+    model_ids : list, optional
+        Only include these models, by default None (all models)
+
+    Returns
+    -------
+    pandas.DataFrame
+        A row for each active model version, with the columns modelid, model,
+        versions, active_version, questionid, question and team
+    """
+    query = f"""
+    SELECT m.modelid, m.name AS model, v.versions, mv.modelversion AS active_version,
+    m.questionid, q.description AS question, m.teamname AS team
+    FROM model AS m
+    JOIN research_question AS q ON q.questionid = m.questionid
+    JOIN model_version AS mv ON mv.modelid = m.modelid AND mv.active
+    JOIN (
+        SELECT modelid, count(*) AS versions FROM model_version GROUP BY modelid
+    ) AS v ON v.modelid = m.modelid
+    WHERE TRUE {model_filter("m.modelid", model_ids)}
+    ORDER BY m.modelid, mv.modelversion
+    """
+    return read_query(connection, query)
+
+
+def get_score_history(connection, model_ids=None):
+    """Get the score of each model version for each metric on each dataset, using the
+    latest run if a model version was run more than once on a dataset. Reference scores
+    and scores for slices are not included.
+
+    Parameters
+    ----------
+    connection : sqlalchemy.engine.Connection
+        ModMon database connection
+    model_ids : list, optional
+        Only include these models, by default None (all models)
+
+    Returns
+    -------
+    pandas.DataFrame
+        A row for each score, ordered by model and dataset, with the columns model
+        (<name>_<version>), titles (<metric> (<research question>)), datasetid and
+        value
+    """
+    query = f"""
+    SELECT model, titles, datasetid, value
+    FROM (
+        SELECT m.name || '_' || s.modelversion AS model,
+        s.metric || ' (' || q.description || ')' AS titles,
+        s.modelid, s.datasetid, s.value,
+        ROW_NUMBER() OVER (
+            PARTITION BY s.modelid, s.modelversion, s.datasetid, s.metric
+            ORDER BY s.runid DESC
+        ) AS position
+        FROM score AS s
+        JOIN model AS m ON m.modelid = s.modelid
+        JOIN research_question AS q ON q.questionid = m.questionid
+        WHERE s.slice = ''
+        AND NOT s.isreference
+        {model_filter("s.modelid", model_ids)}
+    ) AS h
+    WHERE position = 1
+    ORDER BY modelid, datasetid
+    """
+    return read_query(connection, query)
+
+
+def get_score_comparison(connection, model_ids=None):
+    """Get the reference score of each model version for each metric, its score on
+    the first dataset it was run on and its latest score. Reference and latest scores
+    are looked up in the latest_score summary (see modmon.db.summary).
+
+    Parameters
+    ----------
+    connection : sqlalchemy.engine.Connection
+        ModMon database connection
+    model_ids : list, optional
+        Only include these models, by default None (all models)
+
+    Returns
+    -------
+    pandas.DataFrame
+        A row for each model version and metric, with the columns model_metric
+        (<name>_<version>_<metric>), metric, reference, first and latest
+    """
+    query = f"""
+    SELECT m.name || '_' || l.modelversion || '_' || l.metric AS model_metric,
+    l.metric, l.referencevalue AS reference, f.value AS first, l.value AS latest
+    FROM latest_score AS l
+    JOIN model AS m ON m.modelid = l.modelid
+    LEFT JOIN (
+        SELECT modelid, modelversion, metric, value,
+        ROW_NUMBER() OVER (
+            PARTITION BY modelid, modelversion, metric ORDER BY datasetid, runid
+        ) AS position
+        FROM score
+        WHERE slice = ''
+        AND NOT isreference
+        {model_filter("modelid", model_ids)}
+    ) AS f
+    ON f.modelid = l.modelid
+    AND f.modelversion = l.modelversion
+    AND f.metric = l.metric
+    AND f.position = 1
+    WHERE l.slice = ''
+    {model_filter("l.modelid", model_ids)}
+    ORDER BY l.modelid, l.modelversion, l.metric
+    """
+    return read_query(connection, query)
+
+
+def lttb(x, y, max_points):
+    """Downsample a series with the Largest-Triangle-Three-Buckets algorithm, which
+    keeps the points that preserve the visual shape of the series (e.g. peaks and
+    dips), rather than every n-th point.
+
+    Parameters
+    ----------
+    x : array-like
+        x values of the series, in ascending order
+    y : array-like
+        y values of the series
+    max_points : int
+        Maximum number of points to keep. If less than 3 only the first and (if
+        max_points is 2) last points are kept.
+
+    Returns
+    -------
+    numpy.ndarray
+        Indices of the points to keep, in ascending order. All points are kept if
+        there are no more than max_points.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n_points = len(x)
+    if n_points <= max_points:
+        return np.arange(n_points)
+    if max_points < 3:
+        # too few points for any buckets, so only keep the endpoints that fit
+        return np.array([0, n_points - 1][: max(max_points, 0)], dtype=int)
+
+    # the first and last points are always kept, and one point is picked from each of
+    # max_points - 2 buckets of the points between them
+    edges = np.linspace(1, n_points - 1, max_points - 1).astype(int)
+    keep = np.empty(max_points, dtype=int)
+    keep[0] = 0
+    keep[-1] = n_points - 1
+    selected = 0
+    for bucket in range(max_points - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        # the next point is represented by the mean of the next bucket
+        if bucket == max_points - 3:
+            next_x, next_y = x[-1], y[-1]
+        else:
+            next_end = edges[bucket + 2]
+            next_x, next_y = x[end:next_end].mean(), y[end:next_end].mean()
+        # (twice the) area of the triangle between the last selected point, each point
+        # in the bucket and the next point
+        area = np.abs(
+            (x[selected] - next_x) * (y[start:end] - y[selected])
+            - (x[selected] - x[start:end]) * (next_y - y[selected])
+        )
+        selected = start + int(np.argmax(area))
+        keep[bucket + 1] = selected
+    return keep
+
+
+def compact_values(values, digits=6):
+    """Convert values to a list of ints or floats rounded to a number of significant
+    digits, to keep their JSON short.
+
+    Parameters
+    ----------
+    values : array-like
+        Values to convert
+    digits : int, optional
+        Number of significant digits, by default 6
+
+    Returns
+    -------
+    list
+        Converted values, with None for missing values
+    """
+    values = pd.Series(values)
+    if pd.api.types.is_integer_dtype(values):
+        return [int(v) for v in values]
+    return [None if pd.isna(v) else float(f"{v:.{digits}g}") for v in values]
+
+
+def get_series(frame, x, y, name):
+    """Split a DataFrame into the series plotted in an interactive chart.
+
+    Parameters
+    ----------
+    frame : pandas.DataFrame
+        Data for the chart
+    x : str
+        Column of x values
+    y : str
+        Column of y values
+    name : str
+        Column to split the series by, used as the series' names
+
+    Returns
+    -------
+    list
+        A dict for each series with its name, number of points n, and lists of x and
+        y values, ordered by x
+    """
+    series = []
+    for series_name, points in frame.dropna(subset=[x, y]).groupby(name, sort=False):
+        points = points.sort_values(x, kind="mergesort")
+        series.append(
+            {
+                "name": str(series_name),
+                "n": len(points),
+                "x": compact_values(points[x]),
+                "y": compact_values(points[y]),
+            }
+        )
+    return series
+
+
+def downsample_charts(charts, max_points):
+    """Downsample each series in interactive charts to at most max_points points (see
+    lttb).
+
+    Parameters
+    ----------
+    charts : list
+        A dict for each chart with a list of series (see get_series), as returned by
+        the chart functions in modmon.report.figures
+    max_points : int
+        Maximum number of points in each series
+
+    Returns
+    -------
+    list, bool
+        Downsampled copy of the charts, and whether any series were downsampled
+    """
+    downsampled = False
+    sampled_charts = []
+    for chart in charts:
+        sampled_series = []
+        for series in chart["series"]:
+            keep = lttb(series["x"], series["y"], max_points)
+            if len(keep) < len(series["x"]):
+                downsampled = True
+                series = dict(
+                    series,
+                    x=[series["x"][i] for i in keep],
+                    y=[series["y"][i] for i in keep],
+                )
+            sampled_series.append(series)
+        sampled_charts.append(dict(chart, series=sampled_series))
+    return sampled_charts, downsampled
@@ -0,0 +1,204 @@
+"""
+Functions that build the figures and tables of the model appraisal report from the
+ModMon database (see modmon.report.report). Each is registered with the plot, chart
+or table decorator for one scope of report page: the index, the page of each research
+question, or the page of each model. Figures take the IDs of the models on their page
+(None on the index), so each page only loads its own data, and its docstring is used as
+its caption. Figures also list the tables they read, so rendered figures can be cached
+until the data in those tables changes.
+"""
+from collections import namedtuple
+import html
+
+import matplotlib
+
+# render without a display, including in report worker processes
+matplotlib.use("Agg")
+
+import seaborn as sns  # noqa: E402
+from matplotlib import pyplot as plt  # noqa: E402
+
+from .data import (  # noqa: E402
+    get_model_metadata,
+    get_score_comparison,
+    get_score_history,
+    get_series,
+)
+
+# Scopes of report pages: one index page, and a page for each research question and
+# each model
+PAGE_SCOPES = ["index", "question", "model"]
+
+ReportFigure = namedtuple("ReportFigure", ["type", "function", "scope", "tables"])
+
+# {name: ReportFigure} of each figure in the report, in the order they're shown
+FIGURES = {}
+
+# Queries summarising the rows of each table a figure can read (for some models, with
+# {models} replaced by a model_filter on the column t.modelid). A query's result changes
+# when rows are added or removed, or when the small tables are edited, so figures only
+# need to be rendered again when the results for their tables change.
+TABLE_FINGERPRINTS = {
+    "model": (
+        "SELECT modelid, name, teamname, questionid FROM model AS t "
+        "WHERE TRUE {models} ORDER BY modelid"
+    ),
+    "model_version": (
+        "SELECT modelid, modelversion, active FROM model_version AS t "
+        "WHERE TRUE {models} ORDER BY modelid, modelversion"
+    ),
+    "research_question": (
+        "SELECT questionid, description FROM research_question ORDER BY questionid"
+    ),
+    "score": "SELECT count(*), max(runid) FROM score AS t WHERE TRUE {models}",
+    "latest_score": (
+        "SELECT count(*), max(updatedtime) FROM latest_score AS t WHERE TRUE {models}"
+    ),
+}
+
+
+def get_page_file(scope, key=None):
+    """Get the file name of a report page, relative to the report directory.
+
+    Parameters
+    ----------
+    scope : str
+        Scope of the page, one of PAGE_SCOPES
+    key : int, optional
+        ID of the research question or model, by default None (for the index)
+
+    Returns
+    -------
+    str
+        File name of the page, e.g. model_1.html
+    """
+    if scope == "index":
+        return "index.html"
+    return f"{scope}_{key}.html"
+
+
+def plot(scope="index", tables=()):
+    """Register a function that takes a database connection and the IDs of the models
+    on its page, and returns a matplotlib.figure.Figure, as a figure on each page of
+    scope (see PAGE_SCOPES). tables are the names of the tables it reads (see
+    TABLE_FINGERPRINTS).
+    """
+
+    def register(function):
+        FIGURES[function.__name__] = ReportFigure("plot", function, scope, tables)
+        return function
+
+    return register
+
+
+def chart(scope="index", tables=()):
+    """Register a function that takes a database connection and the IDs of the models
+    on its page, and returns a list of interactive charts, as a figure on each page of
+    scope (see PAGE_SCOPES). Each chart is a dict with a title, xlabel, ylabel, legend
+    (title) and list of series (see modmon.report.data.get_series), and is downsampled
+    and drawn in the browser (see templates/charts.js). tables are the names of the
+    tables it reads (see TABLE_FINGERPRINTS).
+    """
+
+    def register(function):
+        FIGURES[function.__name__] = ReportFigure("chart", function, scope, tables)
+        return function
+
+    return register
+
+
+def table(scope="index", tables=()):
+    """Register a function that takes a database connection and the IDs of the models
+    on its page, and returns a HTML table, as a table on each page of scope (see
+    PAGE_SCOPES). tables are the names of the tables it reads (see
+    TABLE_FINGERPRINTS).
+    """
+
+    def register(function):
+        FIGURES[function.__name__] = ReportFigure("table", function, scope, tables)
+        return function
+
+    return register
+
+
+def link(text, href):
+    """HTML link, escaping its text."""
+    return f'<a href="{href}">{html.escape(str(text))}</a>'
+
+
+@table(scope="index", tables=["model", "model_version", "research_question"])
+def metadata_table(connection, model_ids=None):
+    """Models in the monitoring database (ModMon). Follow the links for the report
+    of each model and research question."""
+    metadata = get_model_metadata(connection, model_ids)
+    metadata["model"] = [
+        link(name, get_page_file("model", model_id))
+        for name, model_id in zip(metadata["model"], metadata["modelid"])
+    ]
+    metadata["question"] = [
+        link(question, get_page_file("question", question_id))
+        for question, question_id in zip(metadata["question"], metadata["questionid"])
+    ]
+    metadata = metadata[["model", "versions", "active_version", "question", "team"]]
+    return metadata.to_html(index=False, escape=False)
+
+
+def score_history_charts(scores, legend_title):
+    """Charts of the history of scores with a chart for each metric and a series for
+    each model version (see modmon.report.data.get_score_history).
+    """
+    return [
+        {
+            "title": title,
+            "xlabel": "Dataset ID",
+            "ylabel": "Metric Value",
+            "legend": legend_title,
+            "series": get_series(metric_scores, "datasetid", "value", "model"),
+        }
+        for title, metric_scores in scores.groupby("titles", sort=True)
+    ]
+
+
+@chart(scope="question", tables=["model", "research_question", "score"])
+def question_scores(connection, model_ids):
+    """Performance of the models for this research question across datasets.
+    Each chart shows the performance of the models according to a given
+    metric."""
+    return score_history_charts(get_score_history(connection, model_ids), "Models")
+
+
+@chart(scope="model", tables=["model", "research_question", "score"])
+def model_scores(connection, model_ids):
+    """Performance of each version of this model across datasets.
+    Each chart shows the performance of the model according to a given metric."""
+    return score_history_charts(get_score_history(connection, model_ids), "Versions")
+
+
+@plot(scope="model", tables=["model", "latest_score", "score"])
+def model_bars(connection, model_ids):
+    """Comparison between the reference performance of each version of this model,
+    its performance on the first dataset it was run on and its performance on the
+    most recent dataset"""
+    reduced_scores = (
+        get_score_comparison(connection, model_ids)
+        .melt(
+            id_vars=["model_metric", "metric"],
+            value_vars=["reference", "first", "latest"],
+            var_name="score",
+        )
+        .dropna(subset=["value"])
+    )
+
+    g1 = sns.FacetGrid(
+        data=reduced_scores,
+        col="model_metric",
+        col_wrap=3,
+        sharey=False,
+        sharex=False,
+        hue="metric",
+    )
+    g1.map(plt.bar, "score", "value").fig.subplots_adjust(hspace=0.4)
+    g1.set(xlabel=None, ylabel=None)
+    g1.set_titles(col_template="{col_name}")
+    g1.add_legend(title="Metrics")
+    return g1.fig
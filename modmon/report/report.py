@@ -1,31 +1,411 @@
+import argparse
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
 import datetime
+import inspect
+import io
+import json
 from pathlib import Path
-import subprocess
 import shutil
 
+import jinja2
+import markdown
+from matplotlib import pyplot as plt
+
 from ..config import config
+from ..db.connect import ENGINE, get_connection
 from ..utils.utils import ask_for_confirmation
+from .cache import (
+    get_figure_cache_dir,
+    get_figure_key,
+    prune_figure_cache,
+    read_cached_figure,
+    write_cached_figure,
+)
+from .data import downsample_charts, get_models
+from .figures import FIGURES, get_page_file
+
+TEMPLATES_DIR = Path(__file__).parent / "templates"
+# Templates of the index page and of the other pages of the report
+TEMPLATE_FILE = "index.html"
+PAGE_TEMPLATE_FILE = "page.html"
+# Subdirectory of a report the full resolution data of its charts are saved in
+CHART_DATA_DIR = "data"
+
+Page = namedtuple("Page", ["scope", "key", "title", "model_ids"])
+
+
+def get_report_config(report_config=None):
+    """Get the report settings from the config file.
+
+    Parameters
+    ----------
+    report_config : configparser.SectionProxy, optional
+        configparser section containing the key 'reportdir' and optionally 'jobs' and
+        'maxpoints', by default None which uses modmon.config.config["reports"].
+
+    Returns
+    -------
+    str, int, int
+        Directory reports are saved to, the number of processes to render figures in,
+        and the maximum number of points in each series of an interactive chart
+    """
+    if report_config is None:
+        report_config = config["reports"]
+    report_dir = report_config["reportdir"]
+    jobs = int(report_config.get("jobs", 4))
+    max_points = int(report_config.get("maxpoints", 500))
+    return report_dir, jobs, max_points
+
+
+def figure_to_svg(figure):
+    """Convert a matplotlib figure to an SVG string and close it.
+
+    Parameters
+    ----------
+    figure : matplotlib.figure.Figure
+        Figure to convert
+
+    Returns
+    -------
+    str
+        SVG of the figure
+    """
+    svg = io.StringIO()
+    figure.savefig(svg, format="svg", bbox_inches="tight")
+    plt.close(figure)
+    return svg.getvalue()
+
+
+def charts_to_json(charts, max_points):
+    """Convert interactive charts to compact JSON, with each series downsampled to at
+    most max_points points.
+
+    Parameters
+    ----------
+    charts : list
+        Charts returned by a chart function in modmon.report.figures
+    max_points : int
+        Maximum number of points in each series (see modmon.report.data.lttb)
+
+    Returns
+    -------
+    str
+        JSON object with the downsampled charts ("charts") and the full resolution
+        charts ("full"), which is null if no series were downsampled
+    """
+    sampled, downsampled = downsample_charts(charts, max_points)
+    return json.dumps(
+        {"charts": sampled, "full": charts if downsampled else None},
+        separators=(",", ":"),
+    )
+
+
+def write_chart_data(output_dir, page_file, name, content):
+    """Save the full resolution data of a chart to a script in the report's
+    CHART_DATA_DIR, which the page loads when it's asked for (see
+    templates/charts.js), so it isn't part of the page itself.
+
+    Parameters
+    ----------
+    output_dir : str or Path
+        Directory of the report
+    page_file : str
+        File name of the chart's page
+    name : str
+        Name of the chart in modmon.report.figures.FIGURES
+    content : str
+        Rendered chart (see charts_to_json)
+
+    Returns
+    -------
+    str, str or None
+        JSON of the downsampled charts to embed in the page, and the path of the full
+        resolution data relative to the page (None if no series were downsampled)
+    """
+    content = json.loads(content)
+    sampled = json.dumps(content["charts"], separators=(",", ":"))
+    if content["full"] is None:
+        return sampled, None
+    data_file = f"{CHART_DATA_DIR}/{Path(page_file).stem}_{name}.js"
+    full = json.dumps(content["full"], separators=(",", ":"))
+    Path(output_dir, CHART_DATA_DIR).mkdir(parents=True, exist_ok=True)
+    with open(Path(output_dir, data_file), "w") as f:
+        f.write(f"modmonChartData({json.dumps(name)},{full});\n")
+    return sampled, data_file
+
+
+def get_pages(models, model_ids=None):
+    """Get the pages of the report: an index page, a page for each research question
+    and a page for each model.
+
+    Parameters
+    ----------
+    models : pandas.DataFrame
+        Models in the database (see modmon.report.data.get_models)
+    model_ids : list, optional
+        Only include these models in the report, by default None (all models)
+
+    Returns
+    -------
+    list
+        Page of each page of the report, with the IDs of the models on the page
+        (None on the index of a report of all models)
+    """
+    if model_ids is not None:
+        models = models[models["modelid"].isin(model_ids)]
+        model_ids = models["modelid"].tolist()
+
+    pages = [Page("index", None, "Model Appraisal Report", model_ids)]
+    for (question_id, question), question_models in models.groupby(
+        ["questionid", "question"], sort=True
+    ):
+        pages.append(
+            Page("question", question_id, question, question_models["modelid"].tolist())
+        )
+    for model_id, name in zip(models["modelid"], models["name"]):
+        pages.append(Page("model", int(model_id), name, [int(model_id)]))
+    return pages
+
+
+def get_render_tasks(pages):
+    """Get the figures to render for each page of the report, which can be rendered in
+    parallel.
+
+    Parameters
+    ----------
+    pages : list
+        Pages of the report (see get_pages)
+
+    Returns
+    -------
+    list
+        (name, model_ids) of each figure on each page, in the order of the pages
+    """
+    return [
+        (name, page.model_ids)
+        for page in pages
+        for name, figure in FIGURES.items()
+        if figure.scope == page.scope
+    ]
+
+
+def render_figure(name, model_ids=None, max_points=500):
+    """Build and render a report figure (see modmon.report.figures).
+
+    Parameters
+    ----------
+    name : str
+        Name of the figure in modmon.report.figures.FIGURES
+    model_ids : list, optional
+        IDs of the models on the figure's page, by default None (all models)
+    max_points : int, optional
+        Maximum number of points in each series of interactive charts, by default 500
+
+    Returns
+    -------
+    str
+        Content of the figure, SVG for plots, JSON for charts (see charts_to_json) or
+        HTML for tables
+    """
+    figure = FIGURES[name]
+    connection = get_connection()
+    try:
+        content = figure.function(connection, model_ids)
+    finally:
+        connection.close()
+    if figure.type == "plot":
+        content = figure_to_svg(content)
+    elif figure.type == "chart":
+        content = charts_to_json(content, max_points)
+    return content
+
+
+def _init_worker():
+    """Discard database connections inherited from the parent process."""
+    ENGINE.dispose()
+
+
+def _render_figure_worker(task):
+    """Run render_figure in a worker process, returning the error rather than raising
+    it so one failed figure doesn't stop the report.
+    """
+    try:
+        return render_figure(*task), None
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+
+
+def render_figures(tasks, jobs=1, cache_dir=None, max_points=500, verbose=True):
+    """Render report figures, in parallel processes if jobs > 1. If a cache directory
+    is given, only figures whose code or data has changed since they were cached are
+    rendered (see modmon.report.cache).
+
+    Parameters
+    ----------
+    tasks : list
+        (name, model_ids) of each figure to render (see get_render_tasks)
+    jobs : int, optional
+        Number of processes to render figures in, by default 1
+    cache_dir : str or Path, optional
+        Directory of cached figures (see modmon.report.cache.get_figure_cache_dir),
+        by default None which renders all figures without caching them
+    max_points : int, optional
+        Maximum number of points in each series of interactive charts, by default 500
+    verbose : bool, optional
+        If True print how many figures were rendered, by default True
+
+    Returns
+    -------
+    list, list
+        (content, error) of each task, where content is the rendered figure
+        (None if it failed to render), and the cache keys of the figures (empty if
+        cache_dir is None)
+    """
+    keys = []
+    if cache_dir is not None:
+        connection = get_connection()
+        try:
+            keys = [
+                get_figure_key(connection, *task, max_points=max_points)
+                for task in tasks
+            ]
+        finally:
+            connection.close()
+
+    # (content, error) of each task, None if it needs rendering
+    results = [None] * len(tasks)
+    for i, key in enumerate(keys):
+        content = read_cached_figure(cache_dir, key)
+        if content is not None:
+            results[i] = (content, None)
+    to_render = [i for i, result in enumerate(results) if result is None]
+    if verbose:
+        print(f"Rendering {len(to_render)} of {len(tasks)} figures")
 
+    render_tasks = [(*tasks[i], max_points) for i in to_render]
+    if jobs > 1 and len(render_tasks) > 1:
+        with ProcessPoolExecutor(
+            max_workers=min(jobs, len(render_tasks)), initializer=_init_worker
+        ) as pool:
+            rendered = list(pool.map(_render_figure_worker, render_tasks))
+    else:
+        rendered = [_render_figure_worker(task) for task in render_tasks]
+    for i, (content, error) in zip(to_render, rendered):
+        results[i] = (content, error)
+        if cache_dir is not None and error is None:
+            write_cached_figure(cache_dir, keys[i], content)
+    return results, keys
 
-def generate_report():
-    """Generate a html report containing plots found in test_modmon.py"""
-    report_dir = config["reports"]["reportdir"]
+
+def write_html(output_file, figures, template=TEMPLATE_FILE, **context):
+    """Write a HTML report page from a template in modmon/report/templates.
+
+    Parameters
+    ----------
+    output_file : str or Path
+        Path to save the page to
+    figures : dict
+        {name: figure} of the page's figures, each a dict with the figure's type
+        ("plot", "chart" or "table"), description and content, and for charts the
+        path to their full resolution data (see write_chart_data)
+    template : str, optional
+        Name of the template file, by default TEMPLATE_FILE
+    **context
+        Other variables used in the template
+    """
+    # escape variables such as titles (which come from model names and research
+    # question descriptions in the database); rendered figures are marked as safe
+    environment = jinja2.Environment(
+        loader=jinja2.FileSystemLoader(str(TEMPLATES_DIR)),
+        autoescape=jinja2.select_autoescape(["html"]),
+    )
+    environment.filters["markdown"] = markdown.markdown
+    html = environment.get_template(template).render(figures=figures, **context)
+    Path(output_file).parent.mkdir(parents=True, exist_ok=True)
+    with open(output_file, "w") as f:
+        f.write(html)
+
+
+def generate_report(jobs=None, use_cache=True, model_ids=None, verbose=True):
+    """Generate a html report with an index page and a page for each research question
+    and each model, containing the figures in modmon.report.figures. Figures are
+    rendered in parallel processes, and figures whose data hasn't changed since the
+    last report are reused from the cache in the report directory.
+
+    Parameters
+    ----------
+    jobs : int, optional
+        Number of processes to render figures in, by default None which uses the value
+        in modmon.config.config["reports"] (see get_report_config)
+    use_cache : bool, optional
+        If True only render figures whose data has changed since they were cached,
+        otherwise render all figures (and cache them), by default True
+    model_ids : list, optional
+        Only include these models in the report, by default None (all models)
+    verbose : bool, optional
+        If True print additional progress messages, by default True
+
+    Returns
+    -------
+    Path
+        Path to the index page of the report
+    """
+    report_dir, default_jobs, max_points = get_report_config()
+    jobs = default_jobs if jobs is None else jobs
     print("Generating model appraisal report and saving to", report_dir)
-    date_str = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-    subprocess.run(
-        [
-            "python",
-            "-m",
-            "unitreport",
-            "--output_file",
-            report_dir + "/model_appraisal_" + date_str + ".html",
-            "--templates_dir",
-            "templates",
-        ],
-        check=True,
-        cwd=Path(__file__).parent,
-        capture_output=True,
+    now = datetime.datetime.now()
+    output_dir = Path(report_dir, f"model_appraisal_{now:%Y%m%d_%H%M%S}")
+
+    connection = get_connection()
+    try:
+        pages = get_pages(get_models(connection), model_ids)
+    finally:
+        connection.close()
+    tasks = get_render_tasks(pages)
+
+    cache_dir = get_figure_cache_dir(report_dir)
+    if not use_cache:
+        prune_figure_cache(cache_dir, keep=[])
+    results, keys = render_figures(
+        tasks, jobs=jobs, cache_dir=cache_dir, max_points=max_points, verbose=verbose
     )
+    if model_ids is None:
+        # only keep the figures of the latest full report
+        prune_figure_cache(cache_dir, keys)
+
+    results = iter(results)
+    for page in pages:
+        page_file = get_page_file(page.scope, page.key)
+        figures = {}
+        for name, figure in FIGURES.items():
+            if figure.scope != page.scope:
+                continue
+            content, error = next(results)
+            if error is not None:
+                if verbose:
+                    print(f"Failed to render {name} for {page.title}: {error}")
+                continue
+            figures[name] = {
+                "type": figure.type,
+                "description": inspect.getdoc(figure.function),
+                "content": content,
+            }
+            if figure.type == "chart":
+                content, data_file = write_chart_data(
+                    output_dir, page_file, name, content
+                )
+                figures[name].update(content=content, data_file=data_file)
+        write_html(
+            Path(output_dir, page_file),
+            figures,
+            template=TEMPLATE_FILE if page.scope == "index" else PAGE_TEMPLATE_FILE,
+            date=now.strftime("%Y-%m-%d %H:%M"),
+            title=page.title,
+            scope=page.scope,
+            index_file=get_page_file("index"),
+        )
+    return Path(output_dir, get_page_file("index"))
 
 
 def delete_all_reports_from_storage(
@@ -57,4 +437,28 @@ def main():
 
     Available from the command-line as modmon_report
     """
-    generate_report()
+    parser = argparse.ArgumentParser(
+        description="Generate a report of the performance of all models in ModMon"
+    )
+    parser.add_argument(
+        "--jobs",
+        help=(
+            "Number of processes to render figures in (default: jobs in the [reports] "
+            "section of the config file)"
+        ),
+        type=int,
+    )
+    parser.add_argument(
+        "--force",
+        help="If set, render all figures rather than reusing cached figures",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--models",
+        help="IDs of models to include in the report (default: all models)",
+        type=int,
+        nargs="+",
+    )
+    args = parser.parse_args()
+
+    generate_report(jobs=args.jobs, use_cache=not args.force, model_ids=args.models)
@@ -0,0 +1,201 @@
+// Draws the interactive charts of the model appraisal report (see the chart figures in
+// modmon/report/figures.py). Each chart figure embeds its downsampled series as JSON,
+// and the full resolution series are loaded from a script in the report's data
+// directory when asked for.
+(function () {
+  var SVG_NS = "http://www.w3.org/2000/svg";
+  var COLORS = [
+    "#1f77b4", "#ff7f0e", "#2ca02c", "#d62728", "#9467bd",
+    "#8c564b", "#e377c2", "#7f7f7f", "#bcbd22", "#17becf",
+  ];
+  var WIDTH = 720;
+  var HEIGHT = 260;
+  var MARGIN = { top: 30, right: 20, bottom: 40, left: 60 };
+
+  function svgElement(name, attributes, parent) {
+    var element = document.createElementNS(SVG_NS, name);
+    for (var key in attributes) {
+      element.setAttribute(key, attributes[key]);
+    }
+    parent.appendChild(element);
+    return element;
+  }
+
+  function text(value, attributes, parent) {
+    svgElement("text", attributes, parent).textContent = value;
+  }
+
+  function format(value) {
+    return Number(value.toPrecision(4)).toString();
+  }
+
+  function extent(series, axis) {
+    var min = Infinity;
+    var max = -Infinity;
+    series.forEach(function (s) {
+      s[axis].forEach(function (v) {
+        if (v !== null) {
+          min = Math.min(min, v);
+          max = Math.max(max, v);
+        }
+      });
+    });
+    if (min === Infinity) {
+      return [0, 1];
+    }
+    if (min === max) {
+      return [min - 0.5, max + 0.5];
+    }
+    return [min, max];
+  }
+
+  function drawChart(container, chart, hidden) {
+    var visible = chart.series.filter(function (s) {
+      return !hidden[s.name];
+    });
+    var xRange = extent(visible, "x");
+    var yRange = extent(visible, "y");
+    var plotWidth = WIDTH - MARGIN.left - MARGIN.right;
+    var plotHeight = HEIGHT - MARGIN.top - MARGIN.bottom;
+    function scaleX(v) {
+      return MARGIN.left + ((v - xRange[0]) / (xRange[1] - xRange[0])) * plotWidth;
+    }
+    function scaleY(v) {
+      return MARGIN.top + (1 - (v - yRange[0]) / (yRange[1] - yRange[0])) * plotHeight;
+    }
+
+    var svg = svgElement(
+      "svg",
+      { viewBox: "0 0 " + WIDTH + " " + HEIGHT, class: "chart-plot" },
+      container
+    );
+    text(chart.title, { x: WIDTH / 2, y: 18, "text-anchor": "middle" }, svg);
+    svgElement("rect", {
+      x: MARGIN.left, y: MARGIN.top, width: plotWidth, height: plotHeight,
+      fill: "none", stroke: "#999",
+    }, svg);
+    for (var i = 0; i <= 4; i++) {
+      var xTick = xRange[0] + ((xRange[1] - xRange[0]) * i) / 4;
+      var yTick = yRange[0] + ((yRange[1] - yRange[0]) * i) / 4;
+      text(format(xTick), {
+        x: scaleX(xTick), y: HEIGHT - MARGIN.bottom + 14, "text-anchor": "middle",
+        "font-size": 10,
+      }, svg);
+      text(format(yTick), {
+        x: MARGIN.left - 4, y: scaleY(yTick) + 3, "text-anchor": "end",
+        "font-size": 10,
+      }, svg);
+    }
+    text(chart.xlabel, {
+      x: MARGIN.left + plotWidth / 2, y: HEIGHT - 6, "text-anchor": "middle",
+      "font-size": 11,
+    }, svg);
+    text(chart.ylabel, {
+      x: 12, y: MARGIN.top + plotHeight / 2, "text-anchor": "middle",
+      "font-size": 11,
+      transform: "rotate(-90 12 " + (MARGIN.top + plotHeight / 2) + ")",
+    }, svg);
+
+    chart.series.forEach(function (s, index) {
+      if (hidden[s.name]) {
+        return;
+      }
+      var color = COLORS[index % COLORS.length];
+      var points = [];
+      var group = svgElement("g", { fill: color }, svg);
+      s.x.forEach(function (x, j) {
+        var y = s.y[j];
+        if (y === null) {
+          return;
+        }
+        points.push(scaleX(x) + "," + scaleY(y));
+        var point = svgElement("circle", { cx: scaleX(x), cy: scaleY(y), r: 2.5 }, group);
+        svgElement("title", {}, point).textContent =
+          s.name + "\n" + chart.xlabel + ": " + x + "\n" + chart.ylabel + ": " + y;
+      });
+      svgElement("polyline", {
+        points: points.join(" "), fill: "none", stroke: color, "stroke-width": 1,
+      }, svg);
+    });
+  }
+
+  function drawLegend(container, chart, hidden, redraw) {
+    var legend = document.createElement("div");
+    legend.className = "chart-legend";
+    if (chart.legend) {
+      legend.appendChild(document.createTextNode(chart.legend + ": "));
+    }
+    chart.series.forEach(function (s, index) {
+      var item = document.createElement("span");
+      item.className = hidden[s.name] ? "hidden" : "";
+      item.style.color = COLORS[index % COLORS.length];
+      item.textContent = "● " + s.name;
+      item.title = s.n + " points (click to show or hide)";
+      item.onclick = function () {
+        hidden[s.name] = !hidden[s.name];
+        redraw();
+      };
+      legend.appendChild(item);
+    });
+    container.appendChild(legend);
+  }
+
+  function drawFigure(figure) {
+    var container = document.getElementById(figure.id);
+    container.innerHTML = "";
+    figure.charts.forEach(function (chart, index) {
+      var hidden = figure.hidden[index] || (figure.hidden[index] = {});
+      var element = document.createElement("div");
+      element.className = "chart";
+      container.appendChild(element);
+      function redraw() {
+        element.innerHTML = "";
+        drawChart(element, chart, hidden);
+        drawLegend(element, chart, hidden, redraw);
+      }
+      redraw();
+    });
+    if (figure.fullFile) {
+      var button = document.createElement("button");
+      button.textContent =
+        figure.charts === figure.full ? "Show fewer points" : "Show all points";
+      button.onclick = function () {
+        if (figure.full) {
+          figure.charts = figure.charts === figure.full ? figure.sampled : figure.full;
+          drawFigure(figure);
+        } else {
+          var script = document.createElement("script");
+          script.src = figure.fullFile;
+          document.body.appendChild(script);
+        }
+      };
+      container.appendChild(button);
+    }
+  }
+
+  var figures = {};
+
+  // Called by the full resolution data scripts in the report's data directory
+  window.modmonChartData = function (id, charts) {
+    var figure = figures[id];
+    figure.full = charts;
+    figure.charts = charts;
+    drawFigure(figure);
+  };
+
+  var elements = document.querySelectorAll("script.chart-data");
+  for (var i = 0; i < elements.length; i++) {
+    var element = elements[i];
+    var sampled = JSON.parse(element.textContent);
+    var figure = {
+      id: element.getAttribute("data-chart"),
+      sampled: sampled,
+      charts: sampled,
+      full: null,
+      fullFile: element.getAttribute("data-full"),
+      hidden: {},
+    };
+    figures[figure.id] = figure;
+    drawFigure(figure);
+  }
+})();
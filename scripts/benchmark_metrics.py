@@ -0,0 +1,103 @@
+"""
+Measure the throughput of the metric kernels in modmon.metrics.kernels on random binary
+classification data, processed in chunks as when evaluating a prediction run.
+
+Also times calculating all the kernels for the whole dataset and for a number of
+slices (random groups) in one grouped pass.
+
+Usage: python scripts/benchmark_metrics.py [--rows 10000000] [--chunksize 100000]
+    [--groups 200]
+"""
+import argparse
+import time
+
+import numpy as np
+
+from modmon.metrics.kernels import KERNELS, OutputEvaluator, get_kernels
+
+
+def make_data(n_rows, seed=0):
+    """Random predicted probabilities and labels drawn from them."""
+    rng = np.random.default_rng(seed)
+    y_pred = rng.uniform(size=n_rows)
+    y_true = (rng.uniform(size=n_rows) < y_pred).astype(float)
+    return y_pred, y_true
+
+
+def benchmark_kernel(name, y_pred, y_true, chunk_size):
+    """Time updating a kernel with all the data in chunks and calculating its
+    metrics.
+    """
+    kernel = get_kernels([name])[name]
+    groups = np.zeros(len(y_pred), dtype=np.int64)
+    start = time.perf_counter()
+    for i in range(0, len(y_pred), chunk_size):
+        kernel.update(
+            y_pred[i : i + chunk_size],
+            y_true[i : i + chunk_size],
+            groups[i : i + chunk_size],
+        )
+    result = kernel.result()
+    return time.perf_counter() - start, result
+
+
+def benchmark_evaluator(y_pred, y_true, chunk_size, n_groups=1):
+    """Time calculating all kernels for the whole dataset (group 0) and, if n_groups
+    is more than 1, for random slices (groups 1 to n_groups - 1) in the same pass.
+    """
+    rng = np.random.default_rng(1)
+    slices = rng.integers(1, n_groups, size=len(y_pred)) if n_groups > 1 else None
+    evaluator = OutputEvaluator(n_groups=n_groups)
+    start = time.perf_counter()
+    for i in range(0, len(y_pred), chunk_size):
+        chunk_pred = y_pred[i : i + chunk_size]
+        chunk_true = y_true[i : i + chunk_size]
+        if slices is None:
+            evaluator.update(chunk_pred, chunk_true)
+        else:
+            # each row is in the overall group and one slice
+            rows = np.concatenate([np.arange(len(chunk_pred))] * 2)
+            groups = np.concatenate(
+                [np.zeros(len(chunk_pred), dtype=np.int64), slices[i : i + chunk_size]]
+            )
+            evaluator.update(chunk_pred[rows], chunk_true[rows], groups, n_groups)
+    evaluator.result()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ModMon metric kernels")
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    parser.add_argument("--chunksize", type=int, default=100_000)
+    parser.add_argument(
+        "--groups",
+        type=int,
+        default=200,
+        help="Number of groups for the sliced benchmark, including the overall group",
+    )
+    args = parser.parse_args()
+
+    y_pred, y_true = make_data(args.rows)
+    print(f"{args.rows} rows in chunks of {args.chunksize}")
+    for name in KERNELS:
+        seconds, result = benchmark_kernel(name, y_pred, y_true, args.chunksize)
+        values = ", ".join(
+            f"{metric}={value[0]:.4f}" for metric, value in result.items()
+        )
+        print(
+            f"{name:>12}: {seconds:6.2f}s  {args.rows / seconds / 1e6:7.1f}M rows/s  "
+            f"({values})"
+        )
+
+    seconds = benchmark_evaluator(y_pred, y_true, args.chunksize)
+    print(f"{'all':>12}: {seconds:6.2f}s  {args.rows / seconds / 1e6:7.1f}M rows/s")
+
+    seconds = benchmark_evaluator(y_pred, y_true, args.chunksize, args.groups)
+    print(
+        f"{'all sliced':>12}: {seconds:6.2f}s  {args.rows / seconds / 1e6:7.1f}M rows/s"
+        f"  ({args.groups} groups)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -45,6 +45,17 @@ setup(
             "modmon_retrain=modmon.models.retrain:main",
             "modmon_delete=modmon.utils.delete:main",
             "modmon_report=modmon.report.report:main",
+            "modmon_storage=modmon.models.store:main",
+            "modmon_drift=modmon.metrics.drift:main",
+            "modmon_sketch=modmon.metrics.sketch:main",
+            "modmon_rollup=modmon.metrics.rollup:main",
+            "modmon_labels_ingest=modmon.metrics.labels:main",
+            "modmon_labels_score=modmon.metrics.evaluate:main",
+            "modmon_slices=modmon.metrics.slices:main",
+            "modmon_bootstrap=modmon.metrics.bootstrap:main",
+            "modmon_alerts=modmon.metrics.alerts:main",
+            "modmon_anomaly=modmon.metrics.anomaly:main",
+            "modmon_summary_rebuild=modmon.db.summary:main",
         ]
     },
     package_data={"modmon": ["config/defaults.ini", "report/templates/*"]},